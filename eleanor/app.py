@@ -1,11 +1,27 @@
 """Web app module for eleanor service"""
+import logging
+
 from flask import Flask, json, request, Response
 
-from utils import eleanor_logger
+from utils import eleanor_logger, iter_gzip, iter_ndjson, log_payload
 
+from eleanor import cache, ingest, metrics, payloads
 from eleanor.clients.postgres import utils as pg_utils
 
 web_app = Flask(__name__)
+metrics.init_app(web_app)
+
+
+def stream_json_array(items):
+    """Yields an iterable of items that are already JSON encoded as a single
+    JSON array one item at a time
+    """
+    yield '['
+    for index, item in enumerate(items):
+        if index:
+            yield ','
+        yield item
+    yield ']'
 
 
 @web_app.route('/')
@@ -19,12 +35,45 @@ def hello():
     '/twitter-tl-users', methods=['POST', 'GET'], strict_slashes=False
 )
 def tracked_twitter_tl_user():
-    """Get or add new twitter users to be polled"""
+    """Get or add new twitter users to be polled. GET responses carry an ETag
+    and a matching If-None-Match is answered with a 304"""
     if request.method == 'GET':
         eleanor_logger.debug('Returning tracked twitter timeline users')
-        tracked_users = pg_utils.get_tracked_twitter_tl_users()
+        etag, body = pg_utils.get_tracked_twitter_tl_users_payload()
+        # Weak comparison, as proxies that compress responses weaken etags
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(
+                status=304
+            )
+        else:
+            resp = Response(
+                status=200,
+                mimetype='application/json',
+                response=body
+            )
+        resp.set_etag(etag)
+        return resp
+    elif request.method == 'POST':
+        request_data = request.get_json()
+        try:
+            request_users = request_data['twitter_usernames']
+        except (KeyError, TypeError):
+            request_users = None
+        if not isinstance(request_users, list) or not all(
+                isinstance(username, basestring) for username in request_users
+        ):
+            resp = Response(
+                status=400
+            )
+            return resp
+        log_payload(
+            logging.INFO,
+            'Adding users: %s to tracked twitter timline users',
+            request_users
+        )
+        added_users = pg_utils.begin_tracking_twitter_users(request_users)
         return_data = {
-            'twitter_usernames': tracked_users
+            'added_twitter_usernames': added_users
         }
         resp = Response(
             status=200,
@@ -32,37 +81,88 @@ def tracked_twitter_tl_user():
             response=json.dumps(return_data)
         )
         return resp
-    elif request.method == 'POST':
-        eleanor_logger.debug(
-            'twitter-tl-users POST headers are: %s', request.headers
-        )
-        eleanor_logger.debug(
-            'twitter-tl-users POST request data: %s', request
-        )
-        eleanor_logger.debug(
-            'twitter-tl-users POST json: %s', request.json
-        )
-        for k, v in request.headers.items():
-            if k.lower() == 'content-type':
-                if v.lower() == 'application/json':
-                    request_users = request.json['twitter_usernames']
-                    eleanor_logger.info(
-                        'Adding users: %s to tracked twitter timline users',
-                        request_users
-                    )
-                    for username in request_users:
-                        if not pg_utils.is_twitter_user_in_interns(username):
-                            pg_utils.begin_tracking_twitter_user(username)
-        resp = Response(status=200)
-        return resp
 
 
 @web_app.route('/add-tweet-data', methods=['POST'], strict_slashes=False)
 def add_tweet_data():
-    """Add data pulled from a tweet"""
-    tweet_data = request.get_json()
-    pg_utils.insert_tweet_data(tweet_data)
-    return '200'
+    """Add data pulled from a tweet. When asynchronous ingest is enabled the
+    tweet is validated and queued, returning a 202, or a 429 if the queue is
+    full
+    """
+    tweet_data = request.get_data()
+    ingest_queue = ingest.get_ingest_queue()
+    try:
+        if ingest_queue is None:
+            pg_utils.insert_tweet_data(tweet_data)
+            return '200'
+        row = pg_utils.get_tweet_row(tweet_data)
+    except payloads.InvalidTweetPayload:
+        resp = Response(
+            status=400
+        )
+        return resp
+    if not ingest_queue.put(row):
+        eleanor_logger.warning('Ingest queue is full, rejecting tweet')
+        resp = Response(
+            status=429,
+            headers={'Retry-After': '1'}
+        )
+        return resp
+    resp = Response(
+        status=202
+    )
+    return resp
+
+
+@web_app.route('/ingest/status', strict_slashes=False)
+def ingest_status():
+    """Returns the depth of the asynchronous ingest queue along with counts of
+    the tweets written from it"""
+    ingest_queue = ingest.get_ingest_queue()
+    if ingest_queue is None:
+        return_data = {'enabled': False, 'queue_depth': 0}
+    else:
+        return_data = ingest_queue.status()
+    resp = Response(
+        status=200,
+        mimetype='application/json',
+        response=json.dumps(return_data)
+    )
+    return resp
+
+
+@web_app.route(
+    '/add-tweet-data/batch', methods=['POST'], strict_slashes=False
+)
+def add_tweet_data_batch():
+    """Add data pulled from many tweets at once. Accepts either a JSON array of
+    tweet payloads or NDJSON with one tweet payload per line and returns the
+    result for each tweet in the same order
+    """
+    if request.mimetype == 'application/x-ndjson':
+        # Lines that aren't valid JSON are reported back as per tweet errors
+        tweets = [
+            line for line in request.get_data().splitlines() if line.strip()
+        ]
+    else:
+        try:
+            tweets = payloads.loads(request.get_data())
+        except ValueError:
+            tweets = None
+    if not isinstance(tweets, list):
+        resp = Response(
+            status=400
+        )
+        return resp
+    return_data = {
+        'results': pg_utils.insert_tweet_data_batch(tweets)
+    }
+    resp = Response(
+        status=200,
+        mimetype='application/json',
+        response=json.dumps(return_data)
+    )
+    return resp
 
 
 @web_app.route('/tweet/<tweet_id>', strict_slashes=False)
@@ -70,12 +170,12 @@ def get_tweet_from_id(tweet_id):
     """When given a tweet_id returns tweet data in the same format provided
     initially or returns a 204 if no tweet is found
     """
-    tweet_data = pg_utils.get_tweet_data_by_id(tweet_id)
-    if tweet_data:
+    tweet_json = pg_utils.get_tweet_json_by_id(tweet_id)
+    if tweet_json:
         resp = Response(
             status=200,
             mimetype='application/json',
-            response=json.dumps(tweet_data)
+            response=tweet_json
         )
         return resp
     else:
@@ -85,6 +185,121 @@ def get_tweet_from_id(tweet_id):
         return resp
 
 
+@web_app.route('/tweets', methods=['POST'], strict_slashes=False)
+def get_tweets():
+    """When given either a list of tweet_ids or a twitter username with an
+    optional since_id and max_id returns a JSON array of the matching tweets in
+    the same format as /tweet/<tweet_id>, streamed as they are read
+    """
+    request_data = request.get_json()
+    try:
+        if 'tweet_ids' in request_data:
+            tweets = pg_utils.get_tweet_data_by_ids(
+                request_data['tweet_ids'], serialized=True
+            )
+        else:
+            tweets = pg_utils.get_user_tweet_data(
+                request_data['twitter_username'],
+                since_id=request_data.get('since_id'),
+                max_id=request_data.get('max_id'),
+                serialized=True
+            )
+    except (AttributeError, KeyError, TypeError, ValueError):
+        resp = Response(
+            status=400
+        )
+        return resp
+    resp = Response(
+        stream_json_array(tweets),
+        status=200,
+        mimetype='application/json'
+    )
+    return resp
+
+
+@web_app.route('/users/<username>/tweets', strict_slashes=False)
+def get_user_tweets(username):
+    """Returns a page of tweets from username, newest first. Pass the
+    next_before value from a page as the before query argument to get the
+    next one"""
+    try:
+        page = pg_utils.get_user_tweet_page(
+            username,
+            before=request.args.get('before'),
+            limit=request.args.get('limit', pg_utils.USER_TWEET_PAGE_SIZE),
+            serialized=True
+        )
+    except (TypeError, ValueError):
+        resp = Response(
+            status=400
+        )
+        return resp
+    # The tweets are already JSON encoded so the page is put together around
+    # them rather than encoded again
+    resp = Response(
+        status=200,
+        mimetype='application/json',
+        response='{{"next_before": {0}, "tweets": [{1}]}}'.format(
+            json.dumps(page['next_before']), ','.join(page['tweets'])
+        )
+    )
+    return resp
+
+
+@web_app.route('/export', strict_slashes=False)
+def export_tweets():
+    """Streams every stored tweet as newline delimited JSON, optionally
+    filtered by the twitter_username, start_date and end_date query arguments.
+    The stream is gzip compressed when the client accepts gzip"""
+    try:
+        tweets = pg_utils.iter_tweet_export(
+            username=request.args.get('twitter_username'),
+            start=request.args.get('start_date'),
+            end=request.args.get('end_date'),
+            serialized=True
+        )
+    except (TypeError, ValueError):
+        resp = Response(
+            status=400
+        )
+        return resp
+    chunks = iter_ndjson(tweets, serialized=True)
+    # Caches must not serve the gzip stream to clients that didn't ask for it
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = iter_gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    resp = Response(
+        chunks,
+        status=200,
+        mimetype='application/x-ndjson',
+        headers=headers
+    )
+    return resp
+
+
+@web_app.route('/metrics', strict_slashes=False)
+def get_metrics():
+    """Returns request and database metrics in the prometheus text format"""
+    resp = Response(
+        metrics.render_metrics(),
+        status=200,
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+    return resp
+
+
+@web_app.route('/cache/status', strict_slashes=False)
+def cache_status():
+    """Returns the hit and miss counts of the tweet and last tweet id caches"""
+    resp = Response(
+        status=200,
+        mimetype='application/json',
+        response=json.dumps(cache.get_cache_stats())
+    )
+    return resp
+
+
 @web_app.route('/last-tweet-id/<username>', strict_slashes=False)
 def get_last_tweet_id(username):
     """Returns the last tweet_id from username or a 204 if username is not
@@ -106,10 +321,35 @@ def get_last_tweet_id(username):
         return resp
 
 
+@web_app.route('/last-tweet-ids', methods=['POST'], strict_slashes=False)
+def get_last_tweet_ids():
+    """When given a list of twitter usernames returns the last tweet_id for
+    each of them, or null for usernames with no tweets
+    """
+    request_data = request.get_json()
+    if not request_data or 'twitter_usernames' not in request_data:
+        resp = Response(
+            status=400
+        )
+        return resp
+    return_data = {
+        'last_tweet_ids': pg_utils.last_twitter_user_entry_ids(
+            request_data['twitter_usernames']
+        )
+    }
+    resp = Response(
+        status=200,
+        mimetype='application/json',
+        response=json.dumps(return_data)
+    )
+    return resp
+
+
 @web_app.route('/stats/tweets-on-date', methods=['POST'], strict_slashes=False)
 def search_twitter_data():
     """When given twitter username, a date, and a search term return
-    count"""
+    count. An optional search_match of 'substring' (the default) or 'token'
+    picks how the search term is matched"""
     return_data = None
     for k, v in request.headers.items():
         if k.lower() == 'content-type':
@@ -117,9 +357,18 @@ def search_twitter_data():
                 twitter_user = request.json['twitter_username']
                 search_date = request.json['search_date']
                 search_term = request.json['search_term']
-                return_data = pg_utils.search_count_of_user_tweets_on_day(
-                    twitter_user, search_date, search_term
+                search_match = request.json.get(
+                    'search_match', pg_utils.SEARCH_MATCH_SUBSTRING
                 )
+                try:
+                    return_data = pg_utils.search_count_of_user_tweets_on_day(
+                        twitter_user, search_date, search_term, search_match
+                    )
+                except ValueError:
+                    resp = Response(
+                        status=400
+                    )
+                    return resp
     if return_data is None:
         resp = Response(
             status=204
@@ -133,5 +382,84 @@ def search_twitter_data():
         )
         return resp
 
+
+@web_app.route('/stats/tweet-counts', methods=['POST'], strict_slashes=False)
+def count_twitter_data():
+    """When given a list of twitter usernames, a start and end date, a bucket
+    size of hour, day or week and a list of search terms return a dense time
+    series of counts for every username and search term"""
+    request_data = request.get_json()
+    try:
+        return_data = pg_utils.count_user_tweets_by_bucket(
+            request_data['twitter_usernames'],
+            request_data['start_date'],
+            request_data['end_date'],
+            request_data.get('bucket', 'day'),
+            request_data['search_terms'],
+            request_data.get(
+                'search_match', pg_utils.SEARCH_MATCH_SUBSTRING
+            )
+        )
+    except (AttributeError, KeyError, TypeError, ValueError):
+        resp = Response(
+            status=400
+        )
+        return resp
+    resp = Response(
+        status=200,
+        mimetype='application/json',
+        response=json.dumps(return_data)
+    )
+    return resp
+
+
+def get_top_rollup_response(rollup):
+    """Builds the response for the top hashtags, mentions and urls endpoints
+    from the named daily rollup"""
+    request_data = request.get_json()
+    try:
+        return_data = {
+            rollup: pg_utils.get_top_user_rollup_values(
+                rollup,
+                request_data['twitter_username'],
+                request_data['start_date'],
+                request_data['end_date'],
+                request_data.get('limit', 10)
+            )
+        }
+    except (AttributeError, KeyError, TypeError, ValueError):
+        resp = Response(
+            status=400
+        )
+        return resp
+    resp = Response(
+        status=200,
+        mimetype='application/json',
+        response=json.dumps(return_data)
+    )
+    return resp
+
+
+@web_app.route('/stats/top-hashtags', methods=['POST'], strict_slashes=False)
+def top_hashtags():
+    """When given a twitter username, a start date and an end date return the
+    hashtags used most by that user between those dates"""
+    return get_top_rollup_response('hashtags')
+
+
+@web_app.route('/stats/top-mentions', methods=['POST'], strict_slashes=False)
+def top_mentions():
+    """When given a twitter username, a start date and an end date return the
+    users mentioned most by that user between those dates"""
+    return get_top_rollup_response('user_mentions')
+
+
+@web_app.route('/stats/top-urls', methods=['POST'], strict_slashes=False)
+def top_urls():
+    """When given a twitter username, a start date and an end date return the
+    urls tweeted most by that user between those dates"""
+    return get_top_rollup_response('tweet_urls')
+
+
 if __name__ == '__main__':
     web_app.run()
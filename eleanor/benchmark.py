@@ -0,0 +1,334 @@
+"""Benchmarks for the ingest and read paths, run against a throwaway postgres
+database set up with model_setup.py. Tweets are generated from the example
+payload so the same seed and scale always produce the same data. A run
+refuses to write to the database in the eleanor cfg file or to a database
+that already has any of the generated tweets, and fails if any tweet isn't
+inserted, so every run times the same work
+"""
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.engine.url import make_url
+
+from eleanor import cache
+from eleanor.clients.postgres import client
+from eleanor.clients.postgres import utils as pg_utils
+
+
+EXAMPLE_PAYLOAD_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'example_payload_data.json'
+)
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+FIRST_TWEET_ID = 900000000000000000
+START_DATE = datetime(2016, 1, 1)
+
+
+class BenchmarkError(Exception):
+    """Raised when a benchmark can't be run or its tweets weren't inserted"""
+    pass
+
+
+def load_template(path=EXAMPLE_PAYLOAD_PATH):
+    """Returns the first tweet payload in the example payload file, which
+    holds payloads between lines of prose"""
+    with open(path) as payload_file:
+        contents = payload_file.read().decode('utf-8')
+    template, _ = json.JSONDecoder().raw_decode(contents[contents.index('{'):])
+    return template
+
+
+class TweetGenerator(object):
+    """Generates tweet payloads shaped like template, drawing words, hashtags,
+    mentions and urls from template
+
+    Keyword arguments:
+    seed -- seed for the random number generator
+    users -- number of distinct twitter users tweeting
+    days -- number of days from START_DATE the tweets are spread over
+    retweet_ratio -- fraction of tweets that are retweets
+    first_tweet_id -- tweet_id of the first generated tweet
+    """
+
+    def __init__(self, seed=0, users=20, days=30, retweet_ratio=0.1,
+                 first_tweet_id=FIRST_TWEET_ID, template=None):
+        # pylint: disable=too-many-arguments
+        self.random = random.Random(seed)
+        self.template = template or load_template()
+        self.users = ['bench_user_{0}'.format(user) for user in range(users)]
+        self.days = days
+        self.retweet_ratio = retweet_ratio
+        self.next_tweet_id = first_tweet_id
+        self.words = self.template['tweet_text'].split()
+        self.hashtags = self.template['hashtags'] + [
+            'hashtag{0}'.format(tag) for tag in range(50)
+        ]
+        self.mentions = self.template['user_mentions'] + self.users
+        self.urls = self.template['tweet_urls'] + [
+            'http://example.com/{0}'.format(url) for url in range(50)
+        ]
+
+    def sample(self, values, most):
+        """Returns up to most values picked from values"""
+        return self.random.sample(values, self.random.randint(0, most))
+
+    def generate_tweet(self):
+        """Returns the payload of a new original tweet"""
+        tweet_id = self.next_tweet_id
+        self.next_tweet_id += 1
+        user_name = self.random.choice(self.users)
+        posted = START_DATE + timedelta(
+            seconds=self.random.randint(0, self.days * 24 * 60 * 60 - 1)
+        )
+        tweet = dict(self.template)
+        tweet.update({
+            'user_name': user_name,
+            'tweet_id': str(tweet_id),
+            'url': 'https://twitter.com/{0}/status/{1}'.format(
+                user_name, tweet_id
+            ),
+            'tweet_text': ' '.join(
+                self.random.choice(self.words)
+                for _ in range(self.random.randint(5, 20))
+            ),
+            'tweet_created': posted.strftime(TWITTER_DATE_FORMAT),
+            'is_retweet': False,
+            'user_mentions': self.sample(self.mentions, 3),
+            'hashtags': self.sample(self.hashtags, 3),
+            'tweet_urls': self.sample(self.urls, 2),
+            'retweet_data': {},
+        })
+        return tweet
+
+    def generate(self, count):
+        """Returns a list of count tweet payloads, some of them retweets of
+        new tweets"""
+        tweets = []
+        for _ in range(count):
+            tweet = self.generate_tweet()
+            if self.random.random() < self.retweet_ratio:
+                retweet = self.generate_tweet()
+                retweet.update({
+                    'tweet_text': '',
+                    'is_retweet': True,
+                    'user_mentions': [],
+                    'hashtags': [],
+                    'tweet_urls': [],
+                    'retweet_data': tweet,
+                })
+                tweet = retweet
+            tweets.append(tweet)
+        return tweets
+
+
+def percentile(sorted_values, percent):
+    """Nearest rank percentile of a sorted list"""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def time_calls(func, calls):
+    """Calls func with each tuple of args in calls and returns the seconds
+    each call took"""
+    latencies = []
+    for args in calls:
+        start = time.time()
+        func(*args)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def summarize(latencies, items=None):
+    """Returns throughput and latency percentiles for a list of call times.
+    items is the number of tweets handled if it differs from the number of
+    calls"""
+    total = sum(latencies)
+    items = len(latencies) if items is None else items
+    latencies = [round(seconds * 1000, 3) for seconds in sorted(latencies)]
+    return {
+        'calls': len(latencies),
+        'items': items,
+        'total_seconds': round(total, 3),
+        'items_per_second': round(items / total, 1) if total else None,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+
+def is_service_database(database_url):
+    """Returns True if database_url names the database in the eleanor cfg
+    file"""
+    config = client.get_db_config()
+    for option in ('pg_uname', 'pg_pwd', 'pg_ip_address', 'pg_db_name'):
+        if not config.has_option('Postgres', option):
+            return False
+    url = make_url(database_url)
+    service_url = make_url(client.get_db_url(config))
+    return (
+        (url.host, url.port, url.database) ==
+        (service_url.host, service_url.port, service_url.database)
+    )
+
+
+def get_tweet_ids(payloads):
+    """Returns the set of tweet_ids of payloads and the tweets they retweet"""
+    tweet_ids = set()
+    for payload in payloads:
+        while payload:
+            tweet_ids.add(int(payload['tweet_id']))
+            payload = payload['retweet_data']
+    return tweet_ids
+
+
+def get_stored_tweet_ids(tweet_ids):
+    """Returns the set of tweet_ids that are in the database"""
+    with client.GetDBSession() as db_session:
+        return set(pg_utils.get_twitter_source_ids(tweet_ids, db_session))
+
+
+def insert_batch(tweets):
+    """Inserts a batch of tweets, raising BenchmarkError if any of them
+    wasn't inserted"""
+    results = pg_utils.insert_tweet_data_batch(tweets)
+    failed = [
+        result for result in results
+        if result['status'] != pg_utils.TWEET_INSERTED
+    ]
+    if failed:
+        raise BenchmarkError(
+            '{0} of a batch of {1} tweets were not inserted, the first was '
+            '{2}'.format(len(failed), len(tweets), failed[0])
+        )
+    return results
+
+
+def get_git_commit():
+    """Returns the commit of the checked out eleanor source, if any"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(database_url, tweets=10000, single=500, batch_size=500,
+                   lookups=1000, searches=200, users=20, seed=0,
+                   first_tweet_id=None, use_cache=False):
+    """Ingests generated tweets and times each of the ingest and read paths,
+    returning a dict of results that can be written out as JSON. Reads go to
+    the database unless use_cache is True. Raises BenchmarkError if
+    database_url is the service's database, if it already has any of the
+    generated tweets or if any of them isn't inserted
+
+    Keyword arguments:
+    database_url -- url of the throwaway database to benchmark against
+    tweets -- number of tweets to generate and ingest
+    single -- how many of those are ingested one at a time
+    batch_size -- tweets per call when ingesting the rest in batches
+    lookups -- number of tweet id and last tweet id lookups
+    searches -- number of searches for each match type
+    users -- number of distinct twitter users tweeting
+    seed -- seed for the tweet generator and the lookups
+    first_tweet_id -- tweet_id of the first generated tweet
+    use_cache -- leave the configured read caches on
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    if is_service_database(database_url):
+        raise BenchmarkError(
+            'Refusing to benchmark the database in the eleanor cfg file, '
+            'use a throwaway database'
+        )
+    client.use_database_url(database_url)
+    if not use_cache:
+        cache.disable_caches()
+    generator = TweetGenerator(
+        seed=seed, users=users,
+        first_tweet_id=first_tweet_id or FIRST_TWEET_ID
+    )
+    payloads = generator.generate(tweets)
+    tweet_ids = get_tweet_ids(payloads)
+    existing = get_stored_tweet_ids(tweet_ids)
+    if existing:
+        raise BenchmarkError(
+            '{0} of the generated tweets are already in the database, use an '
+            'empty database or another --first-tweet-id'.format(len(existing))
+        )
+    single = min(single, len(payloads))
+    results = {}
+
+    results['single_ingest'] = summarize(time_calls(
+        pg_utils.insert_tweet_data,
+        [(payload,) for payload in payloads[:single]]
+    ))
+    batches = [
+        (payloads[index:index + batch_size],)
+        for index in range(single, len(payloads), batch_size)
+    ]
+    results['batch_ingest'] = summarize(
+        time_calls(insert_batch, batches),
+        items=len(payloads) - single
+    )
+    # insert_tweet_data logs errors rather than raising them
+    missing = tweet_ids - get_stored_tweet_ids(tweet_ids)
+    if missing:
+        raise BenchmarkError(
+            '{0} of the generated tweets were not inserted'.format(
+                len(missing)
+            )
+        )
+
+    lookup_random = random.Random(seed)
+    lookup_ids = [payload['tweet_id'] for payload in payloads]
+    results['tweet_id_lookup'] = summarize(time_calls(
+        pg_utils.get_tweet_data_by_id,
+        [(tweet_id,) for tweet_id in lookup_random.sample(
+            lookup_ids, min(lookups, len(lookup_ids))
+        )]
+    ))
+    results['last_tweet_id_lookup'] = summarize(time_calls(
+        pg_utils.last_twitter_user_entry_id,
+        [(lookup_random.choice(generator.users),) for _ in range(lookups)]
+    ))
+
+    original_tweets = [
+        payload['retweet_data'] or payload for payload in payloads
+    ]
+    for match in (pg_utils.SEARCH_MATCH_SUBSTRING,
+                  pg_utils.SEARCH_MATCH_TOKEN):
+        calls = []
+        for _ in range(searches):
+            tweet = lookup_random.choice(original_tweets)
+            calls.append((
+                tweet['user_name'], tweet['tweet_created'],
+                lookup_random.choice(tweet['tweet_text'].split()), match
+            ))
+        results['search_{0}'.format(match)] = summarize(time_calls(
+            pg_utils.search_count_of_user_tweets_on_day, calls
+        ))
+
+    return {
+        'meta': {
+            'git_commit': get_git_commit(),
+            'run_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'tweets': tweets,
+            'single': single,
+            'batch_size': batch_size,
+            'lookups': lookups,
+            'searches': searches,
+            'users': users,
+            'seed': seed,
+            'use_cache': use_cache,
+        },
+        'results': results,
+    }
@@ -0,0 +1,225 @@
+"""Read-through caches for tweet data and last tweet ids. Values are kept in
+a bounded in-process LRU by default, or in redis so they are shared between
+processes
+"""
+import json
+import threading
+import time
+
+from eleanor.utils import eleanor_logger, LRUCache
+from eleanor.clients.postgres import client
+
+
+# Settings that can be overridden in a [Cache] section of the eleanor cfg
+# file. cache_backend is one of memory, redis or none and the ttls are in
+# seconds, 0 meaning entries only leave the cache when evicted
+DEFAULT_CACHE_SETTINGS = {
+    'cache_backend': 'memory',
+    'cache_max_size': '10000',
+    'cache_tweet_ttl': '0',
+    'cache_last_tweet_id_ttl': '30',
+    'cache_redis_url': 'redis://localhost:6379/0',
+}
+
+CACHE_BACKENDS = ('memory', 'redis', 'none')
+
+_caches_lock = threading.Lock()
+_caches = None
+
+
+def get_cache_settings():
+    """Returns the cache settings from the eleanor cfg file"""
+    config = client.get_db_config()
+    settings = dict(DEFAULT_CACHE_SETTINGS)
+    if config.has_section('Cache'):
+        for key in DEFAULT_CACHE_SETTINGS:
+            if config.has_option('Cache', key):
+                settings[key] = config.get('Cache', key)
+    backend = settings['cache_backend'].lower()
+    if backend not in CACHE_BACKENDS:
+        raise ValueError('Unknown cache_backend {0}'.format(backend))
+    return {
+        'backend': backend,
+        'max_size': int(settings['cache_max_size']),
+        'tweet_ttl': int(settings['cache_tweet_ttl']),
+        'last_tweet_id_ttl': int(settings['cache_last_tweet_id_ttl']),
+        'redis_url': settings['cache_redis_url'],
+    }
+
+
+class MemoryCacheBackend(object):
+    """Cache backend holding at most max_size entries in this process"""
+
+    def __init__(self, max_size):
+        self._items = LRUCache(max_size)
+
+    def get(self, key):
+        """Returns the value for key or None if it is missing or expired"""
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires and expires <= time.time():
+            self._items.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        """Store value for key, expiring after ttl seconds if ttl isn't 0"""
+        expires = time.time() + ttl if ttl else 0
+        self._items.set(key, (expires, value))
+
+    def delete(self, key):
+        """Remove key from the cache"""
+        self._items.delete(key)
+
+
+class RedisCacheBackend(object):
+    """Cache backend shared between processes through redis. Values are
+    stored as JSON
+    """
+
+    def __init__(self, redis_url, redis_client=None):
+        if redis_client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError(
+                    'The redis package is needed for cache_backend = redis'
+                )
+            redis_client = redis.StrictRedis.from_url(redis_url)
+        self._redis = redis_client
+
+    def get(self, key):
+        """Returns the value for key or None if it is missing"""
+        value = self._redis.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        """Store value for key, expiring after ttl seconds if ttl isn't 0"""
+        self._redis.set(key, json.dumps(value), ex=ttl or None)
+
+    def delete(self, key):
+        """Remove key from the cache"""
+        self._redis.delete(key)
+
+
+class ReadThroughCache(object):
+    """One kind of cached value, e.g. tweets by tweet_id, stored in a backend
+    under its own key prefix and counting hits and misses. A backend of None
+    caches nothing
+    """
+
+    def __init__(self, name, backend, ttl):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, key):
+        """Returns the backend key for key"""
+        return 'eleanor:{0}:{1}'.format(self.name, key)
+
+    def get(self, key):
+        """Returns the cached value for key or None"""
+        value = None
+        if self.backend is not None:
+            try:
+                value = self.backend.get(self.get_key(key))
+            except Exception as e:
+                # A broken cache should only make reads slower
+                eleanor_logger.error('Error reading %s cache %s', self.name, e)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Cache value for key"""
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(self.get_key(key), value, self.ttl)
+        except Exception as e:
+            eleanor_logger.error('Error writing %s cache %s', self.name, e)
+
+    def delete(self, key):
+        """Remove the cached value for key"""
+        if self.backend is None:
+            return
+        try:
+            self.backend.delete(self.get_key(key))
+        except Exception as e:
+            eleanor_logger.error('Error writing %s cache %s', self.name, e)
+
+    def get_or_load(self, key, load):
+        """Returns the cached value for key, otherwise calls load(key) and
+        caches the result unless it is None
+        """
+        value = self.get(key)
+        if value is None:
+            value = load(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def stats(self):
+        """Returns the hit and miss counts"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def get_caches():
+    """Returns the process wide dict of read-through caches, with a 'tweets'
+    cache of serialized tweet JSON keyed by tweet_id and a 'last_tweet_ids'
+    cache keyed by username
+    """
+    # pylint: disable=global-statement
+    global _caches
+    if _caches is not None:
+        return _caches
+    with _caches_lock:
+        if _caches is None:
+            settings = get_cache_settings()
+            backend = None
+            if settings['backend'] == 'memory':
+                backend = MemoryCacheBackend(settings['max_size'])
+            elif settings['backend'] == 'redis':
+                backend = RedisCacheBackend(settings['redis_url'])
+            # Tweets are cached as their serialized JSON under a key prefix
+            # of their own, so dicts cached in redis by older versions are
+            # never served
+            _caches = {
+                'tweets': ReadThroughCache(
+                    'tweet_json', backend, settings['tweet_ttl']
+                ),
+                'last_tweet_ids': ReadThroughCache(
+                    'last_tweet_ids', backend, settings['last_tweet_id_ttl']
+                ),
+            }
+    return _caches
+
+
+def disable_caches():
+    """Replace the process wide caches with ones that store nothing, so every
+    read goes to the database"""
+    # pylint: disable=global-statement
+    global _caches
+    with _caches_lock:
+        _caches = {
+            'tweets': ReadThroughCache('tweet_json', None, 0),
+            'last_tweet_ids': ReadThroughCache('last_tweet_ids', None, 0),
+        }
+
+
+def get_cache_stats():
+    """Returns the hit and miss counts of each cache"""
+    return dict(
+        (name, read_cache.stats()) for name, read_cache in get_caches().items()
+    )
@@ -0,0 +1,293 @@
+"""Bulk import of tweet payloads into postgres using COPY"""
+import gzip
+import io
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from eleanor import payloads
+from eleanor.utils import eleanor_logger
+from eleanor.clients.postgres.client import GetDBSession
+from eleanor.clients.postgres.utils import (
+    forget_last_tweet_ids, get_tweet_row, store_tweet_json,
+    TWEET_CHILD_TABLES
+)
+
+IMPORT_CHUNK_SIZE = 50000
+
+# Staging tables only live for the transaction that merges one chunk.
+# row_number identifies a tweet within the chunk so the children of a tweet
+# that appears more than once are only merged for the copy that is kept
+STAGING_TABLES = (
+    'CREATE TEMP TABLE staging_tweets ('
+    'row_number integer, depth integer, tweet_id bigint, user_name varchar, '
+    'url varchar, tweet_text text, time_posted timestamp, '
+    'is_retweet boolean, retweet_source_tweet_id bigint) ON COMMIT DROP',
+    'CREATE TEMP TABLE staging_tweet_children ('
+    'row_number integer, row_key varchar, position integer, value varchar) '
+    'ON COMMIT DROP',
+)
+
+# Keeps one staged copy of each tweet that isn't stored yet and reserves its
+# text_source id
+MERGE_NEW_TWEETS = (
+    "CREATE TEMP TABLE new_tweets ON COMMIT DROP AS "
+    "SELECT d.*, nextval('text_source_id_seq') AS text_source_id FROM ("
+    "SELECT DISTINCT ON (s.tweet_id) s.* FROM staging_tweets s "
+    "WHERE NOT EXISTS ("
+    "SELECT 1 FROM twitter_source ts WHERE ts.tweet_id = s.tweet_id) "
+    "ORDER BY s.tweet_id, s.row_number) d"
+)
+
+MERGE_TEXT_SOURCE = (
+    "INSERT INTO text_source "
+    "(id, source_key, source_url, written_text, time_posted) "
+    "SELECT text_source_id, 'twitter', url, tweet_text, time_posted "
+    "FROM new_tweets"
+)
+
+# Run once per retweet depth so retweets can reference the twitter_source rows
+# of the tweets they retweet
+MERGE_TWITTER_SOURCE = (
+    "INSERT INTO twitter_source "
+    "(text_source_id, retweet_source_id, tweeter_user_name, tweet_id, "
+    "is_retweet) "
+    "SELECT n.text_source_id, src.id, n.user_name, n.tweet_id, n.is_retweet "
+    "FROM new_tweets n "
+    "LEFT JOIN twitter_source src ON src.tweet_id = n.retweet_source_tweet_id "
+    "WHERE n.depth = :depth ORDER BY n.tweet_id "
+    "ON CONFLICT (tweet_id) DO NOTHING"
+)
+
+# Tweets another writer stored during the import keep their existing rows, so
+# the text rows reserved for them and their staged children are dropped
+DROP_CONFLICTING_TWEETS = (
+    "DELETE FROM new_tweets n WHERE NOT EXISTS ("
+    "SELECT 1 FROM twitter_source ts WHERE ts.tweet_id = n.tweet_id "
+    "AND ts.text_source_id = n.text_source_id)",
+    "DELETE FROM text_source t WHERE t.id IN ("
+    "SELECT s.id FROM unnest(CAST(:text_source_ids AS integer[])) AS s (id) "
+    "WHERE NOT EXISTS ("
+    "SELECT 1 FROM new_tweets n WHERE n.text_source_id = s.id))",
+)
+
+MERGE_DICTIONARY = (
+    "INSERT INTO {dictionary} ({column}) "
+    "SELECT DISTINCT c.value FROM staging_tweet_children c "
+    "JOIN new_tweets n ON n.row_number = c.row_number "
+    "WHERE c.row_key = :row_key AND NOT EXISTS ("
+    "SELECT 1 FROM {dictionary} d WHERE d.{column} = c.value) "
+    "ORDER BY c.value ON CONFLICT ({column}) DO NOTHING"
+)
+
+MERGE_CHILDREN = (
+    "INSERT INTO {child} (twitter_source_id, {id_column}) "
+    "SELECT ts.id, d.id FROM staging_tweet_children c "
+    "JOIN new_tweets n ON n.row_number = c.row_number "
+    "JOIN twitter_source ts ON ts.tweet_id = n.tweet_id "
+    "JOIN {dictionary} d ON d.{column} = c.value "
+    "WHERE c.row_key = :row_key ORDER BY n.tweet_id, c.position"
+)
+
+MERGE_ROLLUP = (
+    "INSERT INTO {rollup} (tweeter_user_name, day, {column}, tweet_count) "
+    "SELECT n.user_name, CAST(n.time_posted AS date), c.value, count(*) "
+    "FROM staging_tweet_children c "
+    "JOIN new_tweets n ON n.row_number = c.row_number "
+    "WHERE c.row_key = :row_key GROUP BY 1, 2, 3 ORDER BY 1, 2, 3 "
+    "ON CONFLICT (tweeter_user_name, day, {column}) DO UPDATE "
+    "SET tweet_count = {rollup}.tweet_count + EXCLUDED.tweet_count"
+)
+
+MERGE_USER_LAST_TWEET = (
+    "INSERT INTO user_last_tweet (tweeter_user_name, last_tweet_id) "
+    "SELECT user_name, max(tweet_id) FROM new_tweets "
+    "GROUP BY user_name ORDER BY user_name "
+    "ON CONFLICT (tweeter_user_name) DO UPDATE "
+    "SET last_tweet_id = GREATEST("
+    "user_last_tweet.last_tweet_id, EXCLUDED.last_tweet_id)"
+)
+
+
+def iter_payload_file(path):
+    """Yields each tweet payload in a file holding either a JSON array of
+    payloads or newline delimited JSON. NDJSON payloads are yielded as the raw
+    line and files ending in .gz are decompressed.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as payload_file:
+        # readline rather than iteration so the rest of a JSON array can
+        # still be read in one go
+        line = payload_file.readline()
+        while line and not line.strip():
+            line = payload_file.readline()
+        if not line:
+            return
+        if line.lstrip().startswith('['):
+            for payload in payloads.loads(line + payload_file.read()):
+                yield payload
+            return
+        yield line
+        for line in payload_file:
+            if line.strip():
+                yield line
+
+
+def get_copy_value(value):
+    """Formats a python value as a postgres CSV COPY field where \\N is null
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"{0}"'.format(value.replace('"', '""'))
+
+
+def copy_records(cursor, table, records):
+    """COPY a list of tuples into table using the given DBAPI cursor"""
+    copy_buffer = io.BytesIO()
+    for record in records:
+        copy_buffer.write(','.join(get_copy_value(value) for value in record))
+        copy_buffer.write('\n')
+    copy_buffer.seek(0)
+    cursor.copy_expert(
+        "COPY {0} FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table),
+        copy_buffer
+    )
+
+
+def get_staging_records(rows):
+    """Flattens tweet rows, including any retweeted tweets embedded in them,
+    into records for the staging_tweets and staging_tweet_children tables and
+    returns the highest retweet depth seen
+    """
+    tweet_records = []
+    child_records = []
+    max_depth = 0
+    for row in rows:
+        chain = []
+        while row is not None:
+            chain.append(row)
+            row = row['retweet_source_row']
+        for depth, chain_row in enumerate(reversed(chain)):
+            row_number = len(tweet_records)
+            max_depth = max(max_depth, depth)
+            tweet_records.append((
+                row_number, depth, chain_row['tweet_id'],
+                chain_row['user_name'], chain_row['url'],
+                chain_row['tweet_text'], chain_row['time_posted'],
+                chain_row['is_retweet'], chain_row['retweet_source_tweet_id']
+            ))
+            for child_table in TWEET_CHILD_TABLES:
+                for position, value in enumerate(
+                        chain_row[child_table.row_key]
+                ):
+                    child_records.append(
+                        (row_number, child_table.row_key, position, value)
+                    )
+    return tweet_records, child_records, max_depth
+
+
+def merge_tweet_rows(rows):
+    """Stages a chunk of tweet rows with COPY and merges them into the tweet
+    tables with set based statements in one transaction. Returns the number
+    of tweets that were newly inserted.
+    """
+    tweet_records, child_records, max_depth = get_staging_records(rows)
+    with GetDBSession() as db_session:
+        for statement in STAGING_TABLES:
+            db_session.execute(text(statement))
+        cursor = db_session.connection().connection.cursor()
+        copy_records(cursor, 'staging_tweets', tweet_records)
+        copy_records(cursor, 'staging_tweet_children', child_records)
+        cursor.close()
+
+        db_session.execute(text(MERGE_NEW_TWEETS))
+        text_source_ids = [
+            text_source_id for (text_source_id,) in db_session.execute(
+                text('SELECT text_source_id FROM new_tweets')
+            )
+        ]
+        db_session.execute(text(MERGE_TEXT_SOURCE))
+        for depth in range(max_depth + 1):
+            db_session.execute(text(MERGE_TWITTER_SOURCE), {'depth': depth})
+        db_session.execute(text(DROP_CONFLICTING_TWEETS[0]))
+        db_session.execute(
+            text(DROP_CONFLICTING_TWEETS[1]),
+            {'text_source_ids': text_source_ids}
+        )
+
+        for child_table in TWEET_CHILD_TABLES:
+            names = {
+                'child': child_table.model.__tablename__,
+                'id_column': child_table.id_column,
+                'dictionary': child_table.dictionary_model.__tablename__,
+                'column': child_table.column,
+                'rollup': child_table.rollup_model.__tablename__
+            }
+            params = {'row_key': child_table.row_key}
+            for statement in (MERGE_DICTIONARY, MERGE_CHILDREN, MERGE_ROLLUP):
+                db_session.execute(text(statement.format(**names)), params)
+        db_session.execute(text(MERGE_USER_LAST_TWEET))
+        user_names = [
+            user_name for (user_name,) in db_session.execute(
+                text('SELECT DISTINCT user_name FROM new_tweets')
+            )
+        ]
+        inserted_ids = [
+            tweet_id for (tweet_id,) in db_session.execute(
+                text('SELECT tweet_id FROM new_tweets')
+            )
+        ]
+        store_tweet_json(inserted_ids, db_session)
+        db_session.commit()
+    forget_last_tweet_ids(user_names)
+    return len(inserted_ids)
+
+
+def import_tweet_files(paths, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """Imports the tweet payloads in each of paths in chunks of chunk_size
+    payloads and returns a dict of totals. progress, if given, is called with
+    the running totals after each chunk.
+
+    Arguments:
+    paths -- list of JSON array or NDJSON payload files
+    chunk_size -- number of payloads merged per transaction
+    progress -- callable taking the totals dict
+    """
+    totals = {'read': 0, 'inserted': 0, 'invalid': 0, 'seconds': 0.0}
+    start = time.time()
+
+    def merge_chunk(rows):
+        # pylint: disable=missing-docstring
+        totals['inserted'] += merge_tweet_rows(rows)
+        totals['seconds'] = time.time() - start
+        if progress is not None:
+            progress(totals)
+
+    rows = []
+    for path in paths:
+        for payload in iter_payload_file(path):
+            totals['read'] += 1
+            try:
+                rows.append(get_tweet_row(payload))
+            except (KeyError, TypeError, ValueError) as e:
+                totals['invalid'] += 1
+                eleanor_logger.warning(
+                    'Skipping invalid tweet payload in %s: %r', path, e
+                )
+                continue
+            if len(rows) >= chunk_size:
+                merge_chunk(rows)
+                rows = []
+    if rows:
+        merge_chunk(rows)
+    totals['seconds'] = time.time() - start
+    return totals
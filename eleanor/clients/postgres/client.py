@@ -4,13 +4,34 @@ import getpass
 
 import ConfigParser
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import Session, sessionmaker
 
+from eleanor import metrics
+from eleanor.utils import ForkSafeLock
 
-def get_db_engine():
-    """Get the sqlalchemy db engine"""
-    config = ConfigParser.RawConfigParser()
+
+# Connection pool settings that can be overridden in the [Postgres] section of
+# the eleanor cfg file. pg_pool_recycle is in seconds (-1 disables recycling)
+# and pg_statement_timeout is in milliseconds (0 disables the timeout).
+# Queries slower than pg_slow_query_ms are logged (0 disables the log)
+DEFAULT_POOL_SETTINGS = {
+    'pg_pool_size': '25',
+    'pg_max_overflow': '10',
+    'pg_pool_recycle': '-1',
+    'pg_pool_pre_ping': 'false',
+    'pg_statement_timeout': '0',
+    'pg_slow_query_ms': '0',
+}
+
+_engine_lock = ForkSafeLock()
+_engine = None
+_session_factory = None
+
+
+def get_db_config():
+    """Read the eleanor cfg file and return the parsed config"""
+    config = ConfigParser.RawConfigParser(DEFAULT_POOL_SETTINGS)
     if getpass.getuser() != 'eleanor':
         path_to_file = os.path.abspath(os.path.dirname(__file__))
         path_to_conf_file = '/'.join(path_to_file.split('/')[:-2])
@@ -20,27 +41,132 @@ def get_db_engine():
     else:
         conf_file = '/etc/opt/eleanor/eleanor_auth.cfg'
     config.read(conf_file)
+    return config
+
+
+def record_connection_pid(dbapi_connection, connection_record):
+    """Pool connect listener that records which process opened a connection
+    """
+    # pylint: disable=unused-argument
+    connection_record.info['pid'] = os.getpid()
+
 
-    pg_user_name = config.get('Postgres', 'pg_uname')
-    pg_password = config.get('Postgres', 'pg_pwd')
-    pg_ip_address = config.get('Postgres', 'pg_ip_address')
-    pg_db_name = config.get('Postgres', 'pg_db_name')
+def check_connection_pid(dbapi_connection, connection_record,
+                         connection_proxy):
+    """Pool checkout listener that keeps a forked process from using the
+    connections it inherited. They are detached from the pool without being
+    closed, as closing one would end the session the parent is still using,
+    and the pool replaces them with new connections
+    """
+    # pylint: disable=unused-argument
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection belongs to pid {0}, not {1}'.format(
+                connection_record.info['pid'], os.getpid()
+            )
+        )
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Pool checkout listener that verifies a pooled connection is still alive
+    before handing it out, so stale connections are replaced transparently
+    """
+    # pylint: disable=unused-argument
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool will discard this connection and retry with a new one
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def get_db_url(config):
+    """Returns the url of the database in the eleanor cfg file"""
+    return 'postgresql://{0}:{1}@{2}/{3}'.format(
+        config.get('Postgres', 'pg_uname'),
+        config.get('Postgres', 'pg_pwd'),
+        config.get('Postgres', 'pg_ip_address'),
+        config.get('Postgres', 'pg_db_name')
+    )
+
+
+def get_db_engine(database_url=None):
+    """Get the sqlalchemy db engine, for database_url if given instead of the
+    database in the eleanor cfg file"""
+    config = get_db_config()
+    if database_url is None:
+        database_url = get_db_url(config)
+    elif not config.has_section('Postgres'):
+        # Pool settings fall back to their defaults
+        config.add_section('Postgres')
+
+    connect_args = {}
+    statement_timeout = config.getint('Postgres', 'pg_statement_timeout')
+    if statement_timeout > 0:
+        connect_args['options'] = '-c statement_timeout={0}'.format(
+            statement_timeout
+        )
 
     engine = create_engine(
-        'postgresql://{0}:{1}@{2}/{3}'.format(
-            pg_user_name, pg_password, pg_ip_address, pg_db_name
-        ),
-        pool_size=25
+        database_url,
+        pool_size=config.getint('Postgres', 'pg_pool_size'),
+        max_overflow=config.getint('Postgres', 'pg_max_overflow'),
+        pool_recycle=config.getint('Postgres', 'pg_pool_recycle'),
+        connect_args=connect_args
+    )
+    event.listen(engine, 'connect', record_connection_pid)
+    event.listen(engine, 'checkout', check_connection_pid)
+    if config.getboolean('Postgres', 'pg_pool_pre_ping'):
+        event.listen(engine, 'checkout', ping_connection)
+    metrics.instrument_engine(
+        engine, config.getint('Postgres', 'pg_slow_query_ms') / 1000.0
     )
     return engine
 
 
+class EleanorSession(Session):
+    """Session class of eleanor's sessionmaker, so session event listeners
+    can be registered for eleanor's sessions only"""
+    pass
+
+
+def get_session_factory():
+    """Return the process wide sessionmaker, creating the engine on first use.
+
+    A forked process, e.g. a gunicorn worker, keeps using the engine it
+    inherited. The engine's pool never hands it a connection opened by another
+    process, see check_connection_pid.
+    """
+    # pylint: disable=global-statement
+    global _engine, _session_factory
+    if _session_factory is None:
+        with _engine_lock:
+            if _session_factory is None:
+                _engine = get_db_engine()
+                _session_factory = sessionmaker(
+                    bind=_engine, class_=EleanorSession
+                )
+    return _session_factory
+
+
+def use_database_url(database_url):
+    """Point this process's sessions at database_url instead of the database
+    in the eleanor cfg file"""
+    # pylint: disable=global-statement
+    global _engine, _session_factory
+    with _engine_lock:
+        _engine = get_db_engine(database_url)
+        _session_factory = sessionmaker(bind=_engine, class_=EleanorSession)
+
+
 class GetDBSession(object):
     """This class acts as a context manager for postgres connections"""
 
     def __init__(self):
-        engine = get_db_engine()
-        Session = sessionmaker(bind=engine)
+        Session = get_session_factory()
         self.session = Session()
 
     def __enter__(self):
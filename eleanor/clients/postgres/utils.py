@@ -1,16 +1,19 @@
 """Utilities for the eleanor service"""
 
+import hashlib
 import json
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta
 
 from dateutil.parser import parse as date_parse
 
-from sqlalchemy import distinct, desc, and_
-from sqlalchemy.exc import IntegrityError
-
-from eleanor.utils import eleanor_logger
+from sqlalchemy import and_, desc, event, func, or_, text
+from eleanor import cache, payloads
+from eleanor.utils import eleanor_logger, LRUCache
 from eleanor.models import models, twitter_models
-from eleanor.clients.postgres.client import GetDBSession
+from eleanor.clients.postgres.client import EleanorSession, GetDBSession
 
 
 def get_string_from_datetime(dt):
@@ -21,94 +24,300 @@ def get_string_from_datetime(dt):
     return dt.strftime(dt_format)
 
 
+# Selects everything needed to serialize a tweet, and the tweet it retweets if
+# any, in one row. Child collections are aggregated into arrays so no lazy
+# loads are needed and the query can be streamed with a server side cursor
+TWEET_DATA_COLUMNS = (
+    'ts.tweeter_user_name, ts.tweet_id, ts.is_retweet, '
+    't.source_url, t.written_text, t.time_posted, '
+    'ARRAY(SELECT d.user_name FROM tweet_user_mentions m '
+    'JOIN mentioned_users d ON d.id = m.mentioned_user_id '
+    'WHERE m.twitter_source_id = ts.id ORDER BY m.id) AS user_mentions, '
+    'ARRAY(SELECT d.hashtag FROM tweet_hashtags h '
+    'JOIN hashtags d ON d.id = h.hashtag_id '
+    'WHERE h.twitter_source_id = ts.id ORDER BY h.id) AS hashtags, '
+    'ARRAY(SELECT d.url FROM tweet_urls u '
+    'JOIN urls d ON d.id = u.url_id '
+    'WHERE u.twitter_source_id = ts.id ORDER BY u.id) AS tweet_urls, '
+    'rs.tweeter_user_name AS retweet_tweeter_user_name, '
+    'rs.tweet_id AS retweet_tweet_id, '
+    'rs.is_retweet AS retweet_is_retweet, '
+    'rt.source_url AS retweet_source_url, '
+    'rt.written_text AS retweet_written_text, '
+    'rt.time_posted AS retweet_time_posted, '
+    'ARRAY(SELECT d.user_name FROM tweet_user_mentions m '
+    'JOIN mentioned_users d ON d.id = m.mentioned_user_id '
+    'WHERE m.twitter_source_id = rs.id ORDER BY m.id) '
+    'AS retweet_user_mentions, '
+    'ARRAY(SELECT d.hashtag FROM tweet_hashtags h '
+    'JOIN hashtags d ON d.id = h.hashtag_id '
+    'WHERE h.twitter_source_id = rs.id ORDER BY h.id) AS retweet_hashtags, '
+    'ARRAY(SELECT d.url FROM tweet_urls u '
+    'JOIN urls d ON d.id = u.url_id '
+    'WHERE u.twitter_source_id = rs.id ORDER BY u.id) AS retweet_tweet_urls'
+)
+TWEET_DATA_FROM = (
+    'FROM twitter_source ts '
+    'JOIN text_source t ON t.id = ts.text_source_id '
+    'LEFT JOIN twitter_source rs ON rs.id = ts.retweet_source_id '
+    'LEFT JOIN text_source rt ON rt.id = rs.text_source_id '
+)
+TWEET_DATA_QUERY = 'SELECT ' + TWEET_DATA_COLUMNS + ' ' + TWEET_DATA_FROM
+
+
+def get_tweet_data_from_row(row, prefix=''):
+    """Takes a row selected with TWEET_DATA_QUERY and returns the tweet data in
+    the same format it was provided in initially. A prefix of 'retweet_'
+    returns the retweeted tweet, which has no retweet_data of its own.
+    """
+    def column(name):
+        # pylint: disable=missing-docstring
+        return getattr(row, prefix + name)
+
+    tweet_data = {
+        'user_name': column('tweeter_user_name'),
+        'tweet_id': column('tweet_id'),
+        'url': column('source_url'),
+        'tweet_text': column('written_text'),
+        'tweet_created': get_string_from_datetime(column('time_posted')),
+        'is_retweet': column('is_retweet'),
+        'user_mentions': column('user_mentions'),
+        'hashtags': column('hashtags'),
+        'tweet_urls': column('tweet_urls')
+    }
+    if not prefix:
+        tweet_data['retweet_data'] = {}
+        if row.is_retweet:
+            tweet_data['retweet_data'] = get_tweet_data_from_row(
+                row, 'retweet_'
+            )
+    return tweet_data
+
+
+def serialize_tweet_data(tweet_data):
+    """Returns the JSON served for tweet data, with its keys sorted so the
+    same tweet always serializes the same way
+    """
+    return json.dumps(tweet_data, sort_keys=True)
+
+
+# Selects the stored serialized JSON of each tweet alongside its tweet data.
+# Tweets stored before the tweet_json table existed have a null payload until
+# backfill_tweet_json runs, and are serialized from the same row meanwhile
+TWEET_JSON_QUERY = (
+    'SELECT ' + TWEET_DATA_COLUMNS + ', j.payload ' + TWEET_DATA_FROM +
+    'LEFT JOIN tweet_json j ON j.tweet_id = ts.tweet_id '
+)
+
+
+def get_tweet_json_from_row(row):
+    """Takes a row selected with TWEET_JSON_QUERY and returns its stored JSON,
+    or serializes the row's tweet data if none has been stored yet
+    """
+    if row.payload is None:
+        return serialize_tweet_data(get_tweet_data_from_row(row))
+    return row.payload
+
+
+def iter_tweet_query(select_query, where_clause, params,
+                     order_by='ts.tweet_id', limit=None):
+    """Yields the rows of select_query for every tweet matching where_clause,
+    streamed from a server side cursor"""
+    query = select_query + 'WHERE {0} ORDER BY {1}'.format(
+        where_clause, order_by
+    )
+    if limit is not None:
+        query += ' LIMIT {0:d}'.format(limit)
+    query = text(query).execution_options(stream_results=True)
+    with GetDBSession() as db_session:
+        for row in db_session.execute(query, params):
+            yield row
+
+
+def iter_tweet_json(where_clause, params, order_by='ts.tweet_id', limit=None):
+    """Yields the tweet_id and serialized JSON of every tweet matching
+    where_clause, as stored at ingest. Tweets that haven't been backfilled
+    are serialized from their rows instead
+    """
+    rows = iter_tweet_query(
+        TWEET_JSON_QUERY, where_clause, params, order_by, limit
+    )
+    for row in rows:
+        yield row.tweet_id, get_tweet_json_from_row(row)
+
+
+def iter_tweet_data(where_clause, params, order_by='ts.tweet_id', limit=None,
+                    serialized=False):
+    """Yields the data for every tweet matching where_clause, which may refer
+    to the twitter_source table as ts and the text_source table as t. Rows are
+    streamed from a server side cursor in a single query so memory use does
+    not depend on how many tweets match.
+
+    Keyword arguments:
+    where_clause -- SQL condition with bind parameters
+    params -- dict of values for the bind parameters in where_clause
+    order_by -- SQL ordering for the results
+    limit -- maximum number of tweets to return, or None for no limit
+    serialized -- yield each tweet as its stored JSON string instead
+    """
+    if serialized:
+        return (
+            tweet_json for _, tweet_json in iter_tweet_json(
+                where_clause, params, order_by, limit
+            )
+        )
+    return (
+        get_tweet_data_from_row(row) for row in iter_tweet_query(
+            TWEET_DATA_QUERY, where_clause, params, order_by, limit
+        )
+    )
+
+
+def get_tweet_json_by_id(tweet_id):
+    """When given a tweet_id returns the tweet's serialized JSON if it is in
+    the database else returns None. Stored tweets never change so they are
+    served from the tweets cache once read
+    """
+    try:
+        tweet_id = int(tweet_id)
+    except ValueError:
+        return None
+    return cache.get_caches()['tweets'].get_or_load(
+        tweet_id, load_tweet_json_by_id
+    )
+
+
 def get_tweet_data_by_id(tweet_id):
     """When given a tweet_id returns the tweet data if in the database else
     returns None
     """
+    tweet_json = get_tweet_json_by_id(tweet_id)
+    if tweet_json is None:
+        return None
+    return json.loads(tweet_json)
+
+
+def load_tweet_json_by_id(tweet_id):
+    """Reads the serialized JSON for an integer tweet_id from the database"""
+    query = text(TWEET_JSON_QUERY + 'WHERE ts.tweet_id = :tweet_id')
     with GetDBSession() as db_session:
-        twitterSource = db_session.query(
-            twitter_models.TwitterSource
-        ).filter(
-            twitter_models.TwitterSource.tweet_id == tweet_id
-        ).first()
-        if not twitterSource:
-            return None
-
-        retweet_data = {}
-        if twitterSource.is_retweet:
-            retweetSource = db_session.query(
-                twitter_models
-            ).get(twitterSource.retweet_source_id)
-            retweet_data = {
-                'user_name': retweetSource.tweeter_user_name,
-                'tweet_id': retweetSource.tweet_id,
-                'url': retweetSource.text_source.source_url,
-                'tweet_text': retweetSource.text_source.written_text,
-                'tweet_created': get_string_from_datetime(
-                    retweetSource.text_source.time_posted
-                ),
-                'is_retweet': retweetSource.is_retweet,
-                'user_mentions': [
-                    mention.user_name for mention in retweetSource.mentions
-                ],
-                'hashtags': [
-                    hashtag.hashtag for hashtag in retweetSource.hashtags
-                ],
-                'tweet_urls': [
-                    url.url for url in retweetSource.urls
-                ]
-            }
+        row = db_session.execute(query, {'tweet_id': tweet_id}).first()
+    if row is None:
+        return None
+    return get_tweet_json_from_row(row)
 
-        ret_data = {
-            'user_name': twitterSource.tweeter_user_name,
-            'tweet_id': twitterSource.tweet_id,
-            'url': twitterSource.text_source.source_url,
-            'tweet_text': twitterSource.text_source.written_text,
-            'tweet_created': get_string_from_datetime(
-                twitterSource.text_source.time_posted
-            ),
-            'is_retweet': twitterSource.is_retweet,
-            'user_mentions': [
-                mention.user_name for mention in twitterSource.mentions
-            ],
-            'hashtags': [
-                hashtag.hashtag for hashtag in twitterSource.hashtags
-            ],
-            'tweet_urls': [
-                url.url for url in twitterSource.urls
-            ],
-            'retweet_data': retweet_data
-        }
-    return ret_data
 
+def get_tweet_data_by_ids(tweet_ids, serialized=False):
+    """When given a list of tweet_ids yields the data for each of those tweets
+    that is in the database, ordered by tweet_id, as serialized JSON if
+    serialized is True
+    """
+    return iter_tweet_data(
+        'ts.tweet_id = ANY(CAST(:tweet_ids AS bigint[]))',
+        {'tweet_ids': [int(tweet_id) for tweet_id in tweet_ids]},
+        serialized=serialized
+    )
 
-def insert_text_data(data_source, source_url, text, time_posted, session):
-    """Adds the base entry for a text data source to the database and returns
-    the newly created model
 
+def get_user_tweet_data(username, since_id=None, max_id=None,
+                        serialized=False):
+    """Yields the data for each tweet from username, ordered by tweet_id
 
-    Keyword arguments:
-    data_source -- An enum indicating source. The enum is located in
-    interns.models.models.AllowedSources
-    source_url -- A string indicating the url the text was pulled from
-    text -- the raw text data pulled from the url
-    time_posted -- either a datetime object or a datetime string
-    session -- active db session
+    Arguments:
+    username -- Twitter user_name/screen_name to get tweets for
+    since_id -- Only return tweets with a tweet_id greater than this
+    max_id -- Only return tweets with a tweet_id less than or equal to this
+    serialized -- Yield each tweet as its stored JSON string
     """
-    if not isinstance(time_posted, datetime):
-        time_posted = date_parse(time_posted)
+    conditions = ['ts.tweeter_user_name = :username']
+    params = {'username': username}
+    if since_id is not None:
+        conditions.append('ts.tweet_id > :since_id')
+        params['since_id'] = int(since_id)
+    if max_id is not None:
+        conditions.append('ts.tweet_id <= :max_id')
+        params['max_id'] = int(max_id)
+    return iter_tweet_data(
+        ' AND '.join(conditions), params, serialized=serialized
+    )
+
 
-    eleanor_logger.debug('Inserting text data into postgres')
+def iter_tweet_export(username=None, start=None, end=None, serialized=False):
+    """Yields the data for every stored tweet, ordered by tweet_id, optionally
+    limited to one username and to tweets posted between start (inclusive)
+    and end (exclusive). Tweets are streamed from a server side cursor so
+    memory use stays flat however many tweets are exported.
 
-    TextModel = models.TextSource(
-        source_key=data_source,
-        source_url=source_url,
-        written_text=text,
-        time_posted=time_posted
+    Arguments:
+    username -- Twitter user_name/screen_name to export tweets for
+    start -- datetime or datetime string of the earliest tweet to export
+    end -- datetime or datetime string to export tweets up to
+    serialized -- Yield each tweet as its stored JSON string
+    """
+    conditions = ['TRUE']
+    params = {}
+    if username is not None:
+        conditions.append('ts.tweeter_user_name = :username')
+        params['username'] = username
+    if start is not None:
+        if not isinstance(start, datetime):
+            start = date_parse(start)
+        conditions.append('t.time_posted >= :start')
+        params['start'] = payloads.to_naive_utc(start)
+    if end is not None:
+        if not isinstance(end, datetime):
+            end = date_parse(end)
+        conditions.append('t.time_posted < :end')
+        params['end'] = payloads.to_naive_utc(end)
+    return iter_tweet_data(
+        ' AND '.join(conditions), params, serialized=serialized
     )
 
-    session.add(TextModel)
-    return TextModel
+
+USER_TWEET_PAGE_SIZE = 20
+MAX_USER_TWEET_PAGE_SIZE = 200
+
+
+def get_user_tweet_page(username, before=None, limit=USER_TWEET_PAGE_SIZE,
+                        serialized=False):
+    """Returns one page of tweets from username, newest first, as a dict with
+    the tweets and the before value to pass to get the next page, which is
+    None on the last page. Pages are keyed on tweet_id so fetching a page
+    costs the same however deep into the timeline it is.
+
+    Arguments:
+    username -- Twitter user_name/screen_name to get tweets for
+    before -- Only return tweets with a tweet_id less than this
+    limit -- Number of tweets per page, at most MAX_USER_TWEET_PAGE_SIZE
+    serialized -- Return each tweet as its stored JSON string
+    """
+    limit = int(limit)
+    if not 0 < limit <= MAX_USER_TWEET_PAGE_SIZE:
+        raise ValueError('limit must be between 1 and {0}'.format(
+            MAX_USER_TWEET_PAGE_SIZE
+        ))
+    conditions = ['ts.tweeter_user_name = :username']
+    params = {'username': username}
+    if before is not None:
+        conditions.append('ts.tweet_id < :before')
+        params['before'] = int(before)
+    next_before = None
+    if serialized:
+        tweet_ids, tweets = [], []
+        for tweet_id, tweet_json in iter_tweet_json(
+                ' AND '.join(conditions), params, 'ts.tweet_id DESC', limit
+        ):
+            tweet_ids.append(tweet_id)
+            tweets.append(tweet_json)
+        if len(tweets) == limit:
+            next_before = tweet_ids[-1]
+        return {'tweets': tweets, 'next_before': next_before}
+    tweets = list(iter_tweet_data(
+        ' AND '.join(conditions), params, 'ts.tweet_id DESC', limit
+    ))
+    if len(tweets) == limit:
+        next_before = tweets[-1]['tweet_id']
+    return {'tweets': tweets, 'next_before': next_before}
 
 
 def get_tracked_twitter_tl_users():
@@ -116,16 +325,61 @@ def get_tracked_twitter_tl_users():
     Pull the list of twitter users that is being polled by the interns
     """
     eleanor_logger.debug('Getting listing of tracked twitter users')
-    tracked_users = []
     with GetDBSession() as db_session:
         tracked_users_query = db_session.query(
-            twitter_models.PolledTimelineUsers
-        )
-        for user in tracked_users_query:
-            tracked_users.append(user.user_name)
+            twitter_models.PolledTimelineUsers.user_name
+        ).order_by(twitter_models.PolledTimelineUsers.id)
+        tracked_users = [user_name for (user_name,) in tracked_users_query]
     return tracked_users
 
 
+# Seconds the serialized tracked users list is reused for. The version is
+# bumped whenever this process adds a tracked user, other processes pick up
+# the change once the ttl runs out
+TRACKED_USERS_CACHE_TTL = 60
+
+_tracked_users_lock = threading.Lock()
+_tracked_users_cache = {
+    'version': 0,
+    'cached_version': None,
+    'expires': 0,
+    'payload': None,
+}
+
+
+def get_tracked_twitter_tl_users_payload():
+    """
+    Returns an (etag, body) tuple where body is the JSON encoded list of
+    tracked twitter users and etag is a hash of body, reusing the last
+    encoding until a tracked user is added or TRACKED_USERS_CACHE_TTL passes
+    """
+    with _tracked_users_lock:
+        if (
+                _tracked_users_cache['cached_version'] ==
+                _tracked_users_cache['version'] and
+                _tracked_users_cache['expires'] > time.time()
+        ):
+            return _tracked_users_cache['payload']
+        version = _tracked_users_cache['version']
+    body = json.dumps({'twitter_usernames': get_tracked_twitter_tl_users()})
+    payload = (hashlib.md5(body).hexdigest(), body)
+    with _tracked_users_lock:
+        # A user added while the list was read leaves it to the next call
+        if _tracked_users_cache['version'] == version:
+            _tracked_users_cache.update({
+                'cached_version': version,
+                'expires': time.time() + TRACKED_USERS_CACHE_TTL,
+                'payload': payload,
+            })
+    return payload
+
+
+def forget_tracked_twitter_tl_users():
+    """Bump the tracked users version so the list is read again"""
+    with _tracked_users_lock:
+        _tracked_users_cache['version'] += 1
+
+
 def begin_tracking_twitter_user(username):
     """
     Add a twitter user to be tracked to the databse
@@ -134,145 +388,576 @@ def begin_tracking_twitter_user(username):
     username -- Twitter username/screen_name to be added. For example to add
     username '@NASA' to be polled: add_tracked_twitter_tl_user('NASA')
     """
-    new_user = twitter_models.PolledTimelineUsers(user_name=username)
+    begin_tracking_twitter_users([username])
+
+
+def begin_tracking_twitter_users(usernames):
+    """
+    Add twitter users to be tracked with a single statement and return the
+    ones that weren't already tracked, in the order they were given
+
+    Arguments:
+    usernames -- List of Twitter usernames/screen_names to be added
+    """
+    if not usernames:
+        return []
     with GetDBSession() as db_session:
-        db_session.add(new_user)
+        # Rows are locked in name order so concurrent requests can't deadlock
+        added = set(
+            user_name for (user_name,) in db_session.execute(
+                text(
+                    'INSERT INTO polled_timeline_users (user_name) '
+                    'SELECT DISTINCT user_name FROM unnest('
+                    'CAST(:user_names AS varchar[])) AS u (user_name) '
+                    'ORDER BY user_name '
+                    'ON CONFLICT (user_name) DO NOTHING RETURNING user_name'
+                ),
+                {'user_names': list(usernames)}
+            )
+        )
         db_session.commit()
-    eleanor_logger.debug('Adding twitter user %s to be tracked', username)
+    if added:
+        forget_tracked_twitter_tl_users()
+        eleanor_logger.debug('Adding twitter users %s to be tracked', added)
+    added_users = []
+    for username in usernames:
+        if username in added and username not in added_users:
+            added_users.append(username)
+    return added_users
 
 
-def is_twitter_user_in_interns(screen_name):
+def forget_inserted_last_tweet_ids(rows, inserted):
+    """Drops the cached last tweet ids of the users of committed tweet rows,
+    including any retweeted tweets embedded in them, that have a tweet_id in
+    inserted. A duplicate tweet doesn't change its user's last tweet id
     """
-    Checks to see if a twitter user exists within the database. Returns True
-    if the screen_name is present in the database else returns False.
+    user_names = set()
+    for row in rows:
+        while row is not None:
+            if row['tweet_id'] in inserted:
+                user_names.add(row['user_name'])
+            row = row['retweet_source_row']
+    forget_last_tweet_ids(user_names)
 
-    For example checking to see if the user '@NASA' exists within the database
-    the method would be called like so: is_twitter_user_in_interns('NASA')
+
+def forget_last_tweet_ids(user_names):
+    """Drops the cached last tweet id of each of user_names"""
+    last_tweet_id_cache = cache.get_caches()['last_tweet_ids']
+    for user_name in user_names:
+        last_tweet_id_cache.delete(user_name)
+
+
+def last_twitter_user_entry_id(screen_name):
+    """
+    Returns the latest tweet id assocaited with screen_name otherwise returns
+    None.
 
     Arguments:
     screen_name -- Twitter user_name/screen_name to check for.
     """
-    screen_names = []
-    with GetDBSession() as db_session:
-        distinct_screen_names = db_session.query(
-            distinct(twitter_models.TwitterSource.tweeter_user_name)
-        )
-    for sn in distinct_screen_names:
-        screen_names.append(sn[0])
-    is_user_tracked = screen_name in screen_names
+    last_tweet_id = last_twitter_user_entry_ids([screen_name])[screen_name]
     eleanor_logger.debug(
-        'Twitter username %s is currently being tracked by interns is: %s',
+        'Last tweet id from twitter user %s is %s',
         screen_name,
-        is_user_tracked
+        last_tweet_id
     )
-    return screen_name in screen_names
+    return last_tweet_id
 
 
-def last_twitter_user_entry_id(screen_name):
+def last_twitter_user_entry_ids(screen_names):
     """
-    Returns the latest tweet id assocaited with screen_name otherwise returns
-    None.
+    Returns a dict of each screen_name to the latest tweet id associated with
+    it, or None if there are no tweets from that screen_name.
 
     Arguments:
-    screen_name -- Twitter user_name/screen_name to check for.
+    screen_names -- List of Twitter user_names/screen_names to check for.
     """
+    last_tweet_id_cache = cache.get_caches()['last_tweet_ids']
+    last_tweet_ids = dict(
+        (screen_name, last_tweet_id_cache.get(screen_name))
+        for screen_name in screen_names
+    )
+    uncached = [
+        screen_name for screen_name, last_tweet_id in last_tweet_ids.items()
+        if last_tweet_id is None
+    ]
+    if not uncached:
+        return last_tweet_ids
     with GetDBSession() as db_session:
-        if is_twitter_user_in_interns(screen_name):
-            # Check to make sure it's not a retweet
-            # change this to filter against if retweet
-            query = db_session.query(
-                twitter_models.TwitterSource.tweet_id
-            ).filter_by(
-                tweeter_user_name=screen_name
-            ).order_by(
-                desc(twitter_models.TwitterSource.tweet_id)
-            ).first().tweet_id
-
-            eleanor_logger.debug(
-                'Last tweet id from twitter user %s is %s',
-                screen_name,
-                query
-            )
-            return query
-        else:
-            return None
+        query = db_session.query(
+            twitter_models.UserLastTweet.tweeter_user_name,
+            twitter_models.UserLastTweet.last_tweet_id
+        ).filter(
+            twitter_models.UserLastTweet.tweeter_user_name.in_(uncached)
+        )
+        for screen_name, last_tweet_id in query:
+            last_tweet_ids[screen_name] = last_tweet_id
+            last_tweet_id_cache.set(screen_name, last_tweet_id)
+    return last_tweet_ids
 
 
-def add_urls(tweet_data, tweetModel):
-    """Add urls to tweetModel"""
-    urls = tweet_data['tweet_urls']
-    if urls:
-        for url in urls:
-            tweetURL = twitter_models.TweetURLs(
-                url=url
-            )
-            tweetModel.urls.append(tweetURL)
+TWEET_INSERTED = 'inserted'
+TWEET_DUPLICATE = 'duplicate'
+TWEET_ERROR = 'error'
 
 
-def add_hashtags(tweet_data, tweetModel):
-    """Insert hashtags"""
-    hashtags = tweet_data['hashtags']
-    if hashtags:
-        for hashtag in hashtags:
-            tweetHashtag = twitter_models.TweetHashtags(
-                hashtag=hashtag
-            )
-            tweetModel.hashtags.append(tweetHashtag)
+def get_tweet_row(tweet_data):
+    """Takes a JSON tweet payload and returns a flat dict of the values needed
+    to insert it, raises payloads.InvalidTweetPayload on a bad payload
+    """
+    tweet = payloads.decode_tweet_payload(tweet_data)
+    return get_tweet_row_from_payload(tweet)
+
+
+def get_tweet_row_from_payload(tweet):
+    """Builds the row for a payload decoded by payloads.decode_tweet_payload"""
+    row = {
+        'tweet_id': tweet['tweet_id'],
+        'user_name': tweet['user_name'],
+        'url': tweet['url'],
+        'time_posted': tweet['tweet_created'],
+        'is_retweet': tweet['is_retweet'],
+        'retweet_source_tweet_id': None,
+        'retweet_source_row': None,
+    }
+    if tweet['is_retweet']:
+        # Retweets are stored as a pointer to the original tweet
+        row['retweet_source_row'] = get_tweet_row_from_payload(
+            tweet['retweet_data']
+        )
+        row['retweet_source_tweet_id'] = row['retweet_source_row']['tweet_id']
+        row['tweet_text'] = ''
+        row['user_mentions'] = []
+        row['hashtags'] = []
+        row['tweet_urls'] = []
+    else:
+        for key in ('tweet_text', 'user_mentions', 'hashtags', 'tweet_urls'):
+            row[key] = tweet[key]
+    return row
+
+
+def get_twitter_source_ids(tweet_ids, session):
+    """Returns a dict of tweet_id to twitter_source id for every tweet_id in
+    tweet_ids that is already in the database
+    """
+    if not tweet_ids:
+        return {}
+    source_table = twitter_models.TwitterSource.__table__
+    existing = session.execute(
+        source_table.select().with_only_columns(
+            [source_table.c.tweet_id, source_table.c.id]
+        ).where(
+            source_table.c.tweet_id.in_(list(tweet_ids))
+        )
+    )
+    return dict((tweet_id, source_id) for tweet_id, source_id in existing)
+
+
+# A child collection of a tweet. Values are interned in dictionary_model and
+# model associates them with a tweet through id_column. rollup_model counts
+# uses of each value per user per day
+TweetChildTable = namedtuple('TweetChildTable', [
+    'model', 'row_key', 'id_column', 'dictionary_model', 'column',
+    'rollup_model'
+])
 
+TWEET_CHILD_TABLES = (
+    TweetChildTable(
+        twitter_models.TweetUserMentions, 'user_mentions',
+        'mentioned_user_id', twitter_models.MentionedUsers, 'user_name',
+        twitter_models.UserDailyUserMentions
+    ),
+    TweetChildTable(
+        twitter_models.TweetHashtags, 'hashtags', 'hashtag_id',
+        twitter_models.Hashtags, 'hashtag', twitter_models.UserDailyHashtags
+    ),
+    TweetChildTable(
+        twitter_models.TweetURLs, 'tweet_urls', 'url_id',
+        twitter_models.URLs, 'url', twitter_models.UserDailyURLs
+    ),
+)
 
-def add_user_mentions(tweet_data, tweetModel):
-    """Insert user mentions"""
-    user_mentions = tweet_data['user_mentions']
-    if user_mentions:
-        for mention in user_mentions:
-            userMention = twitter_models.TweetUserMentions(
-                user_name=mention
+DICTIONARY_CACHE_SIZE = 100000
+_dictionary_id_caches = dict(
+    (child_table.dictionary_model, LRUCache(DICTIONARY_CACHE_SIZE))
+    for child_table in TWEET_CHILD_TABLES
+)
+
+
+@event.listens_for(EleanorSession, 'after_commit')
+def cache_committed_dictionary_ids(session):
+    """Caches the dictionary ids a session looked up or inserted once they are
+    committed, so ids from a rolled back transaction are never cached
+    """
+    pending = session.info.pop('pending_dictionary_ids', {})
+    for dictionary_model, value_ids in pending.items():
+        cache = _dictionary_id_caches[dictionary_model]
+        for value, value_id in value_ids.items():
+            cache.set(value, value_id)
+
+
+@event.listens_for(EleanorSession, 'after_rollback')
+def discard_dictionary_ids(session):
+    """Drops dictionary ids looked up by a transaction that rolled back"""
+    session.info.pop('pending_dictionary_ids', None)
+
+
+def get_dictionary_ids(dictionary_model, column, values, session):
+    """Returns a dict of each of values to its id in dictionary_model, adding
+    any values that are not in dictionary_model yet. Ids are served from an in
+    process LRU cache where possible and otherwise resolved in bulk.
+
+    Keyword arguments:
+    dictionary_model -- one of the dictionary models in TWEET_CHILD_TABLES
+    column -- name of the value column in dictionary_model
+    values -- iterable of values to look up
+    session -- active db session
+    """
+    cache = _dictionary_id_caches[dictionary_model]
+    value_ids = {}
+    missing = set()
+    for value in values:
+        value_id = cache.get(value)
+        if value_id is None:
+            missing.add(value)
+        else:
+            value_ids[value] = value_id
+    if not missing:
+        return value_ids
+
+    select_query = text(
+        'SELECT {column}, id FROM {table} '
+        'WHERE {column} = ANY(CAST(:values AS varchar[]))'.format(
+            table=dictionary_model.__tablename__, column=column
+        )
+    )
+    # Only values that aren't stored yet are inserted so existing values don't
+    # use up ids from the sequence
+    insert_query = text(
+        'INSERT INTO {table} ({column}) '
+        'SELECT unnest(CAST(:values AS varchar[])) '
+        'ON CONFLICT ({column}) DO NOTHING '
+        'RETURNING {column}, id'.format(
+            table=dictionary_model.__tablename__, column=column
+        )
+    )
+    found = {}
+    for query in (select_query, insert_query, select_query):
+        if not missing:
+            break
+        # Sorted so concurrent writers insert in the same order
+        found.update(session.execute(query, {'values': sorted(missing)}))
+        missing.difference_update(found)
+    if missing:
+        raise ValueError(
+            'Unable to resolve {0} values {1!r}'.format(
+                dictionary_model.__tablename__, sorted(missing)
             )
-            tweetModel.mentions.append(userMention)
+        )
+    session.info.setdefault(
+        'pending_dictionary_ids', {}
+    ).setdefault(dictionary_model, {}).update(found)
+    value_ids.update(found)
+    return value_ids
 
 
-def insert_retweet_data(retweet_data):
-    """Inserts retweet data"""
-    insert_tweet_data(retweet_data['retweet_data'])
-    with GetDBSession() as db_session:
-        retweet_id = int(retweet_data['retweet_data']['tweet_id'])
-        retweetSource = db_session.query(
-            twitter_models.TwitterSource
-        ).filter(
-            twitter_models.TwitterSource.tweet_id == retweet_id
-        ).first()
-
-        tweetTextModel = insert_text_data(
-            models.AllowedSources.twitter.name,
-            retweet_data['url'],
-            '',
-            retweet_data['tweet_created'],
-            db_session
+def update_daily_rollup(rollup_model, column, rows, row_key, session):
+    """Adds the values under row_key in each tweet row to the per user daily
+    counts in rollup_model
+
+    Keyword arguments:
+    rollup_model -- one of the daily rollup models in TWEET_CHILD_TABLES
+    column -- name of the value column in rollup_model
+    rows -- list of newly inserted tweet rows
+    row_key -- key of the list of values in each tweet row
+    session -- active db session
+    """
+    user_names, days, values = [], [], []
+    for row in rows:
+        for value in row[row_key]:
+            user_names.append(row['user_name'])
+            days.append(row['time_posted'].date())
+            values.append(value)
+    # Rows are locked in key order so concurrent writers can't deadlock
+    session.execute(
+        text(
+            'INSERT INTO {table} (tweeter_user_name, day, {column}, '
+            'tweet_count) '
+            'SELECT user_name, day, value, count(*) FROM unnest('
+            'CAST(:user_names AS varchar[]), CAST(:days AS date[]), '
+            'CAST(:values AS varchar[])) AS t (user_name, day, value) '
+            'GROUP BY user_name, day, value '
+            'ORDER BY user_name, day, value '
+            'ON CONFLICT (tweeter_user_name, day, {column}) DO UPDATE '
+            'SET tweet_count = {table}.tweet_count + EXCLUDED.tweet_count'
+            .format(table=rollup_model.__tablename__, column=column)
+        ),
+        {'user_names': user_names, 'days': days, 'values': values}
+    )
+
+
+def bulk_insert_tweet_rows(rows, session):
+    """Inserts the given tweet rows, as returned by get_tweet_row, with one
+    multi-row statement per table and returns a dict of tweet_id to the new
+    twitter_source id. Rows that are retweets must have retweet_source_id set.
+    Rows whose tweet_id is already in the database are skipped and left out of
+    the returned dict.
+
+    Keyword arguments:
+    rows -- list of tweet rows that are not yet in the database
+    session -- active db session
+    """
+    if not rows:
+        return {}
+    # Reserve the text_source ids up front so the twitter_source rows can
+    # reference them without relying on the order of a RETURNING clause
+    text_source_ids = [
+        text_source_id for (text_source_id,) in session.execute(
+            text(
+                "SELECT nextval('text_source_id_seq') "
+                "FROM generate_series(1, :count)"
+            ),
+            {'count': len(rows)}
         )
+    ]
+    session.execute(
+        models.TextSource.__table__.insert(),
+        [
+            {
+                'id': text_source_id,
+                'source_key': models.AllowedSources.twitter.name,
+                'source_url': row['url'],
+                'written_text': row['tweet_text'],
+                'time_posted': row['time_posted']
+            }
+            for text_source_id, row in zip(text_source_ids, rows)
+        ]
+    )
+
+    # Tweets that another writer committed since the caller checked for
+    # duplicates are skipped by the unique tweet_id rather than failing the
+    # whole transaction
+    inserted = session.execute(
+        text(
+            'INSERT INTO twitter_source '
+            '(text_source_id, retweet_source_id, tweeter_user_name, '
+            'tweet_id, is_retweet) '
+            'SELECT * FROM unnest('
+            'CAST(:text_source_ids AS integer[]), '
+            'CAST(:retweet_source_ids AS integer[]), '
+            'CAST(:user_names AS varchar[]), '
+            'CAST(:tweet_ids AS bigint[]), '
+            'CAST(:is_retweets AS boolean[])) '
+            'ON CONFLICT (tweet_id) DO NOTHING '
+            'RETURNING tweet_id, id'
+        ),
+        {
+            'text_source_ids': text_source_ids,
+            'retweet_source_ids': [
+                row.get('retweet_source_id') for row in rows
+            ],
+            'user_names': [row['user_name'] for row in rows],
+            'tweet_ids': [row['tweet_id'] for row in rows],
+            'is_retweets': [row['is_retweet'] for row in rows]
+        }
+    )
+    source_ids = dict(
+        (tweet_id, source_id) for tweet_id, source_id in inserted
+    )
+
+    skipped_text_source_ids = [
+        text_source_id for text_source_id, row in zip(text_source_ids, rows)
+        if row['tweet_id'] not in source_ids
+    ]
+    if skipped_text_source_ids:
+        text_table = models.TextSource.__table__
+        session.execute(
+            text_table.delete().where(
+                text_table.c.id.in_(skipped_text_source_ids)
+            )
+        )
+        rows = [row for row in rows if row['tweet_id'] in source_ids]
+
+    # Rows are locked in username order so concurrent writers can't deadlock
+    session.execute(
+        text(
+            'INSERT INTO user_last_tweet (tweeter_user_name, last_tweet_id) '
+            'SELECT user_name, max(tweet_id) '
+            'FROM unnest(CAST(:user_names AS varchar[]), '
+            'CAST(:tweet_ids AS bigint[])) AS t (user_name, tweet_id) '
+            'GROUP BY user_name ORDER BY user_name '
+            'ON CONFLICT (tweeter_user_name) DO UPDATE '
+            'SET last_tweet_id = GREATEST('
+            'user_last_tweet.last_tweet_id, EXCLUDED.last_tweet_id)'
+        ),
+        {
+            'user_names': [row['user_name'] for row in rows],
+            'tweet_ids': [row['tweet_id'] for row in rows]
+        }
+    )
 
-        tweetModel = twitter_models.TwitterSource(
-            retweet_source_id=retweetSource.id,
-            tweeter_user_name=retweet_data['user_name'],
-            tweet_id=retweet_data['tweet_id'],
-            is_retweet=True
+    for child_table in TWEET_CHILD_TABLES:
+        values = set(
+            value for row in rows for value in row[child_table.row_key]
         )
-        tweetTextModel.twitter_source = tweetModel
-        try:
+        if not values:
+            continue
+        value_ids = get_dictionary_ids(
+            child_table.dictionary_model, child_table.column, values, session
+        )
+        session.execute(
+            child_table.model.__table__.insert(),
+            [
+                {
+                    'twitter_source_id': source_ids[row['tweet_id']],
+                    child_table.id_column: value_ids[value]
+                }
+                for row in rows for value in row[child_table.row_key]
+            ]
+        )
+        update_daily_rollup(
+            child_table.rollup_model, child_table.column, rows,
+            child_table.row_key, session
+        )
+    return source_ids
+
+
+TWEET_JSON_BACKFILL_BATCH_SIZE = 1000
+
+
+def store_tweet_json(tweet_ids, session):
+    """Serializes the stored tweets with the given tweet_ids, as read back
+    from the database, and saves the JSON in the tweet_json table. Tweets
+    that already have JSON saved are left alone. Returns the number saved.
+
+    Keyword arguments:
+    tweet_ids -- iterable of tweet_ids already written in session
+    session -- active db session
+    """
+    tweet_ids = sorted(tweet_ids)
+    if not tweet_ids:
+        return 0
+    rows = session.execute(
+        text(
+            TWEET_DATA_QUERY +
+            'WHERE ts.tweet_id = ANY(CAST(:tweet_ids AS bigint[]))'
+        ),
+        {'tweet_ids': tweet_ids}
+    )
+    stored_ids, tweet_jsons = [], []
+    for row in rows:
+        stored_ids.append(row.tweet_id)
+        tweet_jsons.append(serialize_tweet_data(get_tweet_data_from_row(row)))
+    if not stored_ids:
+        return 0
+    saved = session.execute(
+        text(
+            'INSERT INTO tweet_json (tweet_id, payload) '
+            'SELECT * FROM unnest('
+            'CAST(:tweet_ids AS bigint[]), CAST(:payloads AS text[])) '
+            'ON CONFLICT (tweet_id) DO NOTHING'
+        ),
+        {'tweet_ids': stored_ids, 'payloads': tweet_jsons}
+    )
+    return saved.rowcount
+
+
+def backfill_tweet_json(batch_size=TWEET_JSON_BACKFILL_BATCH_SIZE,
+                        progress=None):
+    """Saves the serialized JSON of every stored tweet that doesn't have it
+    yet, committing every batch_size tweets so it can be stopped and rerun.
+    progress, if given, is called with the running total after each batch.
+    Returns the number of tweets saved
+    """
+    query = text(
+        'SELECT ts.tweet_id FROM twitter_source ts '
+        'WHERE ts.tweet_id > :after AND NOT EXISTS ('
+        'SELECT 1 FROM tweet_json j WHERE j.tweet_id = ts.tweet_id) '
+        'ORDER BY ts.tweet_id LIMIT :batch_size'
+    )
+    total = 0
+    after = -1
+    while True:
+        with GetDBSession() as db_session:
+            tweet_ids = [
+                tweet_id for (tweet_id,) in db_session.execute(
+                    query, {'after': after, 'batch_size': batch_size}
+                )
+            ]
+            if not tweet_ids:
+                return total
+            total += store_tweet_json(tweet_ids, db_session)
             db_session.commit()
-        except IntegrityError as e:
-            if 'duplicate key value' in e.message:
+        after = tweet_ids[-1]
+        if progress is not None:
+            progress(total)
+
+
+def write_tweet_rows(rows, session):
+    """Inserts tweet rows, as returned by get_tweet_row, along with any
+    retweeted tweets embedded in them and returns the set of tweet_ids that
+    were newly inserted. Retweet chains are written originals first so every
+    retweet can reference its source inside the same transaction.
+
+    Keyword arguments:
+    rows -- list of tweet rows
+    session -- active db session
+    """
+    # Group every tweet by how many retweets deep its original is, so each
+    # level only depends on tweets written by an earlier level
+    levels = {}
+    for row in rows:
+        chain = []
+        while row is not None:
+            chain.append(row)
+            row = row['retweet_source_row']
+        for depth, chain_row in enumerate(reversed(chain)):
+            levels.setdefault(depth, OrderedDict()).setdefault(
+                chain_row['tweet_id'], chain_row
+            )
+
+    all_tweet_ids = set()
+    for level in levels.values():
+        all_tweet_ids.update(level)
+    source_ids = get_twitter_source_ids(all_tweet_ids, session)
+    inserted = set()
+    for depth in sorted(levels):
+        new_rows = []
+        for tweet_id, row in levels[depth].items():
+            if tweet_id in source_ids:
+                continue
+            if row['is_retweet']:
+                row['retweet_source_id'] = source_ids[
+                    row['retweet_source_tweet_id']
+                ]
+            new_rows.append(row)
+        new_source_ids = bulk_insert_tweet_rows(new_rows, session)
+        inserted.update(new_source_ids)
+        source_ids.update(new_source_ids)
+        # Pick up tweets a concurrent writer committed after the first check
+        source_ids.update(get_twitter_source_ids(
+            set(levels[depth]) - set(source_ids), session
+        ))
+    store_tweet_json(inserted, session)
+    return inserted
+
+
+def insert_tweet_data(tweet_data):
+    """Takes a given JSON payload and inserts it, along with the original
+    tweet if it is a retweet, in a single transaction
+    """
+    eleanor_logger.debug('Inserting tweet data')
+    row = get_tweet_row(tweet_data)
+    with GetDBSession() as db_session:
+        try:
+            inserted = write_tweet_rows([row], db_session)
+            if row['tweet_id'] not in inserted:
                 # We've already captured this so, moving on
                 eleanor_logger.info(
                     'Duplicate tweet is already in the database, skipping'
                 )
-            else:
-                eleanor_logger.critical(
-                    (
-                        'A database error occurred while attempting to '
-                        'insert tweet %s'
-                    ),
-                    e
-                )
+            db_session.commit()
+            forget_inserted_last_tweet_ids([row], inserted)
         except Exception as e:
             # Something real bad happened
             eleanor_logger.critical(
@@ -284,72 +969,101 @@ def insert_retweet_data(retweet_data):
             )
 
 
-def insert_non_retweet_data(tweet_data):
-    """Takes the passed in JSON tweet_data and inserts into the database"""
-    eleanor_logger.debug('Inserting tweet data')
+def insert_tweet_rows(rows):
+    """Inserts tweet rows, as returned by get_tweet_row, in a single
+    transaction and returns the set of tweet_ids that were newly inserted.
+    Database errors are logged and re-raised after rolling back.
+    """
+    eleanor_logger.debug('Inserting batch of %s tweets', len(rows))
     with GetDBSession() as db_session:
-        tweetTextModel = insert_text_data(
-            models.AllowedSources.twitter.name,
-            tweet_data['url'],
-            tweet_data['tweet_text'],
-            date_parse(tweet_data['tweet_created']),
-            db_session
-        )
-
-        tweetModel = twitter_models.TwitterSource(
-            tweeter_user_name=tweet_data['user_name'],
-            tweet_id=tweet_data['tweet_id'],
-            is_retweet=False
-        )
-        tweetTextModel.twitter_source = tweetModel
-
-        add_user_mentions(tweet_data, tweetModel)
-        add_hashtags(tweet_data, tweetModel)
-        add_urls(tweet_data, tweetModel)
-
         try:
+            inserted = write_tweet_rows(rows, db_session)
             db_session.commit()
-        except IntegrityError as e:
-            if 'duplicate key value' in e.message:
-                # We've already captured this so, moving on
-                eleanor_logger.info(
-                    'Duplicate tweet is already in the database, skipping'
-                )
-            else:
-                eleanor_logger.critical(
-                    (
-                        'A database error occurred while attempting '
-                        'to insert tweet %s'
-                    ),
-                    e
-                )
         except Exception as e:
-            # Something real bad happened
             eleanor_logger.critical(
                 (
-                    'An error has occurred while inserting a tweet into '
-                    'the database %s'
+                    'An error has occurred while inserting a batch of tweets '
+                    'into the database %s'
                 ),
                 e
             )
+            db_session.rollback()
+            raise
+    forget_inserted_last_tweet_ids(rows, inserted)
+    return inserted
 
 
-def insert_tweet_data(tweet_data):
-    """Takes a given JSON payload and depending on if a retweet inserts
-    appropriately
+def insert_tweet_data_batch(tweets):
+    """Takes a list of JSON tweet payloads and inserts them in a single
+    transaction using a few multi-row statements. Returns a list with a result
+    dict for each payload in the same order as tweets, with a status of
+    inserted, duplicate or error
     """
-    if not isinstance(tweet_data, dict):
-        tweet_data = json.loads(tweet_data)
-    if tweet_data['is_retweet']:
-        insert_retweet_data(tweet_data)
-    else:
-        insert_non_retweet_data(tweet_data)
+    results = []
+    rows = []
+    for tweet_data in tweets:
+        try:
+            row = get_tweet_row(tweet_data)
+        except (KeyError, TypeError, ValueError) as e:
+            results.append({
+                'tweet_id': None,
+                'status': TWEET_ERROR,
+                'error': 'Invalid tweet payload: {0!r}'.format(e)
+            })
+            continue
+        results.append({'tweet_id': row['tweet_id'], 'status': None})
+        rows.append(row)
+
+    try:
+        inserted = insert_tweet_rows(rows)
+    except Exception:
+        for result in results:
+            if result['status'] is None:
+                result['status'] = TWEET_ERROR
+                result['error'] = 'Database error'
+        return results
+
+    reported = set()
+    for result in results:
+        if result['status'] is not None:
+            continue
+        tweet_id = result['tweet_id']
+        if tweet_id in inserted and tweet_id not in reported:
+            result['status'] = TWEET_INSERTED
+        else:
+            result['status'] = TWEET_DUPLICATE
+        reported.add(tweet_id)
+    return results
+
 
+SEARCH_MATCH_SUBSTRING = 'substring'
+SEARCH_MATCH_TOKEN = 'token'
 
-def search_count_of_user_tweets_on_day(username, date, search_term):
+
+def get_search_filter(search_term, match=SEARCH_MATCH_SUBSTRING):
+    """Returns a filter on TextSource.written_text for search_term. Substring
+    matching finds search_term anywhere in the text while token matching finds
+    tweets containing the words of search_term after stemming, both are
+    backed by an index on written_text
+    """
+    if match == SEARCH_MATCH_TOKEN:
+        return func.to_tsvector(
+            models.TEXT_SEARCH_CONFIG, models.TextSource.written_text
+        ).op('@@')(
+            func.plainto_tsquery(models.TEXT_SEARCH_CONFIG, search_term)
+        )
+    elif match == SEARCH_MATCH_SUBSTRING:
+        return models.TextSource.written_text.contains(search_term)
+    raise ValueError('Unknown search match type {0}'.format(match))
+
+
+def search_count_of_user_tweets_on_day(username, date, search_term,
+                                       match=SEARCH_MATCH_SUBSTRING):
     """When given a username, datetime, and search_term return the number of
-    times search term was tweeted by username on the day of datetime"""
+    times search term was tweeted by username on the day of datetime. match is
+    either 'substring' or 'token'"""
     return_data = {}
+    search_filter = get_search_filter(search_term, match)
     date = date_parse(date)
     start = datetime(year=date.year, month=date.month, day=date.day)
     end = start + timedelta(days=1)
@@ -366,7 +1080,7 @@ def search_count_of_user_tweets_on_day(username, date, search_term):
                         models.TextSource.time_posted > start,
                         models.TextSource.time_posted < end
                     ),
-                    models.TextSource.written_text.contains(search_term)
+                    search_filter
                 )
             )
 
@@ -375,3 +1089,175 @@ def search_count_of_user_tweets_on_day(username, date, search_term):
             'date': start.strftime('%Y-%m-%d')
         }
     return return_data
+
+
+# Buckets for tweet counts mapped to the timedelta between buckets. The names
+# match the postgres date_trunc field names
+TWEET_COUNT_BUCKETS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+}
+MAX_TWEET_COUNT_BUCKETS = 10000
+
+
+def truncate_datetime(dt, bucket):
+    """Truncates dt to the start of its bucket the same way postgres
+    date_trunc does, weeks start on Monday
+    """
+    dt = dt.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    if bucket in ('day', 'week'):
+        dt = dt.replace(hour=0)
+    if bucket == 'week':
+        dt -= timedelta(days=dt.weekday())
+    return dt
+
+
+def count_user_tweets_by_bucket(usernames, start, end, bucket, search_terms,
+                                match=SEARCH_MATCH_SUBSTRING):
+    """Counts the tweets from each of usernames that match each search term,
+    grouped into hour, day or week buckets between start (inclusive) and end
+    (exclusive). All counts come from a single query and are returned as a
+    dense series with a zero count for empty buckets, for example:
+
+    {'NASA': [
+        {'bucket': '2016-07-21T00:00:00', 'counts': {'mars': 2, 'moon': 0}},
+        ...
+    ]}
+
+    start and end are compared in UTC, and naive datetimes are taken to be
+    in UTC.
+
+    Arguments:
+    usernames -- List of Twitter user_names/screen_names
+    start -- datetime or datetime string for the start of the range
+    end -- datetime or datetime string for the end of the range
+    bucket -- one of 'hour', 'day' or 'week'
+    search_terms -- List of terms to count
+    match -- either 'substring' or 'token'
+    """
+    if bucket not in TWEET_COUNT_BUCKETS:
+        raise ValueError('Unknown bucket {0}'.format(bucket))
+    if not isinstance(start, datetime):
+        start = date_parse(start)
+    if not isinstance(end, datetime):
+        end = date_parse(end)
+    start = payloads.to_naive_utc(start)
+    end = payloads.to_naive_utc(end)
+    search_terms = list(OrderedDict.fromkeys(search_terms))
+    if not usernames or not search_terms:
+        raise ValueError('usernames and search_terms must not be empty')
+
+    buckets = []
+    bucket_start = truncate_datetime(start, bucket)
+    while bucket_start < end:
+        buckets.append(bucket_start)
+        bucket_start += TWEET_COUNT_BUCKETS[bucket]
+        if len(buckets) > MAX_TWEET_COUNT_BUCKETS:
+            raise ValueError('Too many buckets for the date range')
+
+    search_filters = [
+        get_search_filter(search_term, match) for search_term in search_terms
+    ]
+    bucket_column = func.date_trunc(
+        bucket, models.TextSource.time_posted
+    ).label('bucket')
+    term_columns = [
+        func.count().filter(search_filter).label('term_{0}'.format(index))
+        for index, search_filter in enumerate(search_filters)
+    ]
+
+    counts = {}
+    with GetDBSession() as db_session:
+        query = db_session.query(
+            twitter_models.TwitterSource.tweeter_user_name,
+            bucket_column,
+            *term_columns
+        ).join(
+            twitter_models.TwitterSource.text_source
+        ).filter(
+            and_(
+                twitter_models.TwitterSource.tweeter_user_name.in_(
+                    list(usernames)
+                ),
+                models.TextSource.time_posted >= start,
+                models.TextSource.time_posted < end,
+                or_(*search_filters)
+            )
+        ).group_by(
+            twitter_models.TwitterSource.tweeter_user_name,
+            bucket_column
+        )
+        for row in query:
+            counts[(row[0], row[1])] = row[2:]
+
+    return_data = {}
+    for username in usernames:
+        series = []
+        for bucket_start in buckets:
+            term_counts = counts.get(
+                (username, bucket_start), [0] * len(search_terms)
+            )
+            series.append({
+                'bucket': bucket_start.strftime('%Y-%m-%dT%H:%M:%S'),
+                'counts': dict(zip(search_terms, term_counts))
+            })
+        return_data[username] = series
+    return return_data
+
+
+# Daily rollups that can be queried for top values, mapped to the rollup model
+# and the name of its value column
+DAILY_ROLLUPS = dict(
+    (child_table.row_key, (child_table.rollup_model, child_table.column))
+    for child_table in TWEET_CHILD_TABLES
+)
+MAX_TOP_ROLLUP_VALUES = 1000
+
+
+def get_top_user_rollup_values(rollup, username, start_date, end_date,
+                               limit=10):
+    """Returns the values most used by username between start_date and
+    end_date, both inclusive, from a daily rollup as a list of dicts sorted by
+    count, for example:
+
+    [{'hashtag': 'space', 'count': 12}, ...]
+
+    Arguments:
+    rollup -- one of 'hashtags', 'user_mentions' or 'tweet_urls'
+    username -- Twitter user_name/screen_name
+    start_date -- date or date string of the first day to include
+    end_date -- date or date string of the last day to include
+    limit -- maximum number of values to return, at most MAX_TOP_ROLLUP_VALUES
+    """
+    if rollup not in DAILY_ROLLUPS:
+        raise ValueError('Unknown rollup {0}'.format(rollup))
+    limit = int(limit)
+    if not 0 < limit <= MAX_TOP_ROLLUP_VALUES:
+        raise ValueError('limit must be between 1 and {0}'.format(
+            MAX_TOP_ROLLUP_VALUES
+        ))
+    rollup_model, column = DAILY_ROLLUPS[rollup]
+    if not isinstance(start_date, date):
+        start_date = date_parse(start_date).date()
+    if not isinstance(end_date, date):
+        end_date = date_parse(end_date).date()
+    value_column = getattr(rollup_model, column)
+    count_column = func.sum(rollup_model.tweet_count).label('count')
+    with GetDBSession() as db_session:
+        query = db_session.query(
+            value_column, count_column
+        ).filter(
+            and_(
+                rollup_model.tweeter_user_name == username,
+                rollup_model.day >= start_date,
+                rollup_model.day <= end_date
+            )
+        ).group_by(
+            value_column
+        ).order_by(
+            desc(count_column), value_column
+        ).limit(limit)
+        return [
+            {column: value, 'count': int(count)} for value, count in query
+        ]
@@ -0,0 +1,268 @@
+"""Write-behind queue for tweet ingest. When enabled /add-tweet-data only
+validates a tweet and queues it, and background writer threads insert the
+queued tweets in micro-batches
+"""
+import os
+import threading
+import time
+import Queue
+
+from sqlalchemy import exc
+
+from eleanor.utils import eleanor_logger, ForkSafeLock
+from eleanor.clients.postgres import client
+from eleanor.clients.postgres import utils as pg_utils
+
+
+# Settings that can be overridden in an [Ingest] section of the eleanor cfg
+# file. ingest_flush_interval is the most seconds a queued tweet waits for a
+# batch to fill before it is written. A batch the database rejects is retried
+# ingest_retry_attempts times, waiting ingest_retry_backoff seconds at first
+# and doubling up to ingest_max_retry_backoff seconds
+DEFAULT_INGEST_SETTINGS = {
+    'ingest_async': 'false',
+    'ingest_queue_size': '10000',
+    'ingest_batch_size': '500',
+    'ingest_flush_interval': '1.0',
+    'ingest_writer_threads': '1',
+    'ingest_retry_attempts': '3',
+    'ingest_retry_backoff': '0.5',
+    'ingest_max_retry_backoff': '30.0',
+}
+
+# Guards creating the process wide IngestQueue and resetting it after a fork
+_ingest_queue_lock = ForkSafeLock()
+_ingest_queue = None
+_ingest_queue_loaded = False
+
+
+def get_ingest_settings():
+    """Returns the ingest settings from the eleanor cfg file"""
+    config = client.get_db_config()
+    settings = dict(DEFAULT_INGEST_SETTINGS)
+    if config.has_section('Ingest'):
+        for key in DEFAULT_INGEST_SETTINGS:
+            if config.has_option('Ingest', key):
+                settings[key] = config.get('Ingest', key)
+    return {
+        'async': (
+            settings['ingest_async'].lower() in ('1', 'true', 'yes', 'on')
+        ),
+        'queue_size': int(settings['ingest_queue_size']),
+        'batch_size': int(settings['ingest_batch_size']),
+        'flush_interval': float(settings['ingest_flush_interval']),
+        'writer_threads': int(settings['ingest_writer_threads']),
+        'retry_attempts': int(settings['ingest_retry_attempts']),
+        'retry_backoff': float(settings['ingest_retry_backoff']),
+        'max_retry_backoff': float(settings['ingest_max_retry_backoff']),
+    }
+
+
+def is_database_unavailable(error):
+    """Returns True if error means the database couldn't be reached, rather
+    than that it rejected what was written"""
+    if not isinstance(error, exc.DBAPIError):
+        return False
+    return error.connection_invalidated or isinstance(
+        error, (exc.OperationalError, exc.InterfaceError)
+    )
+
+
+class IngestQueue(object):
+    """A bounded queue of tweet rows, as returned by pg_utils.get_tweet_row,
+    drained by background writer threads. Writers are started on first use.
+    A process forked after that gets an empty queue and writers of its own.
+
+    Rows are only taken off the queue once the previous batch is written, so
+    while the database is unreachable the queue fills and put rejects rows
+    """
+
+    def __init__(self, queue_size, batch_size, flush_interval, writer_threads,
+                 retry_attempts=3, retry_backoff=0.5, max_retry_backoff=30.0):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writer_threads = writer_threads
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.reset()
+
+    def reset(self):
+        """Start over with an empty queue, zeroed counts and no writers, owned
+        by this process"""
+        self.queue = Queue.Queue(self.queue_size)
+        self.counts = {
+            'queued': 0,
+            'rejected': 0,
+            'inserted': 0,
+            'duplicate': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._writers = []
+        self._writers_pid = None
+        self._pid = os.getpid()
+
+    def start(self):
+        """Start the writer threads if they aren't running in this process"""
+        if self._pid != os.getpid():
+            # Rows queued before a fork belong to the parent's writers, and a
+            # lock held by a parent thread at the fork would never be released.
+            # Only the first thread here may reset, or a row another thread
+            # has just queued would be lost with the queue it was put on
+            with _ingest_queue_lock:
+                if self._pid != os.getpid():
+                    self.reset()
+        with self._lock:
+            if self._writers_pid == os.getpid():
+                return
+            for _ in range(self.writer_threads):
+                writer = threading.Thread(target=self.run_writer)
+                writer.daemon = True
+                writer.start()
+                self._writers.append(writer)
+            self._writers_pid = os.getpid()
+
+    def stop(self):
+        """Stop the writer threads once they finish their current batch"""
+        self._stopping.set()
+        for writer in self._writers:
+            writer.join()
+
+    def put(self, row):
+        """Queue a tweet row, returns False if the queue is full"""
+        self.start()
+        try:
+            self.queue.put_nowait(row)
+        except Queue.Full:
+            with self._lock:
+                self.counts['rejected'] += 1
+            return False
+        with self._lock:
+            self.counts['queued'] += 1
+        return True
+
+    def get_batch(self):
+        """Waits up to flush_interval for a queued row, then collects rows
+        until there are batch_size of them or flush_interval has passed
+        """
+        try:
+            rows = [self.queue.get(timeout=self.flush_interval)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.flush_interval
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self.queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return rows
+
+    def insert_rows(self, rows):
+        """Insert rows, counting how many were new, and retry with backoff if
+        that fails. Rows are retried for as long as the database is
+        unreachable, but only retry_attempts times if the database rejects
+        them. Returns False if the rows were not written
+        """
+        backoff = self.retry_backoff
+        attempts = 0
+        while True:
+            try:
+                inserted = pg_utils.insert_tweet_rows(rows)
+            except Exception as e:
+                # insert_tweet_rows has already logged the error
+                if not is_database_unavailable(e):
+                    attempts += 1
+                    if attempts >= self.retry_attempts:
+                        return False
+                with self._lock:
+                    self.counts['retried'] += len(rows)
+                if self._stopping.wait(backoff):
+                    return False
+                backoff = min(backoff * 2, self.max_retry_backoff)
+            else:
+                with self._lock:
+                    self.counts['inserted'] += len(inserted)
+                    self.counts['duplicate'] += len(rows) - len(inserted)
+                return True
+
+    def write_batch(self, rows):
+        """Insert a batch of rows. If the database keeps rejecting the batch
+        its rows are written one at a time, so only the rows it rejects are
+        dropped
+        """
+        try:
+            if self.insert_rows(rows):
+                return
+            failed_rows = rows
+            if len(rows) > 1 and not self._stopping.is_set():
+                failed_rows = [
+                    row for row in rows if not self.insert_rows([row])
+                ]
+            with self._lock:
+                self.counts['failed'] += len(failed_rows)
+            for row in failed_rows:
+                eleanor_logger.error(
+                    'Dropped queued tweet %s after it could not be written',
+                    row['tweet_id']
+                )
+        finally:
+            for _ in rows:
+                self.queue.task_done()
+
+    def run_writer(self):
+        """Writer thread loop"""
+        eleanor_logger.debug('Starting ingest writer thread')
+        while not self._stopping.is_set():
+            rows = self.get_batch()
+            if rows:
+                self.write_batch(rows)
+
+    def flush(self):
+        """Block until every queued row has been written"""
+        self.queue.join()
+
+    def status(self):
+        """Returns the queue depth, limits and running counts"""
+        with self._lock:
+            status = dict(self.counts)
+        status.update({
+            'enabled': True,
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue_size,
+            'batch_size': self.batch_size,
+            'flush_interval': self.flush_interval,
+            'writer_threads': self.writer_threads,
+        })
+        return status
+
+
+def get_ingest_queue():
+    """Returns the process wide IngestQueue, or None if asynchronous ingest is
+    not enabled in the eleanor cfg file
+    """
+    # pylint: disable=global-statement
+    global _ingest_queue, _ingest_queue_loaded
+    if _ingest_queue_loaded:
+        return _ingest_queue
+    with _ingest_queue_lock:
+        if not _ingest_queue_loaded:
+            settings = get_ingest_settings()
+            if settings['async']:
+                _ingest_queue = IngestQueue(
+                    settings['queue_size'],
+                    settings['batch_size'],
+                    settings['flush_interval'],
+                    settings['writer_threads'],
+                    settings['retry_attempts'],
+                    settings['retry_backoff'],
+                    settings['max_retry_backoff']
+                )
+            _ingest_queue_loaded = True
+    return _ingest_queue
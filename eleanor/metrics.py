@@ -0,0 +1,331 @@
+"""Request and database metrics for the eleanor service, exposed in the
+prometheus text format. Metrics are kept per process
+"""
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event
+
+from eleanor.utils import eleanor_logger
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Route label for queries run outside of a request, e.g. by ingest writers
+NO_ROUTE = 'none'
+
+
+def format_labels(labels):
+    """Formats a dict of labels in the prometheus {name="value"} format"""
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(
+            name,
+            unicode(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"')
+        ) for name, value in sorted(labels.items())
+    ) + '}'
+
+
+def format_value(value):
+    """Returns a number in the prometheus text format"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A named metric holding one value per set of label values"""
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, labels):
+        """Returns the label values in label_names order"""
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def get_samples(self):
+        """Yields (suffix, labels, value) for each sample of the metric"""
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield '', dict(zip(self.label_names, key)), value
+
+    def render(self):
+        """Returns the metric in the prometheus text format"""
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help_text),
+            '# TYPE {0} {1}'.format(self.name, self.metric_type),
+        ]
+        for suffix, labels, value in self.get_samples():
+            lines.append('{0}{1}{2} {3}'.format(
+                self.name, suffix, format_labels(labels), format_value(value)
+            ))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """A metric that only goes up"""
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the counter"""
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    """A metric that goes up and down"""
+    metric_type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        """Subtract amount from the gauge"""
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """A metric counting observed values into cumulative buckets"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=()):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """Record an observed value"""
+        key = self.get_key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0,
+                    'count': 0,
+                }
+            values = self._values[key]
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    values['buckets'][index] += 1
+            values['sum'] += value
+            values['count'] += 1
+
+    def get_samples(self):
+        """Yields the bucket, sum and count samples of each label set"""
+        with self._lock:
+            values = dict(
+                (key, dict(value, buckets=list(value['buckets'])))
+                for key, value in self._values.items()
+            )
+        for key, value in sorted(values.items()):
+            labels = dict(zip(self.label_names, key))
+            for upper_bound, count in zip(self.buckets, value['buckets']):
+                bucket_labels = dict(labels, le=format_value(upper_bound))
+                yield '_bucket', bucket_labels, count
+            yield '_sum', labels, value['sum']
+            yield '_count', labels, value['count']
+
+
+REQUEST_LATENCY = Histogram(
+    'eleanor_http_request_duration_seconds',
+    'Time taken to build each response, by route',
+    ('route', 'method'), LATENCY_BUCKETS
+)
+REQUESTS = Counter(
+    'eleanor_http_requests_total',
+    'Requests handled, by route and status code',
+    ('route', 'method', 'status')
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'eleanor_http_requests_in_flight',
+    'Requests currently being handled'
+)
+REQUEST_QUERIES = Histogram(
+    'eleanor_db_queries_per_request',
+    'Database queries run while building each response, by route',
+    ('route',), QUERY_COUNT_BUCKETS
+)
+QUERIES = Counter(
+    'eleanor_db_queries_total',
+    'Database queries run, by route',
+    ('route',)
+)
+QUERY_SECONDS = Counter(
+    'eleanor_db_query_seconds_total',
+    'Time spent running database queries, by route',
+    ('route',)
+)
+QUERY_ERRORS = Counter(
+    'eleanor_db_query_errors_total',
+    'Database queries that raised an error, by route',
+    ('route',)
+)
+POOL_CHECKED_OUT = Gauge(
+    'eleanor_db_pool_checked_out',
+    'Connections currently checked out of the pool'
+)
+POOL_CHECKOUTS = Counter(
+    'eleanor_db_pool_checkouts_total',
+    'Connections checked out of the pool'
+)
+POOL_CONNECTIONS = Counter(
+    'eleanor_db_pool_connections_total',
+    'New database connections opened by the pool'
+)
+
+METRICS = (
+    REQUEST_LATENCY, REQUESTS, REQUESTS_IN_FLIGHT, REQUEST_QUERIES, QUERIES,
+    QUERY_SECONDS, QUERY_ERRORS, POOL_CHECKED_OUT, POOL_CHECKOUTS,
+    POOL_CONNECTIONS
+)
+
+# Route, start time and query counts of the request this thread is handling
+_request_state = threading.local()
+
+
+def get_current_route():
+    """Returns the route of the request being handled by this thread"""
+    return getattr(_request_state, 'route', NO_ROUTE)
+
+
+def render_metrics():
+    """Returns every metric in the prometheus text format"""
+    return ''.join(metric.render() for metric in METRICS)
+
+
+def start_request():
+    """Flask before_request hook"""
+    _request_state.route = (
+        request.url_rule.rule if request.url_rule else 'unmatched'
+    )
+    _request_state.start = time.time()
+    _request_state.status = None
+    _request_state.queries = 0
+    REQUESTS_IN_FLIGHT.inc()
+
+
+def record_response(response):
+    """Flask after_request hook"""
+    _request_state.status = response.status_code
+    return response
+
+
+def finish_request(exception=None):
+    """Flask teardown_request hook, called even when a view raised. For
+    streamed responses this is reached once the response has been started
+    rather than when the stream ends
+    """
+    # pylint: disable=unused-argument
+    if getattr(_request_state, 'start', None) is None:
+        return
+    route = _request_state.route
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_LATENCY.observe(
+        time.time() - _request_state.start,
+        route=route, method=request.method
+    )
+    REQUESTS.inc(
+        route=route, method=request.method,
+        status=_request_state.status or 500
+    )
+    REQUEST_QUERIES.observe(_request_state.queries, route=route)
+    _request_state.start = None
+    _request_state.route = NO_ROUTE
+
+
+def init_app(web_app):
+    """Record request metrics for every request handled by web_app"""
+    web_app.before_request(start_request)
+    web_app.after_request(record_response)
+    web_app.teardown_request(finish_request)
+
+
+def instrument_engine(engine, slow_query_seconds=0):
+    """Count the queries run through engine and the time they take, logging
+    any that take longer than slow_query_seconds if it isn't 0, and track
+    connections checked out of the engine's pool. Pool checkouts are only
+    counted once any checkout listeners registered earlier, such as the pre
+    ping, have accepted the connection
+    """
+
+    def get_query_key(context, cursor):
+        """Returns the key a query's start time is kept under, its execution
+        context when it has one, which is also passed to handle_error"""
+        return id(context) if context is not None else id(cursor)
+
+    def record_query(conn, query_key, statement):
+        """Record the time since the query started, returning False if no
+        start was recorded for it"""
+        start = conn.info.get('query_start_times', {}).pop(query_key, None)
+        if start is None:
+            return False
+        seconds = time.time() - start
+        route = get_current_route()
+        QUERIES.inc(route=route)
+        QUERY_SECONDS.inc(seconds, route=route)
+        if route != NO_ROUTE:
+            _request_state.queries += 1
+        if slow_query_seconds and seconds > slow_query_seconds:
+            eleanor_logger.warning(
+                'Slow query on %s took %.3fs: %s',
+                route, seconds, statement[:1000]
+            )
+        return True
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        """Remember when the query started"""
+        # pylint: disable=unused-argument, too-many-arguments
+        conn.info.setdefault('query_start_times', {})[
+            get_query_key(context, cursor)
+        ] = time.time()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        """Record how long the query took"""
+        # pylint: disable=unused-argument, too-many-arguments
+        record_query(conn, get_query_key(context, cursor), statement)
+
+    def handle_error(exception_context):
+        """Record how long a query that raised took, so its start time isn't
+        left behind"""
+        conn = exception_context.connection
+        if conn is None:
+            return
+        query_key = get_query_key(
+            exception_context.execution_context, exception_context.cursor
+        )
+        if record_query(conn, query_key, exception_context.statement or ''):
+            QUERY_ERRORS.inc(route=get_current_route())
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        """Count a connection leaving the pool"""
+        # pylint: disable=unused-argument
+        POOL_CHECKOUTS.inc()
+        POOL_CHECKED_OUT.inc()
+
+    def checkin(dbapi_connection, connection_record):
+        """Count a connection returning to the pool"""
+        # pylint: disable=unused-argument
+        POOL_CHECKED_OUT.dec()
+
+    def connect(dbapi_connection, connection_record):
+        """Count a new connection to the database"""
+        # pylint: disable=unused-argument
+        POOL_CONNECTIONS.inc()
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
+    event.listen(engine, 'checkout', checkout)
+    event.listen(engine, 'checkin', checkin)
+    event.listen(engine, 'connect', connect)
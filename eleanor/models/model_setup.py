@@ -1,12 +1,176 @@
+import sys
+
+from sqlalchemy import inspect, text
+
 from eleanor.models import models, twitter_models
 from eleanor.models.base import Base
 from eleanor.clients.postgres import client
+from eleanor.clients.postgres.utils import TWEET_CHILD_TABLES
+
+from eleanor.utils import eleanor_logger
+
+
+# Indexes that were replaced by a model index and can be dropped
+OBSOLETE_INDEXES = (
+    'ix_twitter_source_tweeter_user_name',
+)
+
+
+def get_existing_index_names(engine):
+    """Returns the name of every index in the current schema. This is read
+    from pg_indexes because the inspector leaves out expression indexes, such
+    as the to_tsvector index on text_source
+    """
+    return set(
+        index_name for (index_name,) in engine.execute(text(
+            'SELECT indexname FROM pg_indexes '
+            'WHERE schemaname = current_schema()'
+        ))
+    )
+
+
+def create_missing_indexes(engine):
+    """Create any model indexes that are missing from tables which already
+    existed before the index was added to the model
+    """
+    existing_indexes = get_existing_index_names(engine)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                eleanor_logger.info('Creating index %s', index.name)
+                index.create(engine)
+    for index_name in OBSOLETE_INDEXES:
+        engine.execute(text('DROP INDEX IF EXISTS {0}'.format(index_name)))
+
+
+def add_tracked_users_unique_constraint(engine):
+    """Remove duplicate tracked twitter users, keeping the first row added for
+    each user_name, and add the unique constraint on user_name if the table
+    was created without it
+    """
+    inspector = inspect(engine)
+    unique_columns = [
+        constraint['column_names'] for constraint in
+        inspector.get_unique_constraints('polled_timeline_users')
+    ]
+    if ['user_name'] in unique_columns:
+        return
+    eleanor_logger.info('Adding unique constraint to polled_timeline_users')
+    with engine.begin() as connection:
+        connection.execute(text(
+            'DELETE FROM polled_timeline_users a '
+            'USING polled_timeline_users b '
+            'WHERE a.user_name = b.user_name AND a.id > b.id'
+        ))
+        connection.execute(text(
+            'ALTER TABLE polled_timeline_users '
+            'ADD CONSTRAINT polled_timeline_users_user_name_key '
+            'UNIQUE (user_name)'
+        ))
+
+
+def backfill_user_last_tweets(engine):
+    """Bring the per user last tweet id table up to date with any tweets that
+    were stored before it existed
+    """
+    eleanor_logger.info('Backfilling user_last_tweet')
+    engine.execute(
+        text(
+            'INSERT INTO user_last_tweet (tweeter_user_name, last_tweet_id) '
+            'SELECT tweeter_user_name, max(tweet_id) FROM twitter_source '
+            'WHERE tweeter_user_name IS NOT NULL '
+            'GROUP BY tweeter_user_name '
+            'ON CONFLICT (tweeter_user_name) DO UPDATE '
+            'SET last_tweet_id = GREATEST('
+            'user_last_tweet.last_tweet_id, EXCLUDED.last_tweet_id)'
+        )
+    )
+
+
+def intern_tweet_child_values(engine):
+    """Move the strings stored on each tweet hashtag, url and user mention row
+    into the matching dictionary table, replacing them with the dictionary id.
+    Tables that have already been migrated are skipped.
+    """
+    inspector = inspect(engine)
+    for child_table in TWEET_CHILD_TABLES:
+        child = child_table.model.__tablename__
+        child_columns = set(
+            column['name'] for column in inspector.get_columns(child)
+        )
+        if child_table.column not in child_columns:
+            continue
+        eleanor_logger.info('Interning %s values', child)
+        statements = (
+            'INSERT INTO {dictionary} ({column}) '
+            'SELECT DISTINCT {column} FROM {child} '
+            'WHERE {column} IS NOT NULL '
+            'ON CONFLICT ({column}) DO NOTHING',
+            'ALTER TABLE {child} ADD COLUMN {id_column} integer '
+            'REFERENCES {dictionary} (id)',
+            'UPDATE {child} c SET {id_column} = d.id FROM {dictionary} d '
+            'WHERE d.{column} = c.{column}',
+            'DELETE FROM {child} WHERE {id_column} IS NULL',
+            'ALTER TABLE {child} ALTER COLUMN {id_column} SET NOT NULL, '
+            'DROP COLUMN {column}',
+        )
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement.format(
+                    child=child,
+                    dictionary=child_table.dictionary_model.__tablename__,
+                    column=child_table.column,
+                    id_column=child_table.id_column
+                )))
+
+
+def backfill_daily_rollups(engine):
+    """Fill any empty daily rollup tables from the tweets already stored"""
+    for child_table in TWEET_CHILD_TABLES:
+        rollup = child_table.rollup_model.__tablename__
+        if engine.execute(
+                text('SELECT EXISTS (SELECT 1 FROM {0})'.format(rollup))
+        ).scalar():
+            continue
+        eleanor_logger.info('Backfilling %s', rollup)
+        engine.execute(
+            text(
+                'INSERT INTO {rollup} (tweeter_user_name, day, {column}, '
+                'tweet_count) '
+                'SELECT ts.tweeter_user_name, CAST(t.time_posted AS date), '
+                'd.{column}, count(*) FROM {child} c '
+                'JOIN {dictionary} d ON d.id = c.{id_column} '
+                'JOIN twitter_source ts ON ts.id = c.twitter_source_id '
+                'JOIN text_source t ON t.id = ts.text_source_id '
+                'WHERE ts.tweeter_user_name IS NOT NULL '
+                'GROUP BY 1, 2, 3'.format(
+                    rollup=rollup,
+                    child=child_table.model.__tablename__,
+                    dictionary=child_table.dictionary_model.__tablename__,
+                    column=child_table.column,
+                    id_column=child_table.id_column
+                )
+            )
+        )
+
+
+def setup_database(database_url=None):
+    """Create the eleanor tables and bring an existing database up to date,
+    in database_url if given instead of the database in the eleanor cfg
+    file"""
+    engine = client.get_db_engine(database_url)
 
-from eleanor.utils import get_logger
+    eleanor_logger.info('Setting up database for eleanor')
 
-engine = client.get_db_engine()
+    # Needed by the trigram index on text_source.written_text
+    engine.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    Base.metadata.create_all(engine)
+    intern_tweet_child_values(engine)
+    add_tracked_users_unique_constraint(engine)
+    create_missing_indexes(engine)
+    backfill_user_last_tweets(engine)
+    backfill_daily_rollups(engine)
 
-logger = get_logger(__name__)
-logger.info('Setting up database for eleanor')
 
-Base.metadata.create_all(engine)
+if __name__ == '__main__':
+    setup_database(*sys.argv[1:2])
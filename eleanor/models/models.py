@@ -1,12 +1,18 @@
 """Base model that all text sources should share"""
 import enum
 
-from sqlalchemy import Column, Integer, String, Text, DateTime, Enum
+from sqlalchemy import (
+    Column, Integer, String, Text, DateTime, Enum, Index, func
+)
 from sqlalchemy.orm import relationship
 
 from base import Base
 
 
+# Postgres text search configuration used to tokenize written_text
+TEXT_SEARCH_CONFIG = 'english'
+
+
 class AllowedSources(enum.Enum):
     """Enum of allowed sources for eleanor"""
     twitter = 'twitter'
@@ -24,7 +30,7 @@ class TextSource(Base):
     )
     source_url = Column(String)
     written_text = Column(Text)
-    time_posted = Column(DateTime)
+    time_posted = Column(DateTime, index=True)
 
     twitter_source = relationship(
         'TwitterSource',
@@ -32,3 +38,18 @@ class TextSource(Base):
         cascade='all, delete, delete-orphan',
         uselist=False
     )
+
+
+# Token matching uses the full text index while substring matching uses the
+# trigram index, which needs the pg_trgm extension
+Index(
+    'ix_text_source_written_text_tsvector',
+    func.to_tsvector(TEXT_SEARCH_CONFIG, TextSource.__table__.c.written_text),
+    postgresql_using='gin'
+)
+Index(
+    'ix_text_source_written_text_trgm',
+    TextSource.__table__.c.written_text,
+    postgresql_using='gin',
+    postgresql_ops={'written_text': 'gin_trgm_ops'}
+)
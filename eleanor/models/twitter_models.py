@@ -1,6 +1,6 @@
 """Models for twitter text sources"""
 from sqlalchemy import (
-    Column, Integer, String, ForeignKey, BigInteger, Boolean
+    Column, Integer, String, Text, ForeignKey, BigInteger, Boolean, Date, Index
 )
 
 from sqlalchemy.orm import relationship
@@ -43,17 +43,65 @@ class TwitterSource(Base):
     )
 
 
+# Serves both user membership checks and keyset pagination of a user's tweets
+Index(
+    'ix_twitter_source_tweeter_user_name_tweet_id',
+    TwitterSource.__table__.c.tweeter_user_name,
+    TwitterSource.__table__.c.tweet_id
+)
+
+
+class TweetJSON(Base):
+    """Model holding the serialized JSON served for each tweet, written when
+    the tweet is stored so reads don't rebuild it
+    """
+    __tablename__ = 'tweet_json'
+
+    tweet_id = Column(
+        BigInteger, ForeignKey('twitter_source.tweet_id'), primary_key=True
+    )
+    payload = Column(Text, nullable=False)
+
+
+class Hashtags(Base):
+    """Model holding each distinct hashtag once"""
+    __tablename__ = 'hashtags'
+
+    id = Column(Integer, primary_key=True)
+    hashtag = Column(String, nullable=False, unique=True)
+
+
+class URLs(Base):
+    """Model holding each distinct url once"""
+    __tablename__ = 'urls'
+
+    id = Column(Integer, primary_key=True)
+    url = Column(String, nullable=False, unique=True)
+
+
+class MentionedUsers(Base):
+    """Model holding each distinct mentioned user name once"""
+    __tablename__ = 'mentioned_users'
+
+    id = Column(Integer, primary_key=True)
+    user_name = Column(String, nullable=False, unique=True)
+
+
 class TweetHashtags(Base):
     """Model for hashtags within a tweet"""
     __tablename__ = 'tweet_hashtags'
 
     id = Column(Integer, primary_key=True)
     twitter_source_id = Column(
-        Integer, ForeignKey('twitter_source.id'), nullable=False
+        Integer, ForeignKey('twitter_source.id'), nullable=False,
+        index=True
+    )
+    hashtag_id = Column(
+        Integer, ForeignKey('hashtags.id'), nullable=False
     )
-    hashtag = Column(String)
 
     twitter_source = relationship('TwitterSource', back_populates='hashtags')
+    hashtag = relationship('Hashtags')
 
 
 class TweetURLs(Base):
@@ -62,11 +110,15 @@ class TweetURLs(Base):
 
     id = Column(Integer, primary_key=True)
     twitter_source_id = Column(
-        Integer, ForeignKey('twitter_source.id'), nullable=False
+        Integer, ForeignKey('twitter_source.id'), nullable=False,
+        index=True
+    )
+    url_id = Column(
+        Integer, ForeignKey('urls.id'), nullable=False
     )
-    url = Column(String)
 
     twitter_source = relationship('TwitterSource', back_populates='urls')
+    url = relationship('URLs')
 
 
 class TweetUserMentions(Base):
@@ -75,11 +127,15 @@ class TweetUserMentions(Base):
 
     id = Column(Integer, primary_key=True)
     twitter_source_id = Column(
-        Integer, ForeignKey('twitter_source.id'), nullable=False
+        Integer, ForeignKey('twitter_source.id'), nullable=False,
+        index=True
+    )
+    mentioned_user_id = Column(
+        Integer, ForeignKey('mentioned_users.id'), nullable=False
     )
-    user_name = Column(String)
 
     twitter_source = relationship('TwitterSource', back_populates='mentions')
+    mentioned_user = relationship('MentionedUsers')
 
 
 class PolledTimelineUsers(Base):
@@ -88,4 +144,46 @@ class PolledTimelineUsers(Base):
     __tablename__ = 'polled_timeline_users'
 
     id = Column(Integer, primary_key=True)
-    user_name = Column(String)
+    user_name = Column(String, unique=True)
+
+
+class UserLastTweet(Base):
+    """Model holding the highest tweet_id stored for each twitter user, kept up
+    to date during ingest
+    """
+    __tablename__ = 'user_last_tweet'
+
+    tweeter_user_name = Column(String, primary_key=True)
+    last_tweet_id = Column(BigInteger, nullable=False)
+
+
+class UserDailyHashtags(Base):
+    """Rollup of how many times each twitter user used a hashtag each day"""
+    __tablename__ = 'user_daily_hashtags'
+
+    tweeter_user_name = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    hashtag = Column(String, primary_key=True)
+    tweet_count = Column(Integer, nullable=False)
+
+
+class UserDailyURLs(Base):
+    """Rollup of how many times each twitter user tweeted a url each day"""
+    __tablename__ = 'user_daily_urls'
+
+    tweeter_user_name = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    url = Column(String, primary_key=True)
+    tweet_count = Column(Integer, nullable=False)
+
+
+class UserDailyUserMentions(Base):
+    """Rollup of how many times each twitter user mentioned another user each
+    day
+    """
+    __tablename__ = 'user_daily_user_mentions'
+
+    tweeter_user_name = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    user_name = Column(String, primary_key=True)
+    tweet_count = Column(Integer, nullable=False)
@@ -0,0 +1,181 @@
+"""Decoding and validation of ingested tweet payloads"""
+import json
+from datetime import datetime
+
+from dateutil.parser import parse as date_parse
+from dateutil.tz import tzutc
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+TWITTER_MONTHS = dict(
+    (month, number) for number, month in enumerate(
+        ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+         'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'),
+        1
+    )
+)
+TRUE_STRINGS = frozenset(('true', '1', 'yes'))
+FALSE_STRINGS = frozenset(('false', '0', 'no', ''))
+UTC = tzutc()
+
+
+class InvalidTweetPayload(ValueError):
+    """Raised when a tweet payload is missing a field or has a field that
+    can't be coerced to the expected type"""
+    pass
+
+
+def loads(data):
+    """Decode a JSON string, with ujson if it is installed"""
+    if ujson is not None:
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            # Let json report the error, and decode anything ujson rejects
+            # but json accepts
+            pass
+    return json.loads(data)
+
+
+def coerce_bool(value):
+    """Returns value as a bool, accepting the strings "True" and "False" as
+    sent by the pollers"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, basestring):
+        lowered = value.strip().lower()
+        if lowered in TRUE_STRINGS:
+            return True
+        if lowered in FALSE_STRINGS:
+            return False
+    elif isinstance(value, (int, long)) and value in (0, 1):
+        return bool(value)
+    raise ValueError('not a boolean')
+
+
+def coerce_id(value):
+    """Returns a tweet id sent as a number or a string of digits as an int"""
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    raise ValueError('not a tweet id')
+
+
+def coerce_string(value):
+    """Returns value if it is a string"""
+    if isinstance(value, basestring):
+        return value
+    raise ValueError('not a string')
+
+
+def coerce_string_list(value):
+    """Returns a list of strings with any nulls removed, treating null as an
+    empty list"""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError('not a list')
+    strings = []
+    for item in value:
+        if item is None:
+            continue
+        if not isinstance(item, basestring):
+            raise ValueError('not a list of strings')
+        strings.append(item)
+    return strings
+
+
+def to_naive_utc(dt):
+    """Returns dt as a naive datetime in UTC, the way tweet times are stored.
+    Naive datetimes are taken to already be in UTC
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(UTC).replace(tzinfo=None)
+    return dt
+
+
+def parse_tweet_created(value):
+    """Returns a tweet's creation time as a naive datetime in UTC, so it is
+    stored the same way whichever path writes it. Twitter's created_at
+    format, e.g. 'Wed Aug 27 13:08:45 +0000 2008', is parsed directly and
+    anything else falls back to dateutil"""
+    if isinstance(value, datetime):
+        return to_naive_utc(value)
+    if not isinstance(value, basestring):
+        raise ValueError('not a date')
+    parts = value.split(' ')
+    if len(parts) == 6 and parts[4] == '+0000' and parts[1] in TWITTER_MONTHS:
+        clock = parts[3].split(':')
+        if len(clock) == 3:
+            try:
+                return datetime(
+                    int(parts[5]), TWITTER_MONTHS[parts[1]], int(parts[2]),
+                    int(clock[0]), int(clock[1]), int(clock[2])
+                )
+            except ValueError:
+                pass
+    return to_naive_utc(date_parse(value))
+
+
+# Fields every tweet payload must have and how each is coerced. Fields of
+# retweets are only checked on the retweeted tweet in retweet_data
+TWEET_FIELDS = (
+    ('tweet_id', coerce_id),
+    ('user_name', coerce_string),
+    ('url', coerce_string),
+    ('tweet_created', parse_tweet_created),
+    ('is_retweet', coerce_bool),
+)
+ORIGINAL_TWEET_FIELDS = (
+    ('tweet_text', coerce_string),
+    ('user_mentions', coerce_string_list),
+    ('hashtags', coerce_string_list),
+    ('tweet_urls', coerce_string_list),
+)
+
+
+def decode_fields(tweet_data, fields, tweet, path):
+    """Coerces each of fields from tweet_data into tweet"""
+    for field, coerce in fields:
+        try:
+            value = tweet_data[field]
+        except KeyError:
+            raise InvalidTweetPayload('{0}{1} is missing'.format(path, field))
+        try:
+            tweet[field] = coerce(value)
+        except (TypeError, ValueError, OverflowError) as e:
+            # dateutil raises OverflowError for numbers too large to be dates
+            raise InvalidTweetPayload(
+                '{0}{1} is invalid: {2}'.format(path, field, e)
+            )
+
+
+def decode_tweet_payload(tweet_data, path=''):
+    """Takes a tweet payload, either decoded or as a JSON string, and returns
+    a dict of its validated fields with ids as ints, is_retweet as a bool and
+    tweet_created as a datetime. A retweet's retweet_data is decoded the same
+    way and its own text, mentions, hashtags and urls are left out. Raises
+    InvalidTweetPayload for a payload that doesn't fit
+    """
+    if isinstance(tweet_data, basestring):
+        try:
+            tweet_data = loads(tweet_data)
+        except ValueError as e:
+            raise InvalidTweetPayload('{0}invalid JSON: {1}'.format(path, e))
+    if not isinstance(tweet_data, dict):
+        raise InvalidTweetPayload('{0}payload is not an object'.format(path))
+    tweet = {}
+    decode_fields(tweet_data, TWEET_FIELDS, tweet, path)
+    if tweet['is_retweet']:
+        tweet['retweet_data'] = decode_tweet_payload(
+            tweet_data.get('retweet_data'), path + 'retweet_data.'
+        )
+    else:
+        decode_fields(tweet_data, ORIGINAL_TWEET_FIELDS, tweet, path)
+        tweet['retweet_data'] = None
+    return tweet
@@ -1,19 +1,188 @@
 """General eleanor utilities"""
+import atexit
 import os
+import json
 import logging
 import logging.config
+import logging.handlers
+import random
+import threading
 import time
+import zlib
+import Queue
+from collections import OrderedDict
 
-eleanor_logger = logging.getLogger('eleanor')
-eleanor_logger.setLevel(logging.DEBUG)
-if 'RUN_ENV' in os.environ:
-    if os.environ['RUN_ENV'] == 'production':
-        handler = logging.handlers.TimedRotatingFileHandler(
-            '/var/log/eleanor/eleanor.log', 'midnight', 1, 0, 'utf-8',
-            False, True
+
+# Logging is configured from the environment. ELEANOR_LOG_LEVEL defaults to
+# INFO in production and DEBUG elsewhere. Payloads logged with log_payload
+# are cut to ELEANOR_LOG_PAYLOAD_MAX_LENGTH characters and only a
+# ELEANOR_LOG_PAYLOAD_SAMPLE_RATE fraction of them are logged
+LOG_QUEUE_SIZE = 10000
+LOG_PAYLOAD_MAX_LENGTH = int(
+    os.environ.get('ELEANOR_LOG_PAYLOAD_MAX_LENGTH', '1000')
+)
+LOG_PAYLOAD_SAMPLE_RATE = float(
+    os.environ.get('ELEANOR_LOG_PAYLOAD_SAMPLE_RATE', '1.0')
+)
+
+
+class QueueHandler(logging.Handler):
+    """Log handler that puts records on a bounded queue for a background
+    thread to pass to target_handler, so request threads never wait on file
+    I/O. Records are dropped rather than blocking when the queue is full, and
+    a warning with the number dropped is written once the writer catches up.
+    The queue and writer thread are created on first use in each process, so
+    forked workers get their own
+    """
+
+    def __init__(self, target_handler, queue_size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.target_handler = target_handler
+        self.queue_size = queue_size
+        self.reset()
+
+    def reset(self):
+        """Start over with an empty queue and no writer thread, owned by this
+        process"""
+        self.queue = Queue.Queue(self.queue_size)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self._writer = None
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def start(self):
+        """Start the writer thread if it isn't running in this process"""
+        if self._pid != os.getpid():
+            # Records queued before a fork are the parent's to write, and the
+            # queue's mutex may have been held by a parent thread at the fork
+            self.reset()
+        with self._writer_lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer = threading.Thread(target=self.run_writer)
+            self._writer.daemon = True
+            self._writer.start()
+            self._writer_pid = os.getpid()
+
+    def prepare(self, record):
+        """Format the message now, while its arguments are unchanged, and drop
+        anything that can't be passed to the writer thread"""
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        self.start()
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def report_dropped(self):
+        """Write a warning with the number of records dropped since the last
+        report, if any were"""
+        dropped = self.dropped
+        if dropped == self.reported_dropped:
+            return
+        record = logging.LogRecord(
+            eleanor_logger.name, logging.WARNING, __file__, 0,
+            'Dropped %s log records because the log queue was full',
+            (dropped - self.reported_dropped,), None
         )
+        self.reported_dropped = dropped
+        self.target_handler.handle(self.prepare(record))
+
+    def run_writer(self):
+        """Writer thread loop, a None record stops it"""
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                self.target_handler.handle(record)
+                self.report_dropped()
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait for queued records to be written"""
+        if self._writer_pid == os.getpid():
+            self.queue.join()
+        self.target_handler.flush()
+
+    def close(self):
+        """Write any queued records then stop the writer thread"""
+        if self._writer_pid == os.getpid() and self._writer.is_alive():
+            # The writer handles the records queued before this one first
+            self.queue.put(None)
+            self._writer.join()
+        self.report_dropped()
+        self.target_handler.close()
+        logging.Handler.close(self)
+
+
+def get_log_level():
+    """Returns the log level named by ELEANOR_LOG_LEVEL"""
+    default_level = 'DEBUG'
+    if os.environ.get('RUN_ENV') == 'production':
+        default_level = 'INFO'
+    level_name = os.environ.get('ELEANOR_LOG_LEVEL', default_level).upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        raise ValueError('Unknown ELEANOR_LOG_LEVEL {0}'.format(level_name))
+    return level
+
+
+class LogPayload(object):
+    """Wraps a payload passed as a log argument so it is only formatted if the
+    record is emitted, and then cut to max_length characters"""
+
+    def __init__(self, payload, max_length=LOG_PAYLOAD_MAX_LENGTH):
+        self.payload = payload
+        self.max_length = max_length
+
+    def __str__(self):
+        text = self.payload
+        if not isinstance(text, basestring):
+            text = repr(text)
+        if len(text) > self.max_length:
+            # Concatenated so unicode payloads stay unicode
+            return text[:self.max_length] + '... ({0} characters)'.format(
+                len(text)
+            )
+        return text
+
+
+def log_payload(level, message, *payloads):
+    """Log message with payloads as its arguments if the level is enabled and
+    the payload sample picks this call"""
+    if not eleanor_logger.isEnabledFor(level):
+        return
+    if (
+            LOG_PAYLOAD_SAMPLE_RATE < 1 and
+            random.random() >= LOG_PAYLOAD_SAMPLE_RATE
+    ):
+        return
+    eleanor_logger.log(
+        level, message, *[LogPayload(payload) for payload in payloads]
+    )
+
+
+eleanor_logger = logging.getLogger('eleanor')
+eleanor_logger.setLevel(get_log_level())
+if os.environ.get('RUN_ENV') == 'production':
+    file_handler = logging.handlers.TimedRotatingFileHandler(
+        '/var/log/eleanor/eleanor.log', 'midnight', 1, 0, 'utf-8',
+        False, True
+    )
 else:
-    handler = logging.handlers.TimedRotatingFileHandler(
+    file_handler = logging.handlers.TimedRotatingFileHandler(
         '/tmp/eleanor.log', 'midnight', 1, 0, 'utf-8', False,
         True
     )
@@ -21,7 +190,106 @@ formatter = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 formatter.converter = time.gmtime
+handler = QueueHandler(file_handler)
 handler.setFormatter(formatter)
 if not len(eleanor_logger.handlers):
     eleanor_logger.addHandler(handler)
+    atexit.register(handler.close)
 eleanor_logger.propagate = False
+
+
+class LRUCache(object):
+    """A thread safe mapping that holds at most max_size items, evicting the
+    least recently used item when full
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as recently used, or default
+        """
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used item if the
+        cache is full
+        """
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """Remove key from the cache if it is there"""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """Remove every item from the cache"""
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+def iter_ndjson(items, serialized=False):
+    """Yields each item encoded as a line of newline delimited JSON. Items
+    that are already JSON encoded are passed with serialized set"""
+    for item in items:
+        if not serialized:
+            item = json.dumps(item)
+        yield item + '\n'
+
+
+def iter_gzip(chunks):
+    """Yields a gzip stream of the given string chunks, compressing as the
+    chunks arrive so the whole stream is never held in memory
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+    )
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class ForkSafeLock(object):
+    """A lock that is replaced by a new unlocked lock in each process, so a
+    lock held by another thread when the process forked can't deadlock the
+    child. Use it as a context manager like threading.Lock
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def get_lock(self):
+        """Return the lock for the current process"""
+        pid = os.getpid()
+        lock = self._locks.get(pid)
+        if lock is None:
+            # setdefault is atomic, so threads racing to create the lock
+            # after a fork all get the same one
+            lock = self._locks.setdefault(pid, threading.Lock())
+        return lock
+
+    def __enter__(self):
+        self.get_lock().acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.get_lock().release()
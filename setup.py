@@ -18,6 +18,7 @@ setup(
     maintainer='Brett Smythe',
     maintainer_email='smythebrett@gmail.com',
     packages=find_packages(),
+    package_data={'eleanor': ['example_payload_data.json']},
     install_reqs=reqs,
     entry_points={
         'console_scripts': [
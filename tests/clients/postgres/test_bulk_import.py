@@ -0,0 +1,74 @@
+"""Tests for bulk importing tweets with COPY"""
+# pylint: disable=import-error
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import mock
+
+from eleanor.clients.postgres import bulk_import
+
+
+class BulkImportCases(unittest.TestCase):
+    """Tests for bulk importing tweets with COPY"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_iter_payload_file_json_array(self):
+        """Test reading payloads from a file holding a JSON array"""
+        path = os.path.join(self.temp_dir, 'tweets.json')
+        with open(path, 'wb') as payload_file:
+            payload_file.write('\n[\n{"tweet_id": 1},\n{"tweet_id": 2}\n]\n')
+        self.assertEqual(
+            list(bulk_import.iter_payload_file(path)),
+            [{'tweet_id': 1}, {'tweet_id': 2}]
+        )
+
+    def test_copy_records(self):
+        """Test nulls, empty strings and quotes are kept apart in COPY data"""
+        mock_cursor = mock.MagicMock()
+        copied = []
+        mock_cursor.copy_expert.side_effect = (
+            lambda sql, copy_file: copied.append(copy_file.read())
+        )
+        bulk_import.copy_records(mock_cursor, 'staging_tweets', [
+            (1, None, u'say "hi"', '', True, datetime(2016, 10, 17, 12))
+        ])
+        self.assertIn("NULL '\\N'", mock_cursor.copy_expert.call_args[0][0])
+        self.assertEqual(
+            copied,
+            ['1,\\N,"say ""hi""","",t,"2016-10-17T12:00:00"\n']
+        )
+
+    def test_get_staging_records_retweet(self):
+        """Test a retweet is staged after the tweet it retweets"""
+        source_row = {
+            'tweet_id': 1, 'user_name': 'NASA', 'url': 'fake-url-1',
+            'tweet_text': 'fake text', 'time_posted': datetime(2016, 10, 17),
+            'is_retweet': False, 'retweet_source_tweet_id': None,
+            'retweet_source_row': None, 'user_mentions': [],
+            'hashtags': ['space', 'mars'], 'tweet_urls': []
+        }
+        retweet_row = dict(
+            source_row, tweet_id=2, user_name='SpaceX', url='fake-url-2',
+            tweet_text='', is_retweet=True, retweet_source_tweet_id=1,
+            retweet_source_row=source_row, hashtags=[]
+        )
+        tweet_records, child_records, max_depth = (
+            bulk_import.get_staging_records([retweet_row])
+        )
+        self.assertEqual(max_depth, 1)
+        self.assertEqual(
+            [(record[0], record[1], record[2]) for record in tweet_records],
+            [(0, 0, 1), (1, 1, 2)]
+        )
+        self.assertEqual(
+            child_records,
+            [(0, 'hashtags', 0, 'space'), (0, 'hashtags', 1, 'mars')]
+        )
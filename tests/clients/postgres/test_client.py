@@ -0,0 +1,69 @@
+"""Tests for the eleanor postgres client"""
+import unittest
+
+import mock
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+from eleanor.clients.postgres import client, utils
+
+
+class EleanorPostgresClientCases(unittest.TestCase):
+    """Tests for the eleanor postgres client"""
+
+    def setUp(self):
+        client._engine = None
+        client._session_factory = None
+
+    @mock.patch('eleanor.clients.postgres.client.os.getpid')
+    @mock.patch('eleanor.clients.postgres.client.get_db_engine')
+    def test_session_factory_is_reused(self, mock_get_engine, mock_getpid):
+        """Test that sessions in one process share a single engine"""
+        mock_getpid.return_value = 100
+        first_factory = client.get_session_factory()
+        second_factory = client.get_session_factory()
+        self.assertIs(first_factory, second_factory)
+        self.assertEqual(mock_get_engine.call_count, 1)
+
+    @mock.patch('eleanor.clients.postgres.client.os.getpid')
+    def test_connections_not_shared_after_fork(self, mock_getpid):
+        """Test that a forked process gets new connections and leaves the ones
+        it inherited open for its parent"""
+        mock_getpid.return_value = 100
+        engine = create_engine('sqlite://', poolclass=QueuePool)
+        event.listen(engine, 'connect', client.record_connection_pid)
+        event.listen(engine, 'checkout', client.check_connection_pid)
+        connection = engine.connect()
+        parent_dbapi_connection = connection.connection.connection
+        connection.close()
+
+        mock_getpid.return_value = 101
+        connection = engine.connect()
+        self.assertIsNot(
+            connection.connection.connection, parent_dbapi_connection
+        )
+        connection.close()
+        self.assertEqual(
+            parent_dbapi_connection.execute('SELECT 1').fetchone(), (1,)
+        )
+
+    @mock.patch('eleanor.clients.postgres.client.get_db_engine')
+    def test_session_listeners_only_on_eleanor_sessions(
+            self, mock_get_engine
+    ):
+        """Test that eleanor's session listeners don't apply to every
+        sqlalchemy session in the process"""
+        # pylint: disable=unused-argument
+        session = client.get_session_factory()()
+        self.assertIsInstance(session, client.EleanorSession)
+        for listener in (utils.cache_committed_dictionary_ids,
+                         utils.discard_dictionary_ids):
+            self.assertFalse(event.contains(Session, 'after_commit', listener))
+            self.assertFalse(
+                event.contains(Session, 'after_rollback', listener)
+            )
+        self.assertTrue(event.contains(
+            client.EleanorSession, 'after_commit',
+            utils.cache_committed_dictionary_ids
+        ))
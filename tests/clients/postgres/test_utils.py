@@ -1,16 +1,26 @@
 """Test for eleanor sqlalchemy postgres utils"""
 import unittest
+import json
 
+from collections import namedtuple
 from datetime import datetime
 
 import mock
 
 from eleanor.clients.postgres import utils
+from eleanor.payloads import InvalidTweetPayload
+from eleanor.models import twitter_models
 
 
 class EleanorPostgresUtilsCases(unittest.TestCase):
     """Tests for eleanor sqlalchemy postgres utils"""
 
+    def setUp(self):
+        # Each test reads through its own empty caches
+        cache_patcher = mock.patch('eleanor.cache._caches', None)
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
     def test_get_string_from_datetime(self):
         """Test datetime conversion used by eleanor"""
         test_dt = datetime(year=1997, month=8, day=29, hour=02, minute=14)
@@ -19,3 +29,371 @@ class EleanorPostgresUtilsCases(unittest.TestCase):
             test_dt_string,
             '1997-08-29T02:14:00+'
         )
+
+    def test_get_tweet_row_retweet(self):
+        """Test flattening a retweet payload into insertable rows"""
+        original = {
+            'user_name': 'NASA',
+            'tweet_id': '10',
+            'url': 'https://twitter.com/NASA/status/10',
+            'tweet_text': 'Spacecraft somersault!',
+            'tweet_created': 'Wed Aug 27 13:08:45 +0000 2008',
+            'is_retweet': False,
+            'user_mentions': ['other'],
+            'hashtags': None,
+            'tweet_urls': []
+        }
+        retweet = dict(original, tweet_id='11', is_retweet=True)
+        retweet['retweet_data'] = original
+        row = utils.get_tweet_row(json.dumps(retweet))
+        self.assertEqual(row['tweet_id'], 11)
+        self.assertEqual(row['retweet_source_tweet_id'], 10)
+        self.assertEqual(row['tweet_text'], '')
+        self.assertEqual(row['user_mentions'], [])
+        source_row = row['retweet_source_row']
+        self.assertEqual(source_row['user_mentions'], ['other'])
+        self.assertEqual(source_row['hashtags'], [])
+        self.assertEqual(source_row['time_posted'].year, 2008)
+
+    def test_get_tweet_row_invalid(self):
+        """Test that a payload missing fields is rejected"""
+        with self.assertRaises(InvalidTweetPayload):
+            utils.get_tweet_row({'tweet_id': '10'})
+
+    @mock.patch('eleanor.clients.postgres.utils.store_tweet_json')
+    @mock.patch('eleanor.clients.postgres.utils.bulk_insert_tweet_rows')
+    @mock.patch('eleanor.clients.postgres.utils.get_twitter_source_ids')
+    def test_write_tweet_rows_retweet_chain(self, mock_get_source_ids,
+                                            mock_bulk_insert,
+                                            mock_store_tweet_json):
+        """Test that a retweet of a retweet is written originals first and
+        the JSON of each new tweet is stored"""
+        original = {
+            'user_name': 'NASA',
+            'tweet_id': '10',
+            'url': 'https://twitter.com/NASA/status/10',
+            'tweet_text': 'Spacecraft somersault!',
+            'tweet_created': 'Wed Aug 27 13:08:45 +0000 2008',
+            'is_retweet': False,
+            'user_mentions': [],
+            'hashtags': [],
+            'tweet_urls': []
+        }
+        retweet = dict(original, tweet_id='11', is_retweet=True)
+        retweet['retweet_data'] = original
+        chained_retweet = dict(original, tweet_id='12', is_retweet=True)
+        chained_retweet['retweet_data'] = retweet
+        mock_get_source_ids.return_value = {}
+        mock_bulk_insert.side_effect = [{10: 1}, {11: 2}, {12: 3}]
+        mock_session = mock.Mock()
+        inserted = utils.write_tweet_rows(
+            [utils.get_tweet_row(chained_retweet)], mock_session
+        )
+        self.assertEqual(inserted, set([10, 11, 12]))
+        mock_store_tweet_json.assert_called_once_with(inserted, mock_session)
+        written = [
+            call[0][0][0] for call in mock_bulk_insert.call_args_list
+        ]
+        self.assertEqual(
+            [row['tweet_id'] for row in written], [10, 11, 12]
+        )
+        self.assertEqual(written[1]['retweet_source_id'], 1)
+        self.assertEqual(written[2]['retweet_source_id'], 2)
+
+    @mock.patch('eleanor.clients.postgres.utils.bulk_insert_tweet_rows')
+    @mock.patch('eleanor.clients.postgres.utils.get_twitter_source_ids')
+    @mock.patch('eleanor.clients.postgres.utils.GetDBSession')
+    def test_insert_tweet_data_duplicate(self, mock_get_db_session,
+                                         mock_get_source_ids,
+                                         mock_bulk_insert):
+        """Test that a tweet already in the database is not inserted again"""
+        # pylint: disable=unused-argument
+        tweet_data = {
+            'user_name': 'NASA',
+            'tweet_id': '10',
+            'url': 'https://twitter.com/NASA/status/10',
+            'tweet_text': 'Spacecraft somersault!',
+            'tweet_created': 'Wed Aug 27 13:08:45 +0000 2008',
+            'is_retweet': False,
+            'user_mentions': [],
+            'hashtags': [],
+            'tweet_urls': []
+        }
+        mock_get_source_ids.return_value = {10: 1}
+        mock_bulk_insert.return_value = {}
+        utils.insert_tweet_data(tweet_data)
+        mock_bulk_insert.assert_called_once_with([], mock.ANY)
+
+    def test_get_tweet_data_from_row_retweet(self):
+        """Test that a retweet and its source are serialized from one row"""
+        columns = [
+            'tweeter_user_name', 'tweet_id', 'is_retweet', 'source_url',
+            'written_text', 'time_posted', 'user_mentions', 'hashtags',
+            'tweet_urls'
+        ]
+        tweet_row = namedtuple(
+            'TweetRow',
+            columns + ['retweet_' + column for column in columns]
+        )
+        posted = datetime(year=2016, month=7, day=21, hour=1, minute=18)
+        row = tweet_row(
+            'JossWhedon', 11, True, 'https://twitter.com/11', '', posted,
+            [], [], [],
+            'NASA', 10, False, 'https://twitter.com/10',
+            'Spacecraft somersault!', posted, ['other'], ['space'], []
+        )
+        tweet_data = utils.get_tweet_data_from_row(row)
+        self.assertEqual(tweet_data['user_name'], 'JossWhedon')
+        self.assertEqual(tweet_data['retweet_data']['tweet_id'], 10)
+        self.assertEqual(tweet_data['retweet_data']['hashtags'], ['space'])
+        self.assertNotIn('retweet_data', tweet_data['retweet_data'])
+
+    @mock.patch('eleanor.clients.postgres.utils.load_tweet_json_by_id')
+    def test_get_tweet_data_by_id_cached(self, mock_load_tweet_json_by_id):
+        """Test that a tweet is only read from the database once"""
+        mock_load_tweet_json_by_id.return_value = '{"tweet_id": 10}'
+        self.assertEqual(utils.get_tweet_data_by_id('10'), {'tweet_id': 10})
+        self.assertEqual(utils.get_tweet_json_by_id(10), '{"tweet_id": 10}')
+        mock_load_tweet_json_by_id.assert_called_once_with(10)
+
+    @mock.patch('eleanor.clients.postgres.utils.GetDBSession')
+    def test_load_tweet_json_by_id(self, mock_get_db_session):
+        """Test that stored JSON is served as is and tweets stored before it
+        was kept are serialized from the same row"""
+        json_row = namedtuple('JSONRow', [
+            'tweeter_user_name', 'tweet_id', 'is_retweet', 'source_url',
+            'written_text', 'time_posted', 'user_mentions', 'hashtags',
+            'tweet_urls', 'payload'
+        ])
+        posted = datetime(year=2016, month=7, day=21, hour=1, minute=18)
+        row = json_row(
+            'NASA', 10, False, 'https://twitter.com/10', 'Spacecraft', posted,
+            [], [], [], '{"stored": true}'
+        )
+        mock_session = mock_get_db_session.return_value.__enter__.return_value
+        mock_first = mock_session.execute.return_value.first
+        mock_first.return_value = row
+        self.assertEqual(utils.load_tweet_json_by_id(10), '{"stored": true}')
+
+        mock_first.return_value = row._replace(payload=None)
+        tweet_data = json.loads(utils.load_tweet_json_by_id(10))
+        self.assertEqual(tweet_data['tweet_id'], 10)
+        self.assertEqual(tweet_data['tweet_text'], 'Spacecraft')
+        self.assertEqual(tweet_data['retweet_data'], {})
+        self.assertEqual(mock_get_db_session.call_count, 2)
+        self.assertEqual(mock_session.execute.call_count, 2)
+
+        mock_first.return_value = None
+        self.assertIsNone(utils.load_tweet_json_by_id(10))
+
+    @mock.patch('eleanor.clients.postgres.utils.get_tweet_data_from_row')
+    def test_store_tweet_json(self, mock_get_tweet_data_from_row):
+        """Test that new tweets are read back and saved as sorted JSON"""
+        mock_session = mock.Mock()
+        rows = [mock.Mock(tweet_id=10), mock.Mock(tweet_id=11)]
+        mock_session.execute.side_effect = [rows, mock.Mock(rowcount=2)]
+        mock_get_tweet_data_from_row.side_effect = lambda row: {
+            'url': 'u', 'tweet_id': row.tweet_id
+        }
+        self.assertEqual(
+            utils.store_tweet_json(set([11, 10]), mock_session), 2
+        )
+        self.assertEqual(
+            mock_session.execute.call_args_list[0][0][1],
+            {'tweet_ids': [10, 11]}
+        )
+        self.assertEqual(mock_session.execute.call_args_list[1][0][1], {
+            'tweet_ids': [10, 11],
+            'payloads': [
+                '{"tweet_id": 10, "url": "u"}', '{"tweet_id": 11, "url": "u"}'
+            ]
+        })
+        self.assertEqual(utils.store_tweet_json(set(), mock_session), 0)
+        self.assertEqual(mock_session.execute.call_count, 2)
+
+    @mock.patch('eleanor.clients.postgres.utils.GetDBSession')
+    def test_last_twitter_user_entry_ids_cached(self, mock_get_db_session):
+        """Test last tweet ids are cached until a new tweet from the user is
+        stored"""
+        mock_session = mock_get_db_session.return_value.__enter__.return_value
+        mock_query = mock_session.query.return_value.filter
+        mock_query.return_value = [('NASA', 10)]
+        self.assertEqual(
+            utils.last_twitter_user_entry_ids(['NASA', 'SpaceX']),
+            {'NASA': 10, 'SpaceX': None}
+        )
+        mock_query.return_value = []
+        self.assertEqual(utils.last_twitter_user_entry_id('NASA'), 10)
+        self.assertEqual(mock_query.call_count, 1)
+
+        retweet_row = {
+            'user_name': 'SpaceX', 'tweet_id': 12,
+            'retweet_source_row': {
+                'user_name': 'NASA', 'tweet_id': 10,
+                'retweet_source_row': None
+            }
+        }
+        utils.forget_inserted_last_tweet_ids([retweet_row], set())
+        mock_query.return_value = [('NASA', 11)]
+        self.assertEqual(utils.last_twitter_user_entry_id('NASA'), 10)
+
+        utils.forget_inserted_last_tweet_ids([
+            {'user_name': 'NASA', 'tweet_id': 11, 'retweet_source_row': None}
+        ], set([11]))
+        self.assertEqual(utils.last_twitter_user_entry_id('NASA'), 11)
+
+    @mock.patch('eleanor.clients.postgres.utils.get_tracked_twitter_tl_users')
+    @mock.patch(
+        'eleanor.clients.postgres.utils._tracked_users_cache',
+        {'version': 0, 'cached_version': None, 'expires': 0, 'payload': None}
+    )
+    def test_get_tracked_twitter_tl_users_payload(
+            self, mock_get_tracked_twitter_tl_users
+    ):
+        """Test the encoded tracked users list is reused until a user is
+        added"""
+        mock_get_tracked_twitter_tl_users.return_value = ['NASA']
+        etag, body = utils.get_tracked_twitter_tl_users_payload()
+        self.assertEqual(json.loads(body), {'twitter_usernames': ['NASA']})
+        self.assertEqual(
+            utils.get_tracked_twitter_tl_users_payload(), (etag, body)
+        )
+        self.assertEqual(mock_get_tracked_twitter_tl_users.call_count, 1)
+
+        mock_get_tracked_twitter_tl_users.return_value = ['NASA', 'SpaceX']
+        utils.forget_tracked_twitter_tl_users()
+        new_etag, _ = utils.get_tracked_twitter_tl_users_payload()
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(mock_get_tracked_twitter_tl_users.call_count, 2)
+
+    @mock.patch('eleanor.clients.postgres.utils.GetDBSession')
+    def test_begin_tracking_twitter_users(self, mock_get_db_session):
+        """Test only newly tracked users are returned, in request order"""
+        mock_session = mock_get_db_session.return_value.__enter__.return_value
+        mock_session.execute.return_value = [('SpaceX',), ('JossWhedon',)]
+        added_users = utils.begin_tracking_twitter_users(
+            ['JossWhedon', 'NASA', 'SpaceX', 'JossWhedon']
+        )
+        self.assertEqual(added_users, ['JossWhedon', 'SpaceX'])
+        self.assertEqual(mock_session.execute.call_count, 1)
+        self.assertTrue(mock_session.commit.called)
+
+    def test_get_search_filter_unknown_match(self):
+        """Test that an unknown match type is rejected"""
+        with self.assertRaises(ValueError):
+            utils.get_search_filter('hydra', 'regex')
+
+    @mock.patch('eleanor.clients.postgres.utils.GetDBSession')
+    def test_get_top_user_rollup_values_bad_limit(self, mock_get_db_session):
+        """Test that a limit out of range is rejected before querying"""
+        for limit in (-1, 0, utils.MAX_TOP_ROLLUP_VALUES + 1, 'all'):
+            with self.assertRaises(ValueError):
+                utils.get_top_user_rollup_values(
+                    'hashtags', 'NASA', '2016-07-01', '2016-07-31', limit
+                )
+        self.assertFalse(mock_get_db_session.called)
+
+    @mock.patch('eleanor.clients.postgres.utils.GetDBSession')
+    def test_count_user_tweets_by_bucket_dense(self, mock_get_db_session):
+        """Test that buckets with no tweets are filled with zero counts"""
+        mock_session = mock_get_db_session.return_value.__enter__.return_value
+        mock_session.query.return_value.join.return_value.filter.\
+            return_value.group_by.return_value = [
+                ('NASA', datetime(year=2016, month=7, day=11), 3, 1)
+            ]
+        counts = utils.count_user_tweets_by_bucket(
+            ['NASA'], '2016-07-04', '2016-07-19', 'week', ['mars', 'moon']
+        )
+        self.assertEqual(counts, {'NASA': [
+            {
+                'bucket': '2016-07-04T00:00:00',
+                'counts': {'mars': 0, 'moon': 0}
+            },
+            {
+                'bucket': '2016-07-11T00:00:00',
+                'counts': {'mars': 3, 'moon': 1}
+            },
+            {
+                'bucket': '2016-07-18T00:00:00',
+                'counts': {'mars': 0, 'moon': 0}
+            },
+        ]})
+
+    @mock.patch('eleanor.clients.postgres.utils.GetDBSession')
+    def test_count_user_tweets_by_bucket_utc(self, mock_get_db_session):
+        """Test that a search term named bucket is counted and that start and
+        end with a timezone are compared in UTC"""
+        mock_session = mock_get_db_session.return_value.__enter__.return_value
+        mock_filter = mock_session.query.return_value.join.return_value.filter
+        mock_filter.return_value.group_by.return_value = [
+            ('NASA', datetime(year=2016, month=7, day=4, hour=1), 2)
+        ]
+        counts = utils.count_user_tweets_by_bucket(
+            ['NASA'], '2016-07-04T02:00:00+02:00', '2016-07-04T04:00:00+02:00',
+            'hour', ['bucket']
+        )
+        self.assertEqual(counts, {'NASA': [
+            {'bucket': '2016-07-04T00:00:00', 'counts': {'bucket': 0}},
+            {'bucket': '2016-07-04T01:00:00', 'counts': {'bucket': 2}},
+        ]})
+        time_filters = mock_filter.call_args[0][0].clauses[1:3]
+        self.assertEqual(
+            [clause.right.value for clause in time_filters],
+            [datetime(2016, 7, 4, 0), datetime(2016, 7, 4, 2)]
+        )
+
+    def test_truncate_datetime_week(self):
+        """Test that weeks are truncated to the Monday they start on"""
+        self.assertEqual(
+            utils.truncate_datetime(
+                datetime(year=2016, month=7, day=21, hour=5), 'week'
+            ),
+            datetime(year=2016, month=7, day=18)
+        )
+
+    def test_get_dictionary_ids_cached_after_commit(self):
+        """Test that dictionary ids are cached only once committed"""
+        mock_session = mock.Mock()
+        mock_session.info = {}
+        mock_session.execute.side_effect = [[('hydra', 7)]]
+        value_ids = utils.get_dictionary_ids(
+            twitter_models.Hashtags, 'hashtag', ['hydra'], mock_session
+        )
+        self.assertEqual(value_ids, {'hydra': 7})
+        cache = utils._dictionary_id_caches[twitter_models.Hashtags]
+        self.assertIsNone(cache.get('hydra'))
+
+        utils.cache_committed_dictionary_ids(mock_session)
+        self.assertEqual(cache.get('hydra'), 7)
+        mock_session.execute.reset_mock()
+        value_ids = utils.get_dictionary_ids(
+            twitter_models.Hashtags, 'hashtag', ['hydra'], mock_session
+        )
+        self.assertEqual(value_ids, {'hydra': 7})
+        self.assertFalse(mock_session.execute.called)
+        cache.clear()
+
+    @mock.patch('eleanor.clients.postgres.utils.iter_tweet_data')
+    def test_get_user_tweet_page_next_before(self, mock_iter_tweet_data):
+        """Test that a full page points at the next page"""
+        mock_iter_tweet_data.return_value = iter(
+            [{'tweet_id': 12}, {'tweet_id': 11}]
+        )
+        page = utils.get_user_tweet_page('NASA', before='13', limit=2)
+        self.assertEqual(page['next_before'], 11)
+        mock_iter_tweet_data.assert_called_with(
+            'ts.tweeter_user_name = :username AND ts.tweet_id < :before',
+            {'username': 'NASA', 'before': 13}, 'ts.tweet_id DESC', 2
+        )
+
+    @mock.patch('eleanor.clients.postgres.utils.iter_tweet_json')
+    def test_get_user_tweet_page_serialized(self, mock_iter_tweet_json):
+        """Test that a page of stored JSON points at the next page"""
+        mock_iter_tweet_json.return_value = iter(
+            [(12, '{"tweet_id": 12}'), (11, '{"tweet_id": 11}')]
+        )
+        page = utils.get_user_tweet_page('NASA', limit=2, serialized=True)
+        self.assertEqual(page, {
+            'tweets': ['{"tweet_id": 12}', '{"tweet_id": 11}'],
+            'next_before': 11
+        })
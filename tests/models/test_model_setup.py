@@ -0,0 +1,34 @@
+"""Tests for setting up the eleanor database"""
+# pylint: disable=import-error
+import unittest
+
+import mock
+from sqlalchemy import Index
+
+from eleanor.models import model_setup
+from eleanor.models.base import Base
+
+
+class EleanorModelSetupCases(unittest.TestCase):
+    """Tests for setting up the eleanor database"""
+
+    @mock.patch.object(Index, 'create', autospec=True)
+    def test_create_missing_indexes(self, mock_create):
+        """Test that only indexes missing from pg_indexes are created, with
+        the expression index on written_text counted as existing"""
+        index_names = set(
+            index.name for table in Base.metadata.sorted_tables
+            for index in table.indexes
+        )
+        self.assertIn('ix_text_source_written_text_tsvector', index_names)
+        existing = index_names - set(['ix_text_source_written_text_trgm'])
+        mock_engine = mock.Mock()
+        mock_engine.execute.return_value = [
+            (index_name,) for index_name in existing
+        ]
+        model_setup.create_missing_indexes(mock_engine)
+        self.assertEqual(
+            [call[0][0].name for call in mock_create.call_args_list],
+            ['ix_text_source_written_text_trgm']
+        )
+        mock_create.assert_called_once_with(mock.ANY, mock_engine)
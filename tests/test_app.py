@@ -2,6 +2,7 @@
 # pylint: disable=import-error
 import unittest
 import json
+import zlib
 
 from functools import wraps
 from logging import RootLogger
@@ -12,6 +13,7 @@ from flask import Response
 
 import eleanor
 import eleanor.app
+import eleanor.payloads
 
 
 class EleanorAppCases(unittest.TestCase):
@@ -41,24 +43,30 @@ class EleanorAppCases(unittest.TestCase):
                                           mock_eleanor_logger):
         """Test getting the list of tracked twitter users"""
         fake_users = ['NASA', 'JossWhedon']
-        response_data = {'twitter_usernames': fake_users}
-        test_response = Response(
-            status=200,
-            mimetype='application/json',
-            response=json.dumps(response_data)
-        )
+        fake_body = json.dumps({'twitter_usernames': fake_users})
         mock_eleanor_logger.return_value = mock.Mock(spec=RootLogger)
-        mock_pg_utils.get_tracked_twitter_tl_users.return_value = fake_users
-        return_resp = eleanor.app.tracked_twitter_tl_user()
-        self.assertEqual(
-            return_resp.status, test_response.status
-        )
-        self.assertEqual(
-            return_resp.mimetype, test_response.mimetype
+        mock_pg_utils.get_tracked_twitter_tl_users_payload.return_value = (
+            'fake-etag', fake_body
         )
-        self.assertEqual(
-            return_resp.response, test_response.response
+        return_resp = eleanor.app.tracked_twitter_tl_user()
+        self.assertEqual(return_resp.status, '200 OK')
+        self.assertEqual(return_resp.mimetype, 'application/json')
+        self.assertEqual(return_resp.get_data(), fake_body)
+        self.assertEqual(return_resp.headers['ETag'], '"fake-etag"')
+
+    @mock.patch('eleanor.app.pg_utils')
+    def test_tracked_twitter_tl_users_get_304(self, mock_pg_utils):
+        """Test an unchanged tracked users list is answered with a 304"""
+        mock_pg_utils.get_tracked_twitter_tl_users_payload.return_value = (
+            'fake-etag', '{"twitter_usernames": []}'
         )
+        for if_none_match in ('"fake-etag"', 'W/"fake-etag"', '"a", *'):
+            with eleanor.app.web_app.test_request_context(
+                '/twitter-tl-users', headers={'If-None-Match': if_none_match}
+            ):
+                return_resp = eleanor.app.tracked_twitter_tl_user()
+            self.assertEqual(return_resp.status, '304 NOT MODIFIED')
+            self.assertEqual(return_resp.get_data(), '')
 
     @mock.patch('eleanor.app.request')
     @mock.patch('eleanor.app.eleanor_logger')
@@ -70,31 +78,154 @@ class EleanorAppCases(unittest.TestCase):
         fake_users = ['SteveRogers', 'JossWhedon']
         mock_eleanor_logger.return_value = mock.Mock(spec=RootLogger)
         mock_request.method = 'POST'
-        mock_request.headers = {'content-type': 'application/json'}
-        mock_request.json = {'twitter_usernames': fake_users}
-        mock_pg_utils.is_twitter_user_in_interns.return_value = False
+        mock_request.get_json.return_value = {'twitter_usernames': fake_users}
+        mock_pg_utils.begin_tracking_twitter_users.return_value = [
+            'JossWhedon'
+        ]
         return_resp = eleanor.app.tracked_twitter_tl_user()
-        mock_pg_utils.begin_tracking_twitter_user.assert_any_call(
-            fake_users[0]
-        )
-        mock_pg_utils.begin_tracking_twitter_user.assert_any_call(
-            fake_users[1]
+        mock_pg_utils.begin_tracking_twitter_users.assert_called_with(
+            fake_users
         )
         self.assertEqual(
             return_resp.status, '200 OK'
         )
+        self.assertEqual(
+            json.loads(return_resp.get_data()),
+            {'added_twitter_usernames': ['JossWhedon']}
+        )
 
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/twitter-tl-users', 'POST')
+    def test_tracked_twitter_tl_users_post_400(self, mock_pg_utils,
+                                               mock_request):
+        """Test adding tracked twitter users without a list of usernames"""
+        mock_request.method = 'POST'
+        for request_data in (None, {}, {'twitter_usernames': 'NASA'},
+                             {'twitter_usernames': [1]}):
+            mock_request.get_json.return_value = request_data
+            self.assertEqual(
+                eleanor.app.tracked_twitter_tl_user().status,
+                '400 BAD REQUEST'
+            )
+        self.assertFalse(mock_pg_utils.begin_tracking_twitter_users.called)
+
+    @mock.patch('eleanor.app.ingest')
     @mock.patch('eleanor.app.pg_utils')
     @mock.patch('eleanor.app.request')
     @create_test_context('/add-tweet-data', 'POST')
-    def test_add_tweet_data(self, mock_request, mock_pg_utils):
+    def test_add_tweet_data(self, mock_request, mock_pg_utils, mock_ingest):
         """Test inserting new tweet data"""
         # pylint: disable=no-self-use
         fake_data = '{"test": "json"}'
-        mock_request.get_json.return_value = fake_data
+        mock_request.get_data.return_value = fake_data
+        mock_ingest.get_ingest_queue.return_value = None
         eleanor.app.add_tweet_data()
         mock_pg_utils.insert_tweet_data.assert_called_with(fake_data)
 
+        mock_pg_utils.insert_tweet_data.side_effect = (
+            eleanor.payloads.InvalidTweetPayload('tweet_id is missing')
+        )
+        self.assertEqual(
+            eleanor.app.add_tweet_data().status, '400 BAD REQUEST'
+        )
+
+    @mock.patch('eleanor.app.ingest')
+    @mock.patch('eleanor.app.pg_utils')
+    @mock.patch('eleanor.app.request')
+    @create_test_context('/add-tweet-data', 'POST')
+    def test_add_tweet_data_queued(self, mock_request, mock_pg_utils,
+                                   mock_ingest):
+        """Test new tweet data is queued when asynchronous ingest is on"""
+        fake_row = {'tweet_id': 10}
+        mock_queue = mock_ingest.get_ingest_queue.return_value
+        mock_queue.put.return_value = True
+        mock_pg_utils.get_tweet_row.return_value = fake_row
+        self.assertEqual(eleanor.app.add_tweet_data().status, '202 ACCEPTED')
+        mock_queue.put.assert_called_with(fake_row)
+        self.assertFalse(mock_pg_utils.insert_tweet_data.called)
+
+        mock_queue.put.return_value = False
+        self.assertEqual(
+            eleanor.app.add_tweet_data().status, '429 TOO MANY REQUESTS'
+        )
+
+        mock_pg_utils.get_tweet_row.side_effect = (
+            eleanor.payloads.InvalidTweetPayload('tweet_id is missing')
+        )
+        self.assertEqual(
+            eleanor.app.add_tweet_data().status, '400 BAD REQUEST'
+        )
+
+    @mock.patch('eleanor.app.ingest')
+    @create_test_context('/ingest/status', 'GET')
+    def test_ingest_status(self, mock_ingest):
+        """Test reporting the ingest queue depth"""
+        mock_ingest.get_ingest_queue.return_value.status.return_value = {
+            'enabled': True, 'queue_depth': 3
+        }
+        return_resp = eleanor.app.ingest_status()
+        self.assertEqual(
+            json.loads(return_resp.get_data()),
+            {'enabled': True, 'queue_depth': 3}
+        )
+        mock_ingest.get_ingest_queue.return_value = None
+        return_resp = eleanor.app.ingest_status()
+        self.assertEqual(
+            json.loads(return_resp.get_data()),
+            {'enabled': False, 'queue_depth': 0}
+        )
+
+    @mock.patch('eleanor.app.pg_utils')
+    @mock.patch('eleanor.app.request')
+    @create_test_context('/add-tweet-data/batch', 'POST')
+    def test_add_tweet_data_batch(self, mock_request, mock_pg_utils):
+        """Test inserting a JSON array of new tweet data"""
+        fake_data = [{'tweet_id': 1}, {'tweet_id': 2}]
+        fake_results = [
+            {'tweet_id': 1, 'status': 'inserted'},
+            {'tweet_id': 2, 'status': 'duplicate'}
+        ]
+        mock_request.mimetype = 'application/json'
+        mock_request.get_data.return_value = json.dumps(fake_data)
+        mock_pg_utils.insert_tweet_data_batch.return_value = fake_results
+        return_resp = eleanor.app.add_tweet_data_batch()
+        mock_pg_utils.insert_tweet_data_batch.assert_called_with(fake_data)
+        self.assertEqual(return_resp.status, '200 OK')
+        self.assertEqual(
+            json.loads(return_resp.get_data()), {'results': fake_results}
+        )
+
+    @mock.patch('eleanor.app.pg_utils')
+    @mock.patch('eleanor.app.request')
+    @create_test_context('/add-tweet-data/batch', 'POST')
+    def test_add_tweet_data_batch_ndjson(self, mock_request, mock_pg_utils):
+        """Test inserting NDJSON tweet data"""
+        # pylint: disable=no-self-use
+        mock_request.mimetype = 'application/x-ndjson'
+        mock_request.get_data.return_value = (
+            '{"tweet_id": 1}\n\n{"tweet_id": 2}\n'
+        )
+        mock_pg_utils.insert_tweet_data_batch.return_value = []
+        eleanor.app.add_tweet_data_batch()
+        mock_pg_utils.insert_tweet_data_batch.assert_called_with(
+            ['{"tweet_id": 1}', '{"tweet_id": 2}']
+        )
+
+    @mock.patch('eleanor.app.pg_utils')
+    @mock.patch('eleanor.app.request')
+    @create_test_context('/add-tweet-data/batch', 'POST')
+    def test_add_tweet_data_batch_400(self, mock_request, mock_pg_utils):
+        """Test inserting batch tweet data that is not a list"""
+        mock_request.mimetype = 'application/json'
+        for request_data in ('{"tweet_id": 1}', '[{"tweet_id": 1}'):
+            mock_request.get_data.return_value = request_data
+            self.assertEqual(
+                eleanor.app.add_tweet_data_batch().status,
+                '400 BAD REQUEST'
+            )
+        self.assertFalse(mock_pg_utils.insert_tweet_data_batch.called)
+
     @mock.patch('eleanor.app.pg_utils')
     @create_test_context('/tweet/10', 'GET')
     def test_get_tweet_from_id_200(self, mock_pg_utils):
@@ -105,7 +236,9 @@ class EleanorAppCases(unittest.TestCase):
             mimetype='application/json',
             response=json.dumps(fake_tweet_data)
         )
-        mock_pg_utils.get_tweet_data_by_id.return_value = fake_tweet_data
+        mock_pg_utils.get_tweet_json_by_id.return_value = json.dumps(
+            fake_tweet_data
+        )
         return_resp = eleanor.app.get_tweet_from_id(10)
         self.assertEqual(
             return_resp.status, test_response.status
@@ -123,12 +256,138 @@ class EleanorAppCases(unittest.TestCase):
         """Test getting a tweet by tweet id when no tweet exists with that
         id"""
         no_tweet = None
-        mock_pg_utils.get_tweet_data_by_id.return_value = no_tweet
+        mock_pg_utils.get_tweet_json_by_id.return_value = no_tweet
         self.assertEqual(
             eleanor.app.get_tweet_from_id(10).status,
             '204 NO CONTENT'
         )
 
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/tweets', 'POST')
+    def test_get_tweets_by_ids(self, mock_pg_utils, mock_request):
+        """Test getting many tweets by tweet id"""
+        fake_tweets = [{'tweet_id': 10}, {'tweet_id': 11}]
+        mock_request.get_json.return_value = {'tweet_ids': [10, 11]}
+        mock_pg_utils.get_tweet_data_by_ids.return_value = iter(
+            json.dumps(tweet) for tweet in fake_tweets
+        )
+        return_resp = eleanor.app.get_tweets()
+        mock_pg_utils.get_tweet_data_by_ids.assert_called_with(
+            [10, 11], serialized=True
+        )
+        self.assertEqual(return_resp.status, '200 OK')
+        self.assertEqual(json.loads(return_resp.get_data()), fake_tweets)
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/tweets', 'POST')
+    def test_get_tweets_by_user(self, mock_pg_utils, mock_request):
+        """Test getting tweets for a user within a tweet id range"""
+        mock_request.get_json.return_value = {
+            'twitter_username': 'NASA', 'since_id': 10
+        }
+        mock_pg_utils.get_user_tweet_data.return_value = iter([])
+        return_resp = eleanor.app.get_tweets()
+        mock_pg_utils.get_user_tweet_data.assert_called_with(
+            'NASA', since_id=10, max_id=None, serialized=True
+        )
+        self.assertEqual(json.loads(return_resp.get_data()), [])
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/tweets', 'POST')
+    def test_get_tweets_400(self, mock_pg_utils, mock_request):
+        """Test getting tweets without tweet ids or a username"""
+        # pylint: disable=unused-argument
+        mock_request.get_json.return_value = {}
+        self.assertEqual(
+            eleanor.app.get_tweets().status,
+            '400 BAD REQUEST'
+        )
+
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/users/NASA/tweets?before=100&limit=5', 'GET')
+    def test_get_user_tweets_200(self, mock_pg_utils):
+        """Test getting a page of tweets for a user"""
+        mock_pg_utils.get_user_tweet_page.return_value = {
+            'tweets': ['{"tweet_id": 99}', '{"tweet_id": 98}'],
+            'next_before': 98
+        }
+        return_resp = eleanor.app.get_user_tweets('NASA')
+        mock_pg_utils.get_user_tweet_page.assert_called_with(
+            'NASA', before='100', limit='5', serialized=True
+        )
+        self.assertEqual(
+            json.loads(return_resp.get_data()),
+            {'tweets': [{'tweet_id': 99}, {'tweet_id': 98}], 'next_before': 98}
+        )
+
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/users/NASA/tweets?limit=5000', 'GET')
+    def test_get_user_tweets_400(self, mock_pg_utils):
+        """Test getting a page of tweets with a limit that is too large"""
+        mock_pg_utils.get_user_tweet_page.side_effect = ValueError
+        self.assertEqual(
+            eleanor.app.get_user_tweets('NASA').status,
+            '400 BAD REQUEST'
+        )
+
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context(
+        '/export?twitter_username=NASA', 'GET'
+    )
+    def test_export_tweets(self, mock_pg_utils):
+        """Test streaming a NDJSON export of a user's tweets"""
+        fake_tweets = [{'tweet_id': 10}, {'tweet_id': 11}]
+        mock_pg_utils.iter_tweet_export.return_value = iter(
+            json.dumps(tweet) for tweet in fake_tweets
+        )
+        return_resp = eleanor.app.export_tweets()
+        mock_pg_utils.iter_tweet_export.assert_called_with(
+            username='NASA', start=None, end=None, serialized=True
+        )
+        self.assertEqual(return_resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(line) for line in return_resp.get_data().splitlines()],
+            fake_tweets
+        )
+
+    @mock.patch('eleanor.app.pg_utils')
+    def test_export_tweets_gzip(self, mock_pg_utils):
+        """Test the export is only gzip compressed when gzip is accepted"""
+        for accept_encoding, compressed in (
+                ('gzip, deflate', True),
+                ('gzip;q=0, deflate', False),
+                ('identity', False),
+        ):
+            mock_pg_utils.iter_tweet_export.return_value = iter(
+                ['{"tweet_id": 10}']
+            )
+            with eleanor.app.web_app.test_request_context(
+                    '/export', headers={'Accept-Encoding': accept_encoding}
+            ):
+                return_resp = eleanor.app.export_tweets()
+                data = return_resp.get_data()
+            self.assertEqual(return_resp.headers['Vary'], 'Accept-Encoding')
+            if compressed:
+                self.assertEqual(
+                    return_resp.headers['Content-Encoding'], 'gzip'
+                )
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            else:
+                self.assertNotIn('Content-Encoding', return_resp.headers)
+            self.assertEqual(data, '{"tweet_id": 10}\n')
+
+    @mock.patch('eleanor.app.cache')
+    @create_test_context('/cache/status', 'GET')
+    def test_cache_status(self, mock_cache):
+        """Test reporting cache hit and miss counts"""
+        fake_stats = {'tweets': {'hits': 3, 'misses': 1}}
+        mock_cache.get_cache_stats.return_value = fake_stats
+        return_resp = eleanor.app.cache_status()
+        self.assertEqual(json.loads(return_resp.get_data()), fake_stats)
+
     @mock.patch('eleanor.app.pg_utils')
     @create_test_context('/last-tweet-id/NASA', 'GET')
     def test_get_last_tweet_id_200(self, mock_pg_utils):
@@ -165,6 +424,37 @@ class EleanorAppCases(unittest.TestCase):
             '204 NO CONTENT'
         )
 
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/last-tweet-ids', 'POST')
+    def test_get_last_tweet_ids_200(self, mock_pg_utils, mock_request):
+        """Test getting the last tweet ids for several users at once"""
+        fake_ids = {'NASA': 10, 'JossWhedon': None}
+        mock_request.get_json.return_value = {
+            'twitter_usernames': ['NASA', 'JossWhedon']
+        }
+        mock_pg_utils.last_twitter_user_entry_ids.return_value = fake_ids
+        return_resp = eleanor.app.get_last_tweet_ids()
+        mock_pg_utils.last_twitter_user_entry_ids.assert_called_with(
+            ['NASA', 'JossWhedon']
+        )
+        self.assertEqual(return_resp.status, '200 OK')
+        self.assertEqual(
+            json.loads(return_resp.get_data()), {'last_tweet_ids': fake_ids}
+        )
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/last-tweet-ids', 'POST')
+    def test_get_last_tweet_ids_400(self, mock_pg_utils, mock_request):
+        """Test getting last tweet ids without a list of usernames"""
+        mock_request.get_json.return_value = {}
+        self.assertEqual(
+            eleanor.app.get_last_tweet_ids().status,
+            '400 BAD REQUEST'
+        )
+        self.assertFalse(mock_pg_utils.last_twitter_user_entry_ids.called)
+
     @mock.patch('eleanor.app.request')
     @mock.patch('eleanor.app.pg_utils')
     @create_test_context('/stats/tweets-on-date', 'POST')
@@ -217,3 +507,98 @@ class EleanorAppCases(unittest.TestCase):
             eleanor.app.search_twitter_data().status,
             '204 NO CONTENT'
         )
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/stats/tweets-on-date', 'POST')
+    def test_search_twitter_data_token_match(self, mock_pg_utils,
+                                             mock_request):
+        """Test searching for a number of tweets using token matching"""
+        # pylint: disable=no-self-use
+        mock_request.method = 'POST'
+        mock_request.headers = {'content-type': 'application/json'}
+        mock_request.json = {
+            'twitter_username': 'Bucky',
+            'search_date': '01/01/1945',
+            'search_term': 'hydra',
+            'search_match': 'token'
+        }
+        mock_pg_utils.search_count_of_user_tweets_on_day.return_value = {}
+        eleanor.app.search_twitter_data()
+        mock_pg_utils.search_count_of_user_tweets_on_day.assert_called_with(
+            'Bucky', '01/01/1945', 'hydra', 'token'
+        )
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/stats/tweet-counts', 'POST')
+    def test_count_twitter_data_200(self, mock_pg_utils, mock_request):
+        """Test counting tweets for many users and terms over a date range"""
+        fake_data = {'Bucky': [
+            {'bucket': '1945-01-01T00:00:00', 'counts': {'hydra': 2}}
+        ]}
+        mock_request.get_json.return_value = {
+            'twitter_usernames': ['Bucky'],
+            'start_date': '01/01/1945',
+            'end_date': '02/01/1945',
+            'bucket': 'week',
+            'search_terms': ['hydra']
+        }
+        mock_pg_utils.count_user_tweets_by_bucket.return_value = fake_data
+        return_resp = eleanor.app.count_twitter_data()
+        mock_pg_utils.count_user_tweets_by_bucket.assert_called_with(
+            ['Bucky'], '01/01/1945', '02/01/1945', 'week', ['hydra'],
+            mock_pg_utils.SEARCH_MATCH_SUBSTRING
+        )
+        self.assertEqual(return_resp.status, '200 OK')
+        self.assertEqual(json.loads(return_resp.get_data()), fake_data)
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/stats/tweet-counts', 'POST')
+    def test_count_twitter_data_400(self, mock_pg_utils, mock_request):
+        """Test counting tweets with an invalid bucket"""
+        mock_request.get_json.return_value = {
+            'twitter_usernames': ['Bucky'],
+            'start_date': '01/01/1945',
+            'end_date': '02/01/1945',
+            'bucket': 'fortnight',
+            'search_terms': ['hydra']
+        }
+        mock_pg_utils.count_user_tweets_by_bucket.side_effect = ValueError
+        self.assertEqual(
+            eleanor.app.count_twitter_data().status,
+            '400 BAD REQUEST'
+        )
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/stats/top-hashtags', 'POST')
+    def test_top_hashtags_200(self, mock_pg_utils, mock_request):
+        """Test getting the most used hashtags for a user"""
+        fake_data = [{'hashtag': 'hydra', 'count': 5}]
+        mock_request.get_json.return_value = {
+            'twitter_username': 'Bucky',
+            'start_date': '1945-01-01',
+            'end_date': '1945-01-31'
+        }
+        mock_pg_utils.get_top_user_rollup_values.return_value = fake_data
+        return_resp = eleanor.app.top_hashtags()
+        mock_pg_utils.get_top_user_rollup_values.assert_called_with(
+            'hashtags', 'Bucky', '1945-01-01', '1945-01-31', 10
+        )
+        self.assertEqual(
+            json.loads(return_resp.get_data()), {'hashtags': fake_data}
+        )
+
+    @mock.patch('eleanor.app.request')
+    @mock.patch('eleanor.app.pg_utils')
+    @create_test_context('/stats/top-urls', 'POST')
+    def test_top_urls_400(self, mock_pg_utils, mock_request):
+        """Test getting the most tweeted urls without a date range"""
+        # pylint: disable=unused-argument
+        mock_request.get_json.return_value = {'twitter_username': 'Bucky'}
+        self.assertEqual(
+            eleanor.app.top_urls().status,
+            '400 BAD REQUEST'
+        )
@@ -0,0 +1,57 @@
+"""Tests for the eleanor read-through caches"""
+# pylint: disable=import-error
+import json
+import unittest
+
+import mock
+
+from eleanor import cache
+
+
+class EleanorCacheCases(unittest.TestCase):
+    """Tests for the eleanor read-through caches"""
+
+    @mock.patch('eleanor.cache.time')
+    def test_memory_backend_ttl(self, mock_time):
+        """Test memory cache entries expire after their ttl"""
+        mock_time.time.return_value = 100
+        backend = cache.MemoryCacheBackend(10)
+        backend.set('short', 1, 30)
+        backend.set('forever', 2, 0)
+        mock_time.time.return_value = 131
+        self.assertIsNone(backend.get('short'))
+        self.assertEqual(backend.get('forever'), 2)
+
+    def test_redis_backend(self):
+        """Test values are stored in redis as JSON"""
+        mock_redis = mock.Mock()
+        backend = cache.RedisCacheBackend(None, redis_client=mock_redis)
+        backend.set('key', {'tweet_id': 10}, 0)
+        mock_redis.set.assert_called_with(
+            'key', json.dumps({'tweet_id': 10}), ex=None
+        )
+        mock_redis.get.return_value = '{"tweet_id": 10}'
+        self.assertEqual(backend.get('key'), {'tweet_id': 10})
+
+    def test_read_through_cache(self):
+        """Test values are loaded once and hits and misses are counted"""
+        read_cache = cache.ReadThroughCache(
+            'tweets', cache.MemoryCacheBackend(10), 0
+        )
+        load = mock.Mock(side_effect=[{'tweet_id': 10}, None])
+        self.assertEqual(read_cache.get_or_load(10, load), {'tweet_id': 10})
+        self.assertEqual(read_cache.get_or_load(10, load), {'tweet_id': 10})
+        self.assertIsNone(read_cache.get_or_load(11, load))
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(read_cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_read_through_cache_backend_error(self):
+        """Test a failing backend is treated as a miss"""
+        backend = mock.Mock()
+        backend.get.side_effect = IOError('connection refused')
+        read_cache = cache.ReadThroughCache('tweets', backend, 0)
+        with mock.patch('eleanor.cache.eleanor_logger'):
+            self.assertEqual(
+                read_cache.get_or_load(10, lambda key: {'tweet_id': key}),
+                {'tweet_id': 10}
+            )
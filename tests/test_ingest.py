@@ -0,0 +1,132 @@
+"""Tests for the asynchronous ingest queue"""
+# pylint: disable=import-error
+import unittest
+
+import mock
+from sqlalchemy import exc
+
+from eleanor import ingest
+
+
+def get_insert_error(error_class):
+    """Returns a sqlalchemy error like those raised by insert_tweet_rows"""
+    return error_class('INSERT INTO twitter_source', {}, Exception('error'))
+
+
+class IngestQueueCases(unittest.TestCase):
+    """Tests for the asynchronous ingest queue"""
+
+    @mock.patch('eleanor.ingest.IngestQueue.start')
+    def test_put_rejects_when_full(self, mock_start):
+        """Test rows are rejected once the queue is full"""
+        # pylint: disable=unused-argument
+        ingest_queue = ingest.IngestQueue(2, 10, 0.01, 1)
+        self.assertTrue(ingest_queue.put({'tweet_id': 1}))
+        self.assertTrue(ingest_queue.put({'tweet_id': 2}))
+        self.assertFalse(ingest_queue.put({'tweet_id': 3}))
+        status = ingest_queue.status()
+        self.assertEqual(status['queue_depth'], 2)
+        self.assertEqual(status['queued'], 2)
+        self.assertEqual(status['rejected'], 1)
+
+    @mock.patch('eleanor.ingest.IngestQueue.start')
+    def test_get_batch(self, mock_start):
+        """Test queued rows are collected in batches of batch_size"""
+        # pylint: disable=unused-argument
+        ingest_queue = ingest.IngestQueue(10, 2, 0.01, 1)
+        for tweet_id in range(3):
+            ingest_queue.put({'tweet_id': tweet_id})
+        self.assertEqual(len(ingest_queue.get_batch()), 2)
+        self.assertEqual(len(ingest_queue.get_batch()), 1)
+        self.assertEqual(ingest_queue.get_batch(), [])
+
+    @mock.patch('eleanor.ingest.pg_utils')
+    def test_writer_threads(self, mock_pg_utils):
+        """Test writer threads insert queued rows"""
+        mock_pg_utils.insert_tweet_rows.side_effect = (
+            lambda rows: set(row['tweet_id'] for row in rows[:1])
+        )
+        ingest_queue = ingest.IngestQueue(10, 5, 0.01, 1)
+        self.addCleanup(ingest_queue.stop)
+        ingest_queue.put({'tweet_id': 1})
+        ingest_queue.put({'tweet_id': 2})
+        ingest_queue.flush()
+        status = ingest_queue.status()
+        self.assertEqual(status['queue_depth'], 0)
+        self.assertEqual(status['inserted'] + status['duplicate'], 2)
+        self.assertTrue(mock_pg_utils.insert_tweet_rows.called)
+
+    @mock.patch('eleanor.ingest.IngestQueue.start')
+    @mock.patch('eleanor.ingest.pg_utils')
+    def test_write_batch_waits_for_database(self, mock_pg_utils, mock_start):
+        """Test a batch is kept and retried for as long as the database is
+        unreachable, while the queue fills and rejects new rows"""
+        # pylint: disable=unused-argument
+        unavailable = get_insert_error(exc.OperationalError)
+        ingest_queue = ingest.IngestQueue(1, 2, 0.01, 1, 1, 0.001, 0.002)
+
+        def insert_tweet_rows(rows):
+            # pylint: disable=missing-docstring
+            if mock_pg_utils.insert_tweet_rows.call_count == 1:
+                self.assertTrue(ingest_queue.put({'tweet_id': 3}))
+                self.assertFalse(ingest_queue.put({'tweet_id': 4}))
+            if mock_pg_utils.insert_tweet_rows.call_count < 4:
+                raise unavailable
+            return set(row['tweet_id'] for row in rows)
+        mock_pg_utils.insert_tweet_rows.side_effect = insert_tweet_rows
+        ingest_queue.put({'tweet_id': 1})
+        ingest_queue.write_batch(ingest_queue.get_batch())
+        status = ingest_queue.status()
+        self.assertEqual(mock_pg_utils.insert_tweet_rows.call_count, 4)
+        self.assertEqual(status['inserted'], 1)
+        self.assertEqual(status['retried'], 3)
+        self.assertEqual(status['failed'], 0)
+        self.assertEqual(status['rejected'], 1)
+        self.assertEqual(status['queue_depth'], 1)
+
+    @mock.patch('eleanor.ingest.IngestQueue.start')
+    @mock.patch('eleanor.ingest.pg_utils')
+    def test_write_batch_drops_only_rejected_rows(self, mock_pg_utils,
+                                                  mock_start):
+        """Test a batch the database keeps rejecting is written row by row
+        and only the rejected row is dropped"""
+        # pylint: disable=unused-argument
+        def insert_tweet_rows(rows):
+            # pylint: disable=missing-docstring
+            tweet_ids = set(row['tweet_id'] for row in rows)
+            if 2 in tweet_ids:
+                raise get_insert_error(exc.IntegrityError)
+            return tweet_ids
+        mock_pg_utils.insert_tweet_rows.side_effect = insert_tweet_rows
+        ingest_queue = ingest.IngestQueue(10, 5, 0.01, 1, 2, 0.001, 0.002)
+        for tweet_id in range(1, 4):
+            ingest_queue.put({'tweet_id': tweet_id})
+        ingest_queue.write_batch(ingest_queue.get_batch())
+        status = ingest_queue.status()
+        self.assertEqual(status['inserted'], 2)
+        self.assertEqual(status['failed'], 1)
+        self.assertEqual(mock_pg_utils.insert_tweet_rows.call_count, 6)
+        ingest_queue.flush()
+
+    @mock.patch('eleanor.ingest.threading.Thread')
+    @mock.patch('eleanor.ingest.os.getpid')
+    def test_start_after_fork(self, mock_getpid, mock_thread):
+        """Test a forked process starts with an empty queue of its own"""
+        mock_getpid.return_value = 100
+        ingest_queue = ingest.IngestQueue(10, 5, 0.01, 1)
+        ingest_queue.put({'tweet_id': 1})
+        parent_queue = ingest_queue.queue
+        mock_getpid.return_value = 101
+        ingest_queue.put({'tweet_id': 2})
+        self.assertIsNot(ingest_queue.queue, parent_queue)
+        self.assertEqual(ingest_queue.status()['queue_depth'], 1)
+        self.assertEqual(ingest_queue.status()['queued'], 1)
+        self.assertEqual(mock_thread.call_count, 2)
+
+    @mock.patch('eleanor.ingest.client')
+    def test_get_ingest_settings_defaults(self, mock_client):
+        """Test ingest is synchronous without an [Ingest] cfg section"""
+        mock_client.get_db_config.return_value.has_section.return_value = False
+        settings = ingest.get_ingest_settings()
+        self.assertFalse(settings['async'])
+        self.assertEqual(settings['queue_size'], 10000)
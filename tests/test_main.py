@@ -0,0 +1,82 @@
+"""Tests for the eleanor command line entry point"""
+# pylint: disable=import-error
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import eleanor.main
+
+
+class EleanorMainCases(unittest.TestCase):
+    """Tests for the eleanor command line entry point"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @mock.patch('eleanor.main.app')
+    def test_main_defaults_to_serve(self, mock_app):
+        """Test that running eleanor with no command runs the service"""
+        eleanor.main.main([])
+        mock_app.web_app.run.assert_called_with(port=6060)
+
+    @mock.patch('eleanor.main.pg_utils')
+    def test_export_gzip(self, mock_pg_utils):
+        """Test exporting tweets to a gzip compressed NDJSON file"""
+        fake_tweets = [{'tweet_id': 10}, {'tweet_id': 11}]
+        mock_pg_utils.iter_tweet_export.return_value = iter(
+            json.dumps(tweet) for tweet in fake_tweets
+        )
+        output = os.path.join(self.temp_dir, 'tweets.ndjson.gz')
+        eleanor.main.main([
+            'export', '--gzip', '-o', output, '--twitter-username', 'NASA'
+        ])
+        mock_pg_utils.iter_tweet_export.assert_called_with(
+            username='NASA', start=None, end=None, serialized=True
+        )
+        with gzip.open(output) as export_file:
+            lines = export_file.read().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], fake_tweets)
+
+    @mock.patch('eleanor.main.pg_utils')
+    def test_backfill_json(self, mock_pg_utils):
+        """Test backfilling tweet JSON in batches of the given size"""
+        mock_pg_utils.backfill_tweet_json.return_value = 0
+        eleanor.main.main(['backfill-json', '--batch-size', '50'])
+        mock_pg_utils.backfill_tweet_json.assert_called_with(
+            batch_size=50, progress=eleanor.main.report_backfill_progress
+        )
+
+    @mock.patch('eleanor.main.bulk_import.merge_tweet_rows')
+    def test_import_chunks(self, mock_merge_tweet_rows):
+        """Test importing an NDJSON file in chunks, skipping bad payloads"""
+        mock_merge_tweet_rows.side_effect = lambda rows: len(rows)
+        payload = {
+            'tweet_id': '10', 'user_name': 'NASA', 'url': 'fake-url',
+            'tweet_created': '2016-10-17 12:00:00', 'is_retweet': False,
+            'tweet_text': 'fake text', 'user_mentions': [],
+            'hashtags': ['space'], 'tweet_urls': []
+        }
+        path = os.path.join(self.temp_dir, 'tweets.ndjson.gz')
+        with gzip.open(path, 'wb') as payload_file:
+            for tweet_id in range(3):
+                payload['tweet_id'] = str(tweet_id)
+                payload_file.write(json.dumps(payload) + '\n')
+            payload_file.write('not json\n')
+        with mock.patch('sys.stderr'):
+            eleanor.main.main(['import', path, '--chunk-size', '2'])
+        self.assertEqual(mock_merge_tweet_rows.call_count, 2)
+        chunks = [
+            call_args[0][0] for call_args in
+            mock_merge_tweet_rows.call_args_list
+        ]
+        self.assertEqual([len(rows) for rows in chunks], [2, 1])
+        self.assertEqual(chunks[0][1]['tweet_id'], 1)
+        self.assertEqual(chunks[0][1]['hashtags'], ['space'])
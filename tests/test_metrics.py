@@ -0,0 +1,108 @@
+"""Tests for eleanor request and database metrics"""
+# pylint: disable=import-error
+import unittest
+
+import mock
+
+from sqlalchemy import create_engine
+
+import eleanor.app
+from eleanor import metrics
+
+
+class EleanorMetricsCases(unittest.TestCase):
+    """Tests for eleanor request and database metrics"""
+
+    def test_histogram_render(self):
+        """Test a histogram is rendered with cumulative buckets"""
+        histogram = metrics.Histogram(
+            'fake_seconds', 'Fake help', ('route',), (0.1, 1.0)
+        )
+        histogram.observe(0.05, route='/tweet/<tweet_id>')
+        histogram.observe(0.5, route='/tweet/<tweet_id>')
+        self.assertEqual(
+            histogram.render().splitlines(),
+            [
+                '# HELP fake_seconds Fake help',
+                '# TYPE fake_seconds histogram',
+                'fake_seconds_bucket{le="0.1",route="/tweet/<tweet_id>"} 1',
+                'fake_seconds_bucket{le="1.0",route="/tweet/<tweet_id>"} 2',
+                'fake_seconds_bucket{le="+Inf",route="/tweet/<tweet_id>"} 2',
+                'fake_seconds_sum{route="/tweet/<tweet_id>"} 0.55',
+                'fake_seconds_count{route="/tweet/<tweet_id>"} 2',
+            ]
+        )
+
+    def test_format_labels_escaping(self):
+        """Test label values are escaped"""
+        self.assertEqual(
+            metrics.format_labels({'route': 'a"b\\c\n'}),
+            '{route="a\\"b\\\\c\\n"}'
+        )
+
+    @mock.patch('eleanor.app.eleanor_logger')
+    def test_request_metrics(self, mock_eleanor_logger):
+        """Test requests are counted by route and status"""
+        # pylint: disable=unused-argument
+        client = eleanor.app.web_app.test_client()
+        client.get('/')
+        client.get('/')
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'eleanor_http_requests_total'
+            '{method="GET",route="/",status="200"} 2',
+            response.get_data().splitlines()
+        )
+        self.assertIn(
+            'eleanor_http_requests_in_flight 1',
+            response.get_data().splitlines()
+        )
+
+    @mock.patch('eleanor.metrics.eleanor_logger')
+    def test_instrument_engine(self, mock_eleanor_logger):
+        """Test queries run outside a request are counted and slow queries
+        are logged"""
+        engine = create_engine('sqlite://')
+        metrics.instrument_engine(engine, slow_query_seconds=0.000001)
+        before = metrics.QUERIES.get_key({'route': metrics.NO_ROUTE})
+        start_count = metrics.QUERIES._values.get(before, 0)
+        engine.execute('SELECT 1')
+        self.assertEqual(metrics.QUERIES._values[before], start_count + 1)
+        self.assertTrue(mock_eleanor_logger.warning.called)
+
+    @mock.patch('eleanor.metrics.eleanor_logger')
+    def test_instrument_engine_query_error(self, mock_eleanor_logger):
+        """Test a query that raises is counted and leaves no start time
+        behind"""
+        # pylint: disable=unused-argument
+        engine = create_engine('sqlite://')
+        metrics.instrument_engine(engine)
+        key = metrics.QUERY_ERRORS.get_key({'route': metrics.NO_ROUTE})
+        start_count = metrics.QUERY_ERRORS._values.get(key, 0)
+        with engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.execute('SELECT * FROM missing_table')
+            self.assertEqual(conn.info['query_start_times'], {})
+        self.assertEqual(metrics.QUERY_ERRORS._values[key], start_count + 1)
+
+    def test_instrument_engine_pool(self):
+        """Test connections are counted as they leave and return to the
+        pool"""
+        engine = create_engine('sqlite://')
+        metrics.instrument_engine(engine)
+        checked_out_key = metrics.POOL_CHECKED_OUT.get_key({})
+        checked_out = metrics.POOL_CHECKED_OUT._values.get(checked_out_key, 0)
+        conn = engine.connect()
+        self.assertEqual(
+            metrics.POOL_CHECKED_OUT._values[checked_out_key], checked_out + 1
+        )
+        conn.close()
+        self.assertEqual(
+            metrics.POOL_CHECKED_OUT._values[checked_out_key], checked_out
+        )
+        self.assertGreater(
+            metrics.POOL_CONNECTIONS._values[metrics.POOL_CONNECTIONS.get_key(
+                {}
+            )], 0
+        )
@@ -0,0 +1,100 @@
+"""Tests for decoding ingested tweet payloads"""
+# pylint: disable=import-error
+import json
+import unittest
+from datetime import datetime
+
+from dateutil.parser import parse as date_parse
+
+from eleanor import payloads
+
+
+class EleanorPayloadsCases(unittest.TestCase):
+    """Tests for decoding ingested tweet payloads"""
+
+    def setUp(self):
+        self.tweet = {
+            'user_name': 'NASA',
+            'tweet_id': '754068250401599488',
+            'url': 'https://twitter.com/NASA/status/754068250401599488',
+            'tweet_text': 'Spacecraft somersault!',
+            'tweet_created': 'Wed Aug 27 13:08:45 +0000 2008',
+            'is_retweet': 'False',
+            'user_mentions': ['other', None],
+            'hashtags': None,
+            'tweet_urls': ['http://someurls.com'],
+            'retweet_data': {}
+        }
+
+    def test_decode_example_payload(self):
+        """Test the documented payload, where is_retweet is a string, is
+        decoded and coerced"""
+        tweet = payloads.decode_tweet_payload(json.dumps(self.tweet))
+        self.assertIs(tweet['is_retweet'], False)
+        self.assertEqual(tweet['tweet_id'], 754068250401599488)
+        self.assertEqual(tweet['user_mentions'], ['other'])
+        self.assertEqual(tweet['hashtags'], [])
+        self.assertIsNone(tweet['retweet_data'])
+
+    def test_decode_retweet(self):
+        """Test a retweet is decoded along with the tweet it retweets"""
+        retweet = dict(
+            self.tweet, tweet_id=11, is_retweet='True', tweet_text=None,
+            retweet_data=self.tweet
+        )
+        tweet = payloads.decode_tweet_payload(retweet)
+        self.assertIs(tweet['is_retweet'], True)
+        self.assertNotIn('tweet_text', tweet)
+        self.assertEqual(
+            tweet['retweet_data']['tweet_id'], 754068250401599488
+        )
+
+    def test_decode_invalid(self):
+        """Test invalid payloads name the field at fault"""
+        cases = (
+            (dict(self.tweet, is_retweet='maybe'), 'is_retweet'),
+            (dict(self.tweet, tweet_id='75x'), 'tweet_id'),
+            (dict(self.tweet, hashtags='space'), 'hashtags'),
+            (
+                dict(self.tweet, tweet_created='99999999999999999999'),
+                'tweet_created'
+            ),
+            (dict(self.tweet, is_retweet=True), 'retweet_data.'),
+            ('{"tweet_id": ', 'invalid JSON'),
+            ('[]', 'not an object'),
+        )
+        for tweet_data, message in cases:
+            with self.assertRaises(payloads.InvalidTweetPayload) as context:
+                payloads.decode_tweet_payload(tweet_data)
+            self.assertIn(message, str(context.exception))
+        tweet_data = dict(self.tweet)
+        del tweet_data['url']
+        with self.assertRaises(payloads.InvalidTweetPayload):
+            payloads.decode_tweet_payload(tweet_data)
+
+    def test_parse_tweet_created(self):
+        """Test twitter's created_at format matches dateutil, other formats
+        fall back to it, and every time is returned as naive UTC"""
+        for value, expected in (
+                ('Wed Aug 27 13:08:45 +0000 2008',
+                 datetime(2008, 8, 27, 13, 8, 45)),
+                ('Mon Feb 29 00:00:01 +0000 2016',
+                 datetime(2016, 2, 29, 0, 0, 1)),
+                ('2016-10-17 12:00:00', datetime(2016, 10, 17, 12)),
+                ('Wed Aug 27 13:08:45 +0200 2008',
+                 datetime(2008, 8, 27, 11, 8, 45)),
+                ('2016-10-17T00:30:00-05:00', datetime(2016, 10, 17, 5, 30))
+        ):
+            self.assertEqual(payloads.parse_tweet_created(value), expected)
+        self.assertEqual(
+            payloads.parse_tweet_created('Wed Aug 27 13:08:45 +0000 2008'),
+            date_parse('Wed Aug 27 13:08:45 +0000 2008').replace(tzinfo=None)
+        )
+        posted = datetime(2016, 10, 17)
+        self.assertIs(payloads.parse_tweet_created(posted), posted)
+        self.assertEqual(
+            payloads.parse_tweet_created(
+                date_parse('2016-10-17T02:00:00+02:00')
+            ),
+            posted
+        )
@@ -0,0 +1,148 @@
+"""Tests for general eleanor utilities"""
+# pylint: disable=import-error
+import logging
+import unittest
+
+import mock
+
+from eleanor import utils
+from eleanor.utils import LRUCache
+
+
+class ListHandler(logging.Handler):
+    """Log handler keeping the messages it handles"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class EleanorUtilsCases(unittest.TestCase):
+    """Tests for general eleanor utilities"""
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        """Test that a full cache drops the item used longest ago"""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    @mock.patch('eleanor.utils.os.getpid')
+    def test_fork_safe_lock(self, mock_getpid):
+        """Test a lock held when the process forked is not held in the
+        child"""
+        mock_getpid.return_value = 100
+        lock = utils.ForkSafeLock()
+        lock.get_lock().acquire()
+        mock_getpid.return_value = 101
+        with lock:
+            self.assertFalse(lock.get_lock().acquire(False))
+        self.assertTrue(lock.get_lock().acquire(False))
+
+    def test_queue_handler(self):
+        """Test records are formatted on the calling thread and written by the
+        writer thread"""
+        target_handler = ListHandler()
+        handler = utils.QueueHandler(target_handler)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        logger = logging.getLogger('eleanor.tests.queue_handler')
+        logger.propagate = False
+        logger.addHandler(handler)
+        payload = ['NASA']
+        logger.warning('Adding %s', payload)
+        payload.append('SpaceX')
+        handler.flush()
+        handler.close()
+        logger.removeHandler(handler)
+        self.assertEqual(target_handler.messages, ["WARNING Adding ['NASA']"])
+
+    @mock.patch('eleanor.utils.threading.Thread')
+    @mock.patch('eleanor.utils.os.getpid')
+    def test_queue_handler_after_fork(self, mock_getpid, mock_thread):
+        """Test a forked process queues records on a queue of its own"""
+        mock_getpid.return_value = 100
+        handler = utils.QueueHandler(ListHandler())
+        record = logging.LogRecord(
+            'eleanor', logging.INFO, '', 0, 'x', (), None
+        )
+        handler.emit(record)
+        parent_queue = handler.queue
+        mock_getpid.return_value = 101
+        handler.emit(record)
+        self.assertIsNot(handler.queue, parent_queue)
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(mock_thread.call_count, 2)
+
+    @mock.patch('eleanor.utils.threading.Thread')
+    def test_queue_handler_reports_dropped(self, mock_thread):
+        """Test records dropped from a full queue are reported once"""
+        # pylint: disable=unused-argument
+        target_handler = ListHandler()
+        handler = utils.QueueHandler(target_handler, queue_size=1)
+        # The writer thread is mocked, so the queued record would keep
+        # logging's flush at exit waiting
+        self.addCleanup(handler.reset)
+        record = logging.LogRecord(
+            'eleanor', logging.INFO, '', 0, 'x', (), None
+        )
+        for _ in range(3):
+            handler.emit(record)
+        self.assertEqual(handler.dropped, 2)
+        handler.report_dropped()
+        handler.report_dropped()
+        self.assertEqual(
+            target_handler.messages,
+            ['Dropped 2 log records because the log queue was full']
+        )
+
+    def test_log_payload_max_length(self):
+        """Test long payloads are cut short"""
+        self.assertEqual(
+            str(utils.LogPayload('x' * 20, max_length=5)),
+            'xxxxx... (20 characters)'
+        )
+        self.assertEqual(str(utils.LogPayload(['NASA'])), "['NASA']")
+        self.assertEqual(unicode(utils.LogPayload(u'caf\xe9')), u'caf\xe9')
+        self.assertEqual(
+            unicode(utils.LogPayload(u'caf\xe9' * 2, max_length=4)),
+            u'caf\xe9... (8 characters)'
+        )
+
+    @mock.patch('eleanor.utils.LogPayload')
+    @mock.patch('eleanor.utils.eleanor_logger')
+    def test_log_payload_lazy(self, mock_eleanor_logger, mock_log_payload):
+        """Test payloads aren't wrapped when the level is disabled or the call
+        isn't sampled"""
+        mock_eleanor_logger.isEnabledFor.return_value = False
+        utils.log_payload(logging.DEBUG, 'Payload %s', {'tweet_id': 1})
+        self.assertFalse(mock_log_payload.called)
+
+        mock_eleanor_logger.isEnabledFor.return_value = True
+        with mock.patch('eleanor.utils.LOG_PAYLOAD_SAMPLE_RATE', 0):
+            utils.log_payload(logging.DEBUG, 'Payload %s', {'tweet_id': 1})
+        self.assertFalse(mock_eleanor_logger.log.called)
+
+        utils.log_payload(logging.DEBUG, 'Payload %s', {'tweet_id': 1})
+        mock_eleanor_logger.log.assert_called_with(
+            logging.DEBUG, 'Payload %s', mock_log_payload.return_value
+        )
+
+    def test_get_log_level(self):
+        """Test the log level is read from the environment"""
+        with mock.patch.dict('os.environ', {'ELEANOR_LOG_LEVEL': 'warning'}):
+            self.assertEqual(utils.get_log_level(), logging.WARNING)
+        with mock.patch.dict(
+                'os.environ', {'RUN_ENV': 'production'}, clear=True
+        ):
+            self.assertEqual(utils.get_log_level(), logging.INFO)
+        with mock.patch.dict('os.environ', {'ELEANOR_LOG_LEVEL': 'loud'}):
+            with self.assertRaises(ValueError):
+                utils.get_log_level()